@@ -1,17 +1,26 @@
 # -*- coding: UTF-8 -*-
 import logging
+import time
 import traceback
+import uuid
 
 import simplejson as json
 from django.http import HttpResponse
 
 from common.utils.permission import superuser_required
 from sql.models import Config
+from sql.utils.tasks import check_schedule_configs, add_config_schedules
 from django.db import transaction
 from django.core.cache import cache
 
 logger = logging.getLogger('default')
 
+SYS_CONFIG_VERSION_KEY = 'sys_config_version'
+# 进程内配置的版本号校验间隔，单位秒，间隔内直接使用进程内配置
+VERSION_CHECK_INTERVAL = 1
+# 进程内配置快照 (版本号, 配置, 校验时间)，快照与调用方互不共享字典，修改调用方的配置不影响快照
+_snapshot = (None, None, 0)
+
 
 class SysConfig(object):
     def __init__(self):
@@ -19,6 +28,24 @@ class SysConfig(object):
         self.get_all_config()
 
     def get_all_config(self):
+        global _snapshot
+        # 优先使用进程内配置，版本号未变化时无需读取和反序列化整个配置
+        version, sys_config, checked_at = _snapshot
+        now = time.monotonic()
+        if sys_config is not None and now - checked_at < VERSION_CHECK_INTERVAL:
+            self.sys_config = dict(sys_config)
+            return
+        current_version = _config_version()
+        if sys_config is not None and current_version is not None and current_version == version:
+            _snapshot = (version, sys_config, now)
+            self.sys_config = dict(sys_config)
+            return
+        # 无法获取版本号或者配置加载失败时不使用进程内配置
+        if self._load_config() and current_version is not None:
+            _snapshot = (current_version, dict(self.sys_config), now)
+
+    def _load_config(self):
+        """从缓存或数据库加载配置，数据库读取失败时返回False"""
         # 优先获取缓存数据
         try:
             sys_config = cache.get('sys_config')
@@ -44,12 +71,14 @@ class SysConfig(object):
             except Exception as m:
                 logger.error(f"获取系统配置信息失败:{m}{traceback.format_exc()}")
                 self.sys_config = {}
+                return False
             else:
                 try:
                     # 更新缓存
                     cache.set('sys_config', self.sys_config, timeout=None)
                 except Exception as m:
                     logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return True
 
     def get(self, key, default_value=None):
         value = self.sys_config.get(key, default_value)
@@ -67,12 +96,8 @@ class SysConfig(object):
         config_item.value = value
         config_item.save()
         # 删除并更新缓存
-        try:
-            cache.delete('sys_config')
-        except Exception as m:
-            logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
-        finally:
-            self.get_all_config()
+        _invalidate()
+        self.get_all_config()
 
     def replace(self, configs):
         result = {'status': 0, 'msg': 'ok', 'data': []}
@@ -89,25 +114,54 @@ class SysConfig(object):
             result['status'] = 1
             result['msg'] = str(e)
         finally:
+            _invalidate()
             self.get_all_config()
         return result
 
     def purge(self):
         """清除所有配置, 供测试以及replace方法使用"""
-        try:
-            self.sys_config = {}
-            cache.delete('sys_config')
-        except Exception as m:
-            logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
+        self.sys_config = {}
+        _invalidate()
         with transaction.atomic():
             Config.objects.all().delete()
 
 
+def _config_version():
+    """获取配置版本号，不存在则初始化，获取失败返回None"""
+    try:
+        version = cache.get(SYS_CONFIG_VERSION_KEY)
+        if version is None:
+            cache.add(SYS_CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(SYS_CONFIG_VERSION_KEY)
+        return version
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return None
+
+
+def _invalidate():
+    """删除配置缓存并更新版本号，其他进程在版本号校验间隔后重新加载配置"""
+    global _snapshot
+    _snapshot = (None, None, 0)
+    try:
+        cache.delete('sys_config')
+        cache.set(SYS_CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    except Exception as m:
+        logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
+
+
 # 修改系统配置
 @superuser_required
 def change_config(request):
     configs = request.POST.get('configs')
+    # 定时任务的间隔、天数需为非负整数，校验不通过不保存
+    error = check_schedule_configs(configs)
+    if error:
+        return HttpResponse(json.dumps({'status': 1, 'msg': error, 'data': []}), content_type='application/json')
     archer_config = SysConfig()
     result = archer_config.replace(configs)
+    # 根据配置添加或删除定时任务
+    if result['status'] == 0:
+        add_config_schedules(archer_config)
     # 返回结果
     return HttpResponse(json.dumps(result), content_type='application/json')
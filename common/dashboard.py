@@ -1,7 +1,16 @@
 # -*- coding: UTF-8 -*-
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
 from django.shortcuts import render
 
+from common.config import SysConfig
 from sql.models import SqlWorkflow, QueryPrivilegesApply, Users, Instance
 
 from common.utils.chart_dao import ChartDao
@@ -13,141 +22,228 @@ from pyecharts.charts import Pie, Bar, Line
 
 CurrentConfig.ONLINE_HOST = '/static/echarts/'
 
+logger = logging.getLogger('default')
+
+# 图表缓存时间，单位秒
+CHART_CACHE_TTL = 600
+MAX_WORKERS = 5
+
 
 @permission_required('sql.menu_dashboard', raise_exception=True)
 def pyecharts(request):
-    """dashboard view"""
-    # 工单数量统计
-    chart_dao = ChartDao()
-    data = chart_dao.workflow_by_date(30)
+    """dashboard view，图表由页面通过chart接口分别加载"""
+    # 获取统计数据
+    dashboard_count_stats = {
+        "sql_wf_cnt": SqlWorkflow.objects.count(),
+        "query_wf_cnt": QueryPrivilegesApply.objects.count(),
+        "user_cnt": Users.objects.count(),
+        "ins_cnt": Instance.objects.count()
+    }
+
+    return render(request, "dashboard.html", {"charts": CHARTS, "count_stats": dashboard_count_stats})
+
+
+@permission_required('sql.menu_dashboard', raise_exception=True)
+def chart(request):
+    """获取图表，name为逗号分隔的图表名称，days为统计天数，未传递时使用图表默认值"""
+    names = [name for name in request.GET.get('name', '').split(',') if name]
+    days = request.GET.get('days')
+    if not names or any(name not in CHARTS for name in names):
+        result = {'status': 1, 'msg': '图表不存在', 'data': {}}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    try:
+        days = int(days) if days else None
+        if days is not None and not 0 < days <= 365:
+            raise ValueError
+    except ValueError:
+        result = {'status': 1, 'msg': '统计天数需在1-365之间', 'data': {}}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    result = {'status': 0, 'msg': 'ok', 'data': get_charts(names, days)}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+def get_charts(names, days=None, refresh=False):
+    """
+    获取图表HTML，优先读取缓存，未命中的图表在线程池内并发生成
+    :param names: 图表名称列表
+    :param days: 统计天数，为None时使用各图表的默认天数
+    :param refresh: 忽略缓存重新生成，用于缓存预热
+    :return: {图表名称: HTML}
+    """
+    keys = {name: _cache_key(name, days or CHARTS[name]['days']) for name in names}
+    charts = {}
+    if not refresh:
+        try:
+            cached = cache.get_many(list(keys.values()))
+        except Exception as m:
+            cached = {}
+            logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        charts = {name: cached[key] for name, key in keys.items() if key in cached}
+    missing = [name for name in names if name not in charts]
+    if len(missing) == 1:
+        charts[missing[0]] = _render(missing[0], days)
+    elif missing:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for name, html in zip(missing, executor.map(lambda name: _render_in_thread(name, days), missing)):
+                charts[name] = html
+    if missing:
+        try:
+            cache.set_many({keys[name]: charts[name] for name in missing}, timeout=chart_cache_ttl())
+        except Exception as m:
+            logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    return charts
+
+
+def warm_charts():
+    """按默认统计天数重新生成全部图表，供定时任务调用"""
+    if int(SysConfig().get('dashboard_warm_interval', 0) or 0) <= 0:
+        return
+    get_charts(list(CHARTS), refresh=True)
+
+
+def chart_cache_ttl():
+    """图表缓存时间，开启缓存预热时保留到下次预热之后"""
+    interval = int(SysConfig().get('dashboard_warm_interval', 0) or 0)
+    return max(interval * 3, CHART_CACHE_TTL) if interval > 0 else CHART_CACHE_TTL
+
+
+def _render(name, days=None):
+    chart_def = CHARTS[name]
+    return chart_def['build'](days or chart_def['days']).render_embed()
+
+
+def _render_in_thread(name, days):
+    try:
+        return _render(name, days)
+    finally:
+        # 关闭线程内的数据库连接
+        connection.close()
+
+
+def _cache_key(name, days):
+    return f'dashboard_chart:{name}:{days}'
+
+
+def _date_list(days):
     today = date.today()
-    one_month_before = today - relativedelta(days=+30)
-    attr = chart_dao.get_date_list(one_month_before, today)
+    return ChartDao.get_date_list(today - relativedelta(days=+days), today)
+
+
+def _pie(attr, value, label_position=None):
+    pie = Pie(init_opts=opts.InitOpts(width='600', height='380px'))
+    pie.set_global_opts(title_opts=opts.TitleOpts(title=''),
+                        legend_opts=opts.LegendOpts(
+                            orient="vertical", pos_top="15%", pos_left="2%", is_show=False
+                        ))
+    if label_position:
+        pie.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}", position=label_position))
+    else:
+        pie.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
+    pie.add("", [list(z) for z in zip(attr, value)])
+    return pie
+
+
+def _bar(attr, value):
+    bar = Bar(init_opts=opts.InitOpts(width='600', height='380px'))
+    bar.add_xaxis(attr)
+    bar.add_yaxis("", value)
+    return bar
+
+
+def workflow_by_date(days):
+    """工单数量统计"""
+    data = ChartDao().workflow_by_date(days)
+    attr = _date_list(days)
     _dict = {}
     for row in data['rows']:
         _dict[row[0]] = row[1]
     value = [_dict.get(day) if _dict.get(day) else 0 for day in attr]
-    bar1 = Bar(init_opts=opts.InitOpts(width='600', height='380px'))
-    bar1.add_xaxis(attr)
-    bar1.add_yaxis("", value)
+    return _bar(attr, value)
 
-    # 工单按组统计
-    data = chart_dao.workflow_by_group(30)
-    attr = [row[0] for row in data['rows']]
-    value = [row[1] for row in data['rows']]
-    pie1 = Pie(init_opts=opts.InitOpts(width='600', height='380px'))
-    pie1.set_global_opts(title_opts=opts.TitleOpts(title=''),
-                         legend_opts=opts.LegendOpts(
-                             orient="vertical", pos_top="15%", pos_left="2%", is_show=False
-                         ))
-    pie1.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
-    pie1.add("", [list(z) for z in zip(attr, value)])
-
-    # 工单按人统计
-    data = chart_dao.workflow_by_user(30)
+
+def workflow_by_group(days):
+    """工单按组统计"""
+    data = ChartDao().workflow_by_group(days)
     attr = [row[0] for row in data['rows']]
     value = [row[1] for row in data['rows']]
-    bar2 = Bar(init_opts=opts.InitOpts(width='600', height='380px'))
-    bar2.add_xaxis(attr)
-    bar2.add_yaxis("", value)
+    return _pie(attr, value)
+
 
-    # SQL语句类型统计
-    data = chart_dao.syntax_type()
+def workflow_by_user(days):
+    """工单按人统计"""
+    data = ChartDao().workflow_by_user(days)
     attr = [row[0] for row in data['rows']]
     value = [row[1] for row in data['rows']]
-    pie2 = Pie()
-    pie2.set_global_opts(title_opts=opts.TitleOpts(title='SQL上线工单统计(类型)'),
-                         legend_opts=opts.LegendOpts(
-                             orient="vertical", pos_top="15%", pos_left="2%"
-                         ))
-    pie2.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
-    pie2.add("", [list(z) for z in zip(attr, value)])
-
-    # SQL查询统计(每日检索行数)
-    attr = chart_dao.get_date_list(one_month_before, today)
-    effect_data = chart_dao.querylog_effect_row_by_date(30)
+    return _bar(attr, value)
+
+
+def querylog_by_date(days):
+    """SQL查询统计(每日检索行数、检索次数)"""
+    chart_dao = ChartDao()
+    attr = _date_list(days)
+    effect_data = chart_dao.querylog_effect_row_by_date(days)
     effect_dict = {}
     for row in effect_data['rows']:
         effect_dict[row[0]] = int(row[1])
     effect_value = [effect_dict.get(day) if effect_dict.get(day) else 0 for day in attr]
-    count_data = chart_dao.querylog_count_by_date(30)
+    count_data = chart_dao.querylog_count_by_date(days)
     count_dict = {}
     for row in count_data['rows']:
         count_dict[row[0]] = int(row[1])
     count_value = [count_dict.get(day) if count_dict.get(day) else 0 for day in attr]
-    line1 = Line(init_opts=opts.InitOpts(width='600', height='380px'))
-    line1.set_global_opts(title_opts=opts.TitleOpts(title=''),
-                          legend_opts=opts.LegendOpts(selected_mode='single'))
-    line1.add_xaxis(attr)
-    line1.add_yaxis("检索行数", effect_value, is_smooth=True,
-                    markpoint_opts=opts.MarkPointOpts(data=[opts.MarkPointItem(type_="average")]))
-    line1.add_yaxis("检索次数", count_value, is_smooth=True,
-                    markline_opts=opts.MarkLineOpts(data=[opts.MarkLineItem(type_="max"),
-                                                          opts.MarkLineItem(type_="average")]))
-
-    # SQL查询统计(用户检索行数)
-    data = chart_dao.querylog_effect_row_by_user(30)
+    line = Line(init_opts=opts.InitOpts(width='600', height='380px'))
+    line.set_global_opts(title_opts=opts.TitleOpts(title=''),
+                         legend_opts=opts.LegendOpts(selected_mode='single'))
+    line.add_xaxis(attr)
+    line.add_yaxis("检索行数", effect_value, is_smooth=True,
+                   markpoint_opts=opts.MarkPointOpts(data=[opts.MarkPointItem(type_="average")]))
+    line.add_yaxis("检索次数", count_value, is_smooth=True,
+                   markline_opts=opts.MarkLineOpts(data=[opts.MarkLineItem(type_="max"),
+                                                         opts.MarkLineItem(type_="average")]))
+    return line
+
+
+def querylog_effect_row_by_user(days):
+    """SQL查询统计(用户检索行数)"""
+    data = ChartDao().querylog_effect_row_by_user(days)
     attr = [row[0] for row in data['rows']]
     value = [int(row[1]) for row in data['rows']]
-    pie4 = Pie(init_opts=opts.InitOpts(width='600', height='380px'))
-    pie4.set_global_opts(title_opts=opts.TitleOpts(title=''),
-                         legend_opts=opts.LegendOpts(
-                             orient="vertical", pos_top="15%", pos_left="2%", is_show=False
-                         ))
-    pie4.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
-    pie4.add("", [list(z) for z in zip(attr, value)])
-
-    # SQL查询统计(DB检索行数)
-    data = chart_dao.querylog_effect_row_by_db(30)
+    return _pie(attr, value)
+
+
+def querylog_effect_row_by_db(days):
+    """SQL查询统计(DB检索行数)"""
+    data = ChartDao().querylog_effect_row_by_db(days)
     attr = [row[0] for row in data['rows']]
     value = [int(row[1]) for row in data['rows']]
-    pie5 = Pie(init_opts=opts.InitOpts(width='600', height='380px'))
-    pie5.set_global_opts(title_opts=opts.TitleOpts(title=''),
-                         legend_opts=opts.LegendOpts(
-                             orient="vertical", pos_top="15%", pos_left="2%", is_show=False
-                         ))
-    pie5.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}", position="left"))
-    pie5.add("", [list(z) for z in zip(attr, value)])
-
-    # 慢查询db/user维度统计(最近1天)
-    data = chart_dao.slow_query_count_by_db_by_user(1)
+    return _pie(attr, value, label_position="left")
+
+
+def slow_query_count_by_db_by_user(days):
+    """慢查询db/user维度统计"""
+    data = ChartDao().slow_query_count_by_db_by_user(days)
     attr = [row[0] for row in data['rows']]
     value = [int(row[1]) for row in data['rows']]
-    pie3 = Pie(init_opts=opts.InitOpts(width='600',height='380px'))
-    pie3.set_global_opts(title_opts=opts.TitleOpts(title=''),
-                         legend_opts=opts.LegendOpts(
-                             orient="vertical", pos_top="15%", pos_left="2%", is_show=False
-                         ))
-    pie3.set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}", position="left"))
-    pie3.add("", [list(z) for z in zip(attr, value)])
-
-    # 慢查询db维度统计(最近1天)
-    data = chart_dao.slow_query_count_by_db(1)
-    attr = [row[0] for row in data['rows']]
-    value = [row[1] for row in data['rows']]
-    bar3 = Bar(init_opts=opts.InitOpts(width='600', height='380px'))
-    bar3.add_xaxis(attr)
-    bar3.add_yaxis("", value)
-
-    # 可视化展示页面
-    chart = {
-        "bar1": bar1.render_embed(),
-        "pie1": pie1.render_embed(),
-        "bar2": bar2.render_embed(),
-        "bar3": bar3.render_embed(),
-        "pie2": pie2.render_embed(),
-        "line1": line1.render_embed(),
-        "pie3": pie3.render_embed(),
-        "pie4": pie4.render_embed(),
-        "pie5": pie5.render_embed(),
-    }
+    return _pie(attr, value, label_position="left")
 
-    # 获取统计数据
-    dashboard_count_stats = {
-        "sql_wf_cnt": SqlWorkflow.objects.count(),
-        "query_wf_cnt": QueryPrivilegesApply.objects.count(),
-        "user_cnt": Users.objects.count(),
-        "ins_cnt": Instance.objects.count()
-    }
 
-    return render(request, "dashboard.html", {"chart": chart, "count_stats": dashboard_count_stats})
+def slow_query_count_by_db(days):
+    """慢查询db维度统计"""
+    data = ChartDao().slow_query_count_by_db(days)
+    attr = [row[0] for row in data['rows']]
+    value = [row[1] for row in data['rows']]
+    return _bar(attr, value)
+
+
+# 图表名称：生成函数、默认统计天数、标题，页面按顺序分两列展示
+CHARTS = {
+    'bar3': {'build': slow_query_count_by_db, 'days': 1, 'title': '24h慢查询db维度统计', 'column': 'left'},
+    'line1': {'build': querylog_by_date, 'days': 30, 'title': 'SQL查询统计', 'column': 'left'},
+    'bar1': {'build': workflow_by_date, 'days': 30, 'title': 'SQL上线数量', 'column': 'left'},
+    'bar2': {'build': workflow_by_user, 'days': 30, 'title': 'SQL上线用户', 'column': 'left'},
+    'pie3': {'build': slow_query_count_by_db_by_user, 'days': 1, 'title': '24h慢查询db/user维度统计',
+             'column': 'right'},
+    'pie1': {'build': workflow_by_group, 'days': 30, 'title': 'SQL上线统计', 'column': 'right'},
+    'pie5': {'build': querylog_effect_row_by_db, 'days': 30, 'title': 'DB检索行数', 'column': 'right'},
+    'pie4': {'build': querylog_effect_row_by_user, 'days': 30, 'title': 'SQL查询用户', 'column': 'right'},
+}
@@ -2,15 +2,22 @@ import json
 import smtplib
 from unittest.mock import patch, ANY
 import datetime
+from decimal import Decimal
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Sum
 from django.test import Client, TestCase
 
+from common import config, dashboard
 from common.config import SysConfig
 from common.utils.sendmsg import MsgSender
 from sql.engines import EngineBase, ResultSet
-from sql.models import Instance, SqlWorkflow, SqlWorkflowContent, QueryLog, ResourceGroup
+from sql.models import Instance, SqlWorkflow, SqlWorkflowContent, QueryLog, ResourceGroup, Config, QueryLogRollup, \
+    RollupWatermark
 from common.utils.chart_dao import ChartDao
 from common.auth import init_user
+from common.utils import columnar_json, dashboard_rollup
 
 User = get_user_model()
 
@@ -42,6 +49,26 @@ class ConfigOpsTests(TestCase):
         }
         self.assertEqual(archer_config.sys_config, expected_config)
 
+    @patch('sql.utils.tasks.add_replication_lag_schedule')
+    def test_change_config_check_schedule(self, _add_schedule):
+        superuser = User.objects.create(username='super_config', is_superuser=True)
+        c = Client()
+        c.force_login(superuser)
+        archer_config = SysConfig()
+        archer_config.set('replication_lag_interval', '60')
+        # 非整数的间隔不保存
+        configs = json.dumps([{'key': 'replication_lag_interval', 'value': '1.5'}])
+        r = c.post('/config/change/', data={'configs': configs}).json()
+        self.assertEqual(r['status'], 1)
+        self.assertEqual(SysConfig().get('replication_lag_interval'), '60')
+        _add_schedule.assert_not_called()
+        configs = json.dumps([{'key': 'replication_lag_interval', 'value': '90'}])
+        r = c.post('/config/change/', data={'configs': configs}).json()
+        self.assertEqual(r['status'], 0)
+        _add_schedule.assert_called_once_with(90)
+        archer_config.purge()
+        superuser.delete()
+
     def test_get_bool_transform(self):
         bool_config = json.dumps([{'key': 'boolconfig2', 'value': 'false'}])
         archer_config = SysConfig()
@@ -65,6 +92,27 @@ class ConfigOpsTests(TestCase):
         self.assertEqual(archer_config.sys_config['other_config'], 'testvalue3')
 
 
+    def test_process_snapshot(self):
+        archer_config = SysConfig()
+        archer_config.set('snapshot_config', 'value1')
+        # 版本号校验间隔内直接使用进程内配置，不读取Redis
+        with patch('common.config.cache') as _cache:
+            self.assertEqual(SysConfig().get('snapshot_config'), 'value1')
+            _cache.get.assert_not_called()
+        # 模拟其他进程修改配置
+        Config.objects.filter(item='snapshot_config').update(value='value2')
+        cache.delete('sys_config')
+        version, sys_config, _ = config._snapshot
+        config._snapshot = (version, sys_config, 0)
+        self.assertEqual(SysConfig().get('snapshot_config'), 'value1')
+        config._snapshot = (version, sys_config, 0)
+        cache.set(config.SYS_CONFIG_VERSION_KEY, 'new_version', timeout=None)
+        self.assertEqual(SysConfig().get('snapshot_config'), 'value2')
+        # 修改返回的配置不影响进程内配置
+        SysConfig().sys_config['snapshot_config'] = 'value3'
+        self.assertEqual(SysConfig().get('snapshot_config'), 'value2')
+        archer_config.purge()
+
 class SendMessageTest(TestCase):
     """发送消息测试"""
 
@@ -464,6 +512,74 @@ class ChartTest(TestCase):
         expected_rows = ((self.u2.display, 3), (self.u1.display, 2))
         self.assertEqual(result['rows'], expected_rows)
 
+    def testQueryLogRollup(self):
+        """查询日志汇总后统计结果不变，汇总之后的新记录同样统计"""
+        query_logs = [QueryLog(instance_name=self.slave1.instance_name, db_name=f'db{i % 2}', sqllog='select 1',
+                               effect_row=i, username=self.u1.username, user_display=self.u1.display)
+                      for i in range(10)]
+        QueryLog.objects.bulk_create(query_logs)
+        QueryLog.objects.update(create_time=self.now - datetime.timedelta(days=1))
+        dao = ChartDao()
+        expected = {
+            'effect_row_by_date': dao.querylog_effect_row_by_date(30)['rows'],
+            'count_by_date': dao.querylog_count_by_date(30)['rows'],
+            'effect_row_by_user': dao.querylog_effect_row_by_user(30)['rows'],
+            'effect_row_by_db': dao.querylog_effect_row_by_db(30)['rows'],
+        }
+        archer_config = SysConfig()
+        archer_config.set('dashboard_rollup_interval', '300')
+        try:
+            dashboard_rollup.rollup()
+            self.assertEqual(QueryLogRollup.objects.aggregate(Sum('query_count'))['query_count__sum'], 10)
+            # 重复执行不重复累加
+            dashboard_rollup.rollup()
+            self.assertEqual(QueryLogRollup.objects.aggregate(Sum('effect_row'))['effect_row__sum'], 45)
+            self.assertEqual(dao.querylog_effect_row_by_date(30)['rows'], expected['effect_row_by_date'])
+            self.assertEqual(dao.querylog_count_by_date(30)['rows'], expected['count_by_date'])
+            self.assertEqual(dao.querylog_effect_row_by_user(30)['rows'], expected['effect_row_by_user'])
+            self.assertEqual(dao.querylog_effect_row_by_db(30)['rows'], expected['effect_row_by_db'])
+            # 尚未汇总的新记录
+            QueryLog.objects.create(instance_name=self.slave1.instance_name, db_name='db0', sqllog='select 1',
+                                    effect_row=100, username=self.u1.username, user_display=self.u1.display)
+            rows = dict(dao.querylog_effect_row_by_db(30)['rows'])
+            self.assertEqual(rows['db0'], 120)
+        finally:
+            archer_config.purge()
+            QueryLog.objects.all().delete()
+            QueryLogRollup.objects.all().delete()
+            RollupWatermark.objects.all().delete()
+
+    def testDashboardChart(self):
+        """图表接口，未命中缓存时生成，之后读取缓存"""
+        c = Client()
+        c.force_login(self.superuser1)
+        cache.delete_many([dashboard._cache_key(name, chart['days']) for name, chart in dashboard.CHARTS.items()])
+        r = c.get('/dashboard/chart/', data={'name': 'bar1,pie1'})
+        result = json.loads(r.content)
+        self.assertEqual(result['status'], 0)
+        self.assertEqual(set(result['data']), {'bar1', 'pie1'})
+        with patch('common.dashboard._render') as _render:
+            r = c.get('/dashboard/chart/', data={'name': 'bar1'})
+            _render.assert_not_called()
+        self.assertEqual(json.loads(r.content)['data']['bar1'], result['data']['bar1'])
+        r = c.get('/dashboard/chart/', data={'name': 'not_exists'})
+        self.assertEqual(json.loads(r.content)['status'], 1)
+        r = c.get('/dashboard/chart/', data={'name': 'bar1', 'days': 0})
+        self.assertEqual(json.loads(r.content)['status'], 1)
+
+    @patch('common.dashboard.get_charts')
+    def testWarmCharts(self, _get_charts):
+        """缓存预热"""
+        dashboard.warm_charts()
+        _get_charts.assert_not_called()
+        archer_config = SysConfig()
+        archer_config.set('dashboard_warm_interval', '300')
+        try:
+            dashboard.warm_charts()
+            _get_charts.assert_called_once_with(list(dashboard.CHARTS), refresh=True)
+        finally:
+            archer_config.purge()
+
     def testDashboard(self):
         """Dashboard测试"""
         # TODO 这部分测试并没有遵循单元测试, 而是某种集成测试, 直接从响应到结果, 并且只检查状态码
@@ -497,3 +613,49 @@ class AuthTest(TestCase):
         # init 需要是无状态的, 可以重复执行, 执行一次和执行n次结果一样
         init_user(self.u1)
         self.assertEqual(self.u1, self.resource_group1.users_set.get(pk=self.u1.pk))
+
+
+class ColumnarJsonTest(TestCase):
+    def test_dumps(self):
+        rows = [(1, datetime.datetime(2020, 1, 1, 1, 2, 3), Decimal('1.5'), b'x', None),
+                (2 ** 60, None, Decimal('2'), b'\xff', 's')]
+        result = {'status': 0, 'data': {'column_list': ['a', 'b', 'c', 'd', 'e'], 'rows': rows}}
+        data = json.loads(columnar_json.dumps(result))['data']
+        self.assertNotIn('rows', data)
+        self.assertEqual(data['column_types'], ['integer', 'datetime', 'decimal', 'binary', 'string'])
+        self.assertEqual(data['columns'], [[1, '1152921504606846976'], ['2020-01-01 01:02:03', None],
+                                           ['1.5', '2'], ['x', 'ÿ'], [None, 's']])
+        # 不修改原结果
+        self.assertEqual(result['data']['rows'], rows)
+
+    def test_dumps_mixed_and_empty(self):
+        result = {'data': {'column_list': ['a'], 'rows': [(1,), ('a',), (datetime.date(2020, 1, 1),)]}}
+        data = json.loads(columnar_json.dumps(result))['data']
+        self.assertEqual(data['column_types'], ['mixed'])
+        self.assertEqual(data['columns'], [[1, 'a', '2020-01-01']])
+        data = json.loads(columnar_json.dumps({'data': {'column_list': ['a', 'b'], 'rows': []}}))['data']
+        self.assertEqual(data['columns'], [[], []])
+        self.assertEqual(data['column_types'], ['null', 'null'])
+
+    def test_dumps_decimal_and_nested(self):
+        """Decimal转为字符串保留精度，list、dict单元格内的值递归转换"""
+        rows = [(Decimal('12345678901234567890.123456789'), [1, 'a', datetime.datetime(2020, 1, 1)],
+                 {'k': Decimal('1.10')}, 1),
+                (Decimal('0.10'), [], {}, None)]
+        result = {'status': 0, 'data': {'column_list': ['a', 'b', 'c', 'd'], 'rows': rows}}
+        data = json.loads(columnar_json.dumps(result))['data']
+        self.assertEqual(data['column_types'], ['decimal', 'json', 'json', 'integer'])
+        self.assertEqual(data['columns'], [['12345678901234567890.123456789', '0.10'],
+                                           [[1, 'a', '2020-01-01 00:00:00'], []],
+                                           [{'k': '1.10'}, {}], [1, None]])
+
+    def test_dumps_without_orjson(self):
+        """未安装orjson时结果一致"""
+        result = {'status': 0, 'data': {'column_list': ['a', 'b'],
+                                        'rows': [(Decimal('1.5'), {'k': datetime.date(2020, 1, 1)})]}}
+        payload = columnar_json.dumps(result)
+        with patch.object(columnar_json, 'orjson', None):
+            fallback = columnar_json.dumps(result)
+        self.assertIsInstance(fallback, str)
+        self.assertEqual(json.loads(fallback), json.loads(payload))
+        self.assertEqual(json.loads(fallback)['data']['columns'], [['1.5'], [{'k': '2020-01-01'}]])
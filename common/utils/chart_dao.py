@@ -3,6 +3,8 @@
 from datetime import timedelta
 from django.db import connection
 
+from common.utils import dashboard_rollup
+
 
 class ChartDao(object):
     # 直接在Archery数据库查询数据，用于报表
@@ -21,6 +23,64 @@ class ChartDao(object):
             'rows': rows
         }
 
+    def __querylog_rollup(self, dimension, value, cycle, limit=None):
+        """
+        从汇总表统计查询日志，加上尚未汇总的新记录
+        :param dimension: 统计维度，date、user_display、db_name
+        :param value: 统计值，query_count、effect_row
+        """
+        rollup_dimension = "date_format(stat_date, '%Y-%m-%d')" if dimension == 'date' else dimension
+        detail_dimension = "date_format(create_time, '%Y-%m-%d')" if dimension == 'date' else dimension
+        detail_value = 'count(*)' if value == 'query_count' else 'sum(effect_row)'
+        sql = f'''
+        select dimension, sum(value)
+        from (
+          select {rollup_dimension} as dimension, sum({value}) as value
+          from query_log_rollup
+          where stat_date >= date(date_add(now(), interval -{cycle} day))
+          group by 1
+          union all
+          select {detail_dimension}, {detail_value}
+          from query_log
+          where id > (select ifnull(max(last_id), 0) from rollup_watermark where name = 'query_log')
+            and create_time >= date(date_add(now(), interval -{cycle} day))
+          group by 1
+        ) t
+        group by dimension
+        order by sum(value) desc
+        {f'limit {limit}' if limit else ''};'''
+        return self.__query(sql)
+
+    def __slow_query_rollup(self, dimension, cycle):
+        """
+        从汇总表统计慢日志，加上尚未汇总的新记录
+        :param dimension: 统计维度，db、db_user
+        """
+        if dimension == 'db':
+            rollup_dimension, detail_dimension = 'db_max', "ifnull(db_max, '')"
+        else:
+            rollup_dimension = "concat(db_max, ' user: ', user_max)"
+            detail_dimension = "concat(ifnull(db_max, ''), ' user: ', user_max)"
+        sql = f'''
+        select dimension, sum(value)
+        from (
+          select {rollup_dimension} as dimension, sum(ts_cnt) as value
+          from mysql_slow_query_rollup
+          where stat_hour >= date_format(date_sub(now(), interval {cycle} day), '%Y-%m-%d %H:00:00')
+          group by 1
+          union all
+          select {detail_dimension}, sum(ts_cnt)
+          from mysql_slow_query_review_history
+          where id > (select ifnull(max(last_id), 0) from rollup_watermark
+                      where name = 'mysql_slow_query_review_history')
+            and ts_min >= date_format(date_sub(now(), interval {cycle} day), '%Y-%m-%d %H:00:00')
+          group by 1
+        ) t
+        group by dimension
+        order by sum(value) desc
+        limit 50;'''
+        return self.__query(sql)
+
     # 获取连续时间
     @staticmethod
     def get_date_list(begin_date, end_date):
@@ -85,6 +145,8 @@ class ChartDao(object):
 
     # SQL查询统计(每日检索行数)
     def querylog_effect_row_by_date(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__querylog_rollup('date', 'effect_row', cycle)
         sql = '''
         select
           date_format(create_time, '%Y-%m-%d'),
@@ -97,6 +159,8 @@ class ChartDao(object):
 
     # SQL查询统计(每日检索次数)
     def querylog_count_by_date(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__querylog_rollup('date', 'query_count', cycle)
         sql = '''
         select
           date_format(create_time, '%Y-%m-%d'),
@@ -109,6 +173,8 @@ class ChartDao(object):
 
     # SQL查询统计(用户检索行数)
     def querylog_effect_row_by_user(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__querylog_rollup('user_display', 'effect_row', cycle, limit=10)
         sql = '''
         select 
           user_display,
@@ -122,6 +188,8 @@ class ChartDao(object):
 
     # SQL查询统计(DB检索行数)
     def querylog_effect_row_by_db(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__querylog_rollup('db_name', 'effect_row', cycle, limit=10)
         sql = '''
        select
           db_name,
@@ -151,6 +219,8 @@ group by date(date_add(ts_min, interval 8 HOUR));"""
 
     # 慢日志db/user维度统计
     def slow_query_count_by_db_by_user(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__slow_query_rollup('db_user', cycle)
         sql = '''
         select
             concat(db_max,' user: ' ,user_max),
@@ -163,6 +233,8 @@ group by date(date_add(ts_min, interval 8 HOUR));"""
 
     # 慢日志db维度统计
     def slow_query_count_by_db(self, cycle):
+        if dashboard_rollup.enabled():
+            return self.__slow_query_rollup('db', cycle)
         sql = '''
         select
             db_max,
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+按列序列化查询结果，用于大结果集的快速返回
+结果集转置为按列的数组，每列根据实际包含的类型预先确定转换函数，仅对需要转换的列逐个转换，
+转换后的数据只包含JSON原生类型，序列化时不再逐个单元格调用default，优先使用orjson（未安装时使用simplejson的C扩展）；
+Decimal转为字符串以保留精度，list、dict单元格内的值递归转换，客户端可根据column_types还原
+返回格式：{"column_list": [], "column_types": [], "columns": [[第一列的值], [第二列的值]]}，rows不再返回
+仅供API调用（/query/的format=columns），前端页面仍使用行格式
+"""
+from datetime import datetime, date, timedelta, time
+from decimal import Decimal
+
+import simplejson
+
+from common.utils.extend_json_encoder import ExtendJSONEncoderFTime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 超过该值的整数转为字符串，与bigint_as_string=True保持一致
+MAX_SAFE_INTEGER = 2 ** 53
+NATIVE_TYPES = {str, float, bool, type(None)}
+
+
+def _bytes(value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin1')
+
+
+def _int(value):
+    return str(value) if abs(value) >= MAX_SAFE_INTEGER else value
+
+
+def _nested(value):
+    """list、dict单元格递归转换其中的值"""
+    if isinstance(value, dict):
+        return {key: _nested(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_nested(item) for item in value]
+    return _convert_value(value)
+
+
+CONVERTERS = {
+    datetime: lambda value: value.isoformat(' '),
+    date: lambda value: value.strftime('%Y-%m-%d'),
+    time: str,
+    timedelta: str,
+    bytes: _bytes,
+    bytearray: _bytes,
+    int: _int,
+    Decimal: str,
+    list: _nested,
+    dict: _nested,
+    tuple: _nested,
+}
+
+TYPE_TAGS = {
+    str: 'string',
+    int: 'integer',
+    float: 'float',
+    bool: 'bool',
+    datetime: 'datetime',
+    date: 'date',
+    time: 'time',
+    timedelta: 'time',
+    Decimal: 'decimal',
+    bytes: 'binary',
+    bytearray: 'binary',
+    list: 'json',
+    dict: 'json',
+    tuple: 'json',
+}
+
+
+def column_type(types):
+    """列的类型标识，null表示全部为空，mixed表示包含多种类型"""
+    types = types - {type(None)}
+    if not types:
+        return 'null'
+    if len(types) > 1:
+        return 'mixed'
+    return TYPE_TAGS.get(types.pop(), 'string')
+
+
+def convert_column(values, types=None):
+    """转换一列的值，返回(类型标识, 转换后的列表)"""
+    types = types or set(map(type, values))
+    tag = column_type(types)
+    if types <= NATIVE_TYPES:
+        return tag, list(values)
+    # int仅在存在超过安全范围的值时才需要转换
+    if types <= NATIVE_TYPES | {int} and all(
+            abs(v) < MAX_SAFE_INTEGER for v in values if type(v) is int):
+        return tag, list(values)
+    if len(types - {type(None)}) == 1:
+        converter = CONVERTERS.get(next(iter(types - {type(None)})), str)
+        return tag, [None if value is None else converter(value) for value in values]
+    return tag, [_convert_value(value) for value in values]
+
+
+def _convert_value(value):
+    value_type = type(value)
+    if value_type in NATIVE_TYPES:
+        return value
+    return CONVERTERS.get(value_type, str)(value)
+
+
+def columnar(data):
+    """将结果集字典（ResultSet.as_dict()）中的rows转换为按列的数组"""
+    data = dict(data)
+    rows = data.pop('rows', None) or []
+    column_count = len(data.get('column_list') or []) or (len(rows[0]) if rows else 0)
+    columns = list(zip(*rows)) if rows else [()] * column_count
+    column_types, converted = [], []
+    for values in columns:
+        tag, values = convert_column(values)
+        column_types.append(tag)
+        converted.append(values)
+    data['column_types'] = column_types
+    data['columns'] = converted
+    return data
+
+
+def dumps(result):
+    """序列化返回结果，result['data']中包含rows时转换为按列的格式"""
+    if isinstance(result.get('data'), dict) and 'rows' in result['data']:
+        result = dict(result, data=columnar(result['data']))
+    if orjson is not None:
+        try:
+            return orjson.dumps(result, default=_convert_value, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            # 结果集以外的字段包含orjson不支持的类型
+            pass
+    return simplejson.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True)
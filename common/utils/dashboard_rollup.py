@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+"""
+dashboard汇总，由django-q定时任务将query_log、mysql_slow_query_review_history增量汇总到汇总表，
+每次只处理上次汇总进度（明细表ID）之后的新记录，ChartDao读取汇总表和尚未汇总的少量新记录
+汇总间隔通过系统配置dashboard_rollup_interval设置，单位秒，为0或未配置时不汇总，dashboard直接统计明细表
+"""
+import logging
+
+from django.db import connection, transaction
+
+from common.config import SysConfig
+from sql.models import RollupWatermark
+
+logger = logging.getLogger('default')
+
+# 每批汇总的明细记录数
+BATCH_SIZE = 10000
+# 只汇总写入超过该时间的查询日志，避免遗漏提交较晚、ID较小的记录，单位秒
+QUERY_LOG_DELAY = 60
+
+QUERY_LOG_ROLLUP_SQL = '''
+insert into query_log_rollup (stat_date, user_display, db_name, query_count, effect_row)
+select date(create_time), user_display, db_name, count(*), sum(effect_row)
+from query_log
+where id > %s and id <= %s
+group by date(create_time), user_display, db_name
+on duplicate key update query_count = query_count + values(query_count),
+  effect_row = effect_row + values(effect_row);'''
+
+SLOW_QUERY_ROLLUP_SQL = '''
+insert into mysql_slow_query_rollup (stat_hour, db_max, user_max, ts_cnt)
+select date_format(ts_min, '%%Y-%%m-%%d %%H:00:00'), ifnull(db_max, ''), user_max, ifnull(sum(ts_cnt), 0)
+from mysql_slow_query_review_history
+where id > %s and id <= %s
+group by date_format(ts_min, '%%Y-%%m-%%d %%H:00:00'), ifnull(db_max, ''), user_max
+on duplicate key update ts_cnt = ts_cnt + values(ts_cnt);'''
+
+
+def enabled():
+    """是否开启汇总，ChartDao据此决定读取汇总表还是明细表"""
+    return int(SysConfig().get('dashboard_rollup_interval', 0) or 0) > 0
+
+
+def rollup():
+    """增量汇总，供定时任务调用"""
+    if not enabled():
+        return
+    _rollup('query_log', QUERY_LOG_ROLLUP_SQL,
+            f'create_time < date_sub(now(), interval {QUERY_LOG_DELAY} second)')
+    _rollup('mysql_slow_query_review_history', SLOW_QUERY_ROLLUP_SQL)
+
+
+def _rollup(table, rollup_sql, condition='1=1'):
+    """
+    按ID分批汇总明细表，每批汇总和更新进度在同一个事务内，中断后重新执行不会重复累加；
+    汇总进度行加锁，多个任务同时执行时依次处理
+    """
+    while True:
+        with transaction.atomic():
+            watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=table)
+            with connection.cursor() as cursor:
+                cursor.execute(f'''select max(id) from (
+                    select id from {table} where id > %s and {condition} order by id limit %s) t;''',
+                               [watermark.last_id, BATCH_SIZE])
+                last_id = cursor.fetchone()[0]
+                if last_id is None:
+                    break
+                cursor.execute(rollup_sql, [watermark.last_id, last_id])
+            watermark.last_id = last_id
+            watermark.save()
+        logger.debug(f'{table}汇总至ID：{last_id}')
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class SqlConfig(AppConfig):
+    name = 'sql'
+
+    def ready(self):
+        # 注册信号处理
+        from sql.utils import data_masking  # noqa
+        from sql import query_privileges  # noqa
+        from sql.utils import resource_group  # noqa
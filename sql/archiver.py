@@ -10,6 +10,7 @@ import os
 import re
 import traceback
 import time
+from contextlib import ExitStack
 
 import simplejson as json
 from django.conf import settings
@@ -29,6 +30,7 @@ from sql.engines import get_engine
 from sql.notify import notify_for_audit
 from sql.plugins.pt_archiver import PtArchiver
 from sql.utils.resource_group import user_instances, user_groups
+from sql.utils.ssh_tunnel import TunnelAddress
 from sql.models import ArchiveConfig, ArchiveLog, Instance, ResourceGroup
 from sql.utils.workflow_audit import Audit
 
@@ -274,69 +276,73 @@ def archive(archive_id):
         s_charset = s_db.options['charset'].value
 
     pt_archiver = PtArchiver()
-    # 准备参数
-    source = fr"h={s_ins.host},u={s_ins.user},p={s_ins.password}," \
-        fr"P={s_ins.port},D={src_db_name},t={src_table_name},A={s_charset}"
-    args = {
-        "no-version-check": True,
-        "source": source,
-        "where": condition,
-        "progress": 5000,
-        "statistics": True,
-        "charset": 'utf8',
-        "limit": 10000,
-        "txn-size": 1000,
-        "sleep": sleep
-    }
-
-    # 归档到目标实例
-    if mode == 'dest':
-        d_ins = archive_info.dest_instance
-        dest_db_name = archive_info.dest_db_name
-        dest_table_name = archive_info.dest_table_name
-        # 目标表的字符集信息
-        d_engine = get_engine(d_ins)
-        d_db = d_engine.schema_object.databases[dest_db_name]
-        d_tb = d_db.tables[dest_table_name]
-        d_charset = d_tb.options['charset'].value
-        if d_charset is None:
-            d_charset = d_db.options['charset'].value
-        # dest
-        dest = fr"h={d_ins.host},u={d_ins.user},p={d_ins.password},P={d_ins.port}," \
-            fr"D={dest_db_name},t={dest_table_name},A={d_charset}"
-        args['dest'] = dest
-        if no_delete:
-            args['no-delete'] = True
-    elif mode == 'file':
-        output_directory = os.path.join(settings.BASE_DIR, 'downloads/archiver')
-        os.makedirs(output_directory, exist_ok=True)
-        args['file'] = f'{output_directory}/{s_ins.instance_name}-{src_db_name}-{src_table_name}.txt'
-        if no_delete:
-            args['no-delete'] = True
-    elif mode == 'purge':
-        args['purge'] = True
-
-    # 参数检查
-    args_check_result = pt_archiver.check_args(args)
-    if args_check_result['status'] == 1:
-        return JsonResponse(args_check_result)
-    # 参数转换
-    cmd_args = pt_archiver.generate_args2cmd(args, shell=True)
-    # 执行命令，获取结果
-    select_cnt = 0
-    insert_cnt = 0
-    delete_cnt = 0
-    with FuncTimer() as t:
-        p = pt_archiver.execute_cmd(cmd_args, shell=True)
-        stdout = ''
-        for line in iter(p.stdout.readline, ''):
-            if re.match(r'^SELECT\s(\d+)$', line, re.I):
-                select_cnt = re.findall(r'^SELECT\s(\d+)$', line)
-            elif re.match(r'^INSERT\s(\d+)$', line, re.I):
-                insert_cnt = re.findall(r'^INSERT\s(\d+)$', line)
-            elif re.match(r'^DELETE\s(\d+)$', line, re.I):
-                delete_cnt = re.findall(r'^DELETE\s(\d+)$', line)
-            stdout += f'{line}\n'
+    # 配置了隧道的实例使用进程内共享隧道的本地映射地址，命令执行结束后释放
+    with ExitStack() as tunnels:
+        s_host, s_port = tunnels.enter_context(TunnelAddress(s_ins))
+        # 准备参数
+        source = fr"h={s_host},u={s_ins.user},p={s_ins.password}," \
+            fr"P={s_port},D={src_db_name},t={src_table_name},A={s_charset}"
+        args = {
+            "no-version-check": True,
+            "source": source,
+            "where": condition,
+            "progress": 5000,
+            "statistics": True,
+            "charset": 'utf8',
+            "limit": 10000,
+            "txn-size": 1000,
+            "sleep": sleep
+        }
+
+        # 归档到目标实例
+        if mode == 'dest':
+            d_ins = archive_info.dest_instance
+            dest_db_name = archive_info.dest_db_name
+            dest_table_name = archive_info.dest_table_name
+            # 目标表的字符集信息
+            d_engine = get_engine(d_ins)
+            d_db = d_engine.schema_object.databases[dest_db_name]
+            d_tb = d_db.tables[dest_table_name]
+            d_charset = d_tb.options['charset'].value
+            if d_charset is None:
+                d_charset = d_db.options['charset'].value
+            # dest
+            d_host, d_port = tunnels.enter_context(TunnelAddress(d_ins))
+            dest = fr"h={d_host},u={d_ins.user},p={d_ins.password},P={d_port}," \
+                fr"D={dest_db_name},t={dest_table_name},A={d_charset}"
+            args['dest'] = dest
+            if no_delete:
+                args['no-delete'] = True
+        elif mode == 'file':
+            output_directory = os.path.join(settings.BASE_DIR, 'downloads/archiver')
+            os.makedirs(output_directory, exist_ok=True)
+            args['file'] = f'{output_directory}/{s_ins.instance_name}-{src_db_name}-{src_table_name}.txt'
+            if no_delete:
+                args['no-delete'] = True
+        elif mode == 'purge':
+            args['purge'] = True
+
+        # 参数检查
+        args_check_result = pt_archiver.check_args(args)
+        if args_check_result['status'] == 1:
+            return JsonResponse(args_check_result)
+        # 参数转换
+        cmd_args = pt_archiver.generate_args2cmd(args, shell=True)
+        # 执行命令，获取结果
+        select_cnt = 0
+        insert_cnt = 0
+        delete_cnt = 0
+        with FuncTimer() as t:
+            p = pt_archiver.execute_cmd(cmd_args, shell=True)
+            stdout = ''
+            for line in iter(p.stdout.readline, ''):
+                if re.match(r'^SELECT\s(\d+)$', line, re.I):
+                    select_cnt = re.findall(r'^SELECT\s(\d+)$', line)
+                elif re.match(r'^INSERT\s(\d+)$', line, re.I):
+                    insert_cnt = re.findall(r'^INSERT\s(\d+)$', line)
+                elif re.match(r'^DELETE\s(\d+)$', line, re.I):
+                    delete_cnt = re.findall(r'^DELETE\s(\d+)$', line)
+                stdout += f'{line}\n'
     statistics = stdout
     # 获取异常信息
     stderr = p.stderr.read()
@@ -15,6 +15,7 @@ from sql.engines import get_engine
 
 from sql.plugins.binglog2sql import Binlog2Sql
 from sql.notify import notify_for_binlog2sql
+from sql.utils.ssh_tunnel import TunnelAddress
 from .models import Instance
 
 logger = logging.getLogger('default')
@@ -107,64 +108,66 @@ def binlog2sql(request):
 
     # 提交给binlog2sql进行解析
     binlog2sql = Binlog2Sql()
-    # 准备参数
-    args = {"conn_options": fr"-h{instance.host} -u{instance.user} -p'{instance.password}' -P{instance.port} ",
-            "stop_never": False,
-            "no-primary-key": no_pk,
-            "flashback": flashback,
-            "back-interval": back_interval,
-            "start-file": start_file,
-            "start-position": start_pos,
-            "stop-file": end_file,
-            "stop-position": end_pos,
-            "start-datetime": start_time,
-            "stop-datetime": stop_time,
-            "databases": ' '.join(only_schemas),
-            "tables": ' '.join(only_tables),
-            "only-dml": only_dml,
-            "sql-type": ' '.join(sql_type),
-            "instance": instance
-            }
-
-    # 参数检查
-    args_check_result = binlog2sql.check_args(args)
-    if args_check_result['status'] == 1:
-        return HttpResponse(json.dumps(args_check_result), content_type='application/json')
-    # 参数转换
-    cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
-    # 执行命令
-    try:
-        p = binlog2sql.execute_cmd(cmd_args, shell=True)
-        # 读取前num行后结束
-        rows = []
-        n = 1
-        for line in iter(p.stdout.readline, ''):
-            if n <= num:
-                n = n + 1
-                row_info = {}
-                try:
-                    row_info['sql'] = line.split('; #')[0] + ";"
-                    row_info['binlog_info'] = line.split('; #')[1].rstrip('\"')
-                except IndexError:
-                    row_info['sql'] = line
-                    row_info['binlog_info'] = None
-                rows.append(row_info)
-            else:
-                break
-        if rows.__len__() == 0:
-            # 判断是否有异常
-            stderr = p.stderr.read()
-            if stderr:
-                result['status'] = 1
-                result['msg'] = stderr
-                return HttpResponse(json.dumps(result), content_type='application/json')
-        # 终止子进程
-        p.kill()
-        result['data'] = rows
-    except Exception as e:
-        logger.error(traceback.format_exc())
-        result['status'] = 1
-        result['msg'] = str(e)
+    # 配置了隧道的实例使用进程内共享隧道的本地映射地址，解析结束后释放
+    with TunnelAddress(instance) as (host, port):
+        # 准备参数
+        args = {"conn_options": fr"-h{host} -u{instance.user} -p'{instance.password}' -P{port} ",
+                "stop_never": False,
+                "no-primary-key": no_pk,
+                "flashback": flashback,
+                "back-interval": back_interval,
+                "start-file": start_file,
+                "start-position": start_pos,
+                "stop-file": end_file,
+                "stop-position": end_pos,
+                "start-datetime": start_time,
+                "stop-datetime": stop_time,
+                "databases": ' '.join(only_schemas),
+                "tables": ' '.join(only_tables),
+                "only-dml": only_dml,
+                "sql-type": ' '.join(sql_type),
+                "instance": instance
+                }
+
+        # 参数检查
+        args_check_result = binlog2sql.check_args(args)
+        if args_check_result['status'] == 1:
+            return HttpResponse(json.dumps(args_check_result), content_type='application/json')
+        # 参数转换
+        cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
+        # 执行命令
+        try:
+            p = binlog2sql.execute_cmd(cmd_args, shell=True)
+            # 读取前num行后结束
+            rows = []
+            n = 1
+            for line in iter(p.stdout.readline, ''):
+                if n <= num:
+                    n = n + 1
+                    row_info = {}
+                    try:
+                        row_info['sql'] = line.split('; #')[0] + ";"
+                        row_info['binlog_info'] = line.split('; #')[1].rstrip('\"')
+                    except IndexError:
+                        row_info['sql'] = line
+                        row_info['binlog_info'] = None
+                    rows.append(row_info)
+                else:
+                    break
+            if rows.__len__() == 0:
+                # 判断是否有异常
+                stderr = p.stderr.read()
+                if stderr:
+                    result['status'] = 1
+                    result['msg'] = stderr
+                    return HttpResponse(json.dumps(result), content_type='application/json')
+            # 终止子进程
+            p.kill()
+            result['data'] = rows
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result['status'] = 1
+            result['msg'] = str(e)
 
     # 异步保存到文件
     if save_sql:
@@ -186,8 +189,6 @@ def binlog2sql_file(args, user):
     """
     binlog2sql = Binlog2Sql()
     instance = args.get('instance')
-    conn_options = fr"-h{instance.host} -u{instance.user} -p'{instance.password}' -P{instance.port}"
-    args['conn_options'] = conn_options
     timestamp = int(time.time())
     path = os.path.join(settings.BASE_DIR, 'downloads/binlog2sql/')
     os.makedirs(path, exist_ok=True)
@@ -196,11 +197,14 @@ def binlog2sql_file(args, user):
     else:
         filename = os.path.join(path, f"{instance.host}_{instance.port}_{timestamp}.sql")
 
-    # 参数转换
-    cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
-    # 执行命令保存到文件
-    with open(filename, 'w') as f:
-        p = binlog2sql.execute_cmd(cmd_args, shell=True)
-        for c in iter(p.stdout.readline, ''):
-            f.write(c)
+    # 配置了隧道的实例使用进程内共享隧道的本地映射地址
+    with TunnelAddress(instance) as (host, port):
+        args['conn_options'] = fr"-h{host} -u{instance.user} -p'{instance.password}' -P{port}"
+        # 参数转换
+        cmd_args = binlog2sql.generate_args2cmd(args, shell=True)
+        # 执行命令保存到文件
+        with open(filename, 'w') as f:
+            p = binlog2sql.execute_cmd(cmd_args, shell=True)
+            for c in iter(p.stdout.readline, ''):
+                f.write(c)
     return user, filename
@@ -1,6 +1,12 @@
 """engine base库, 包含一个``EngineBase`` class和一个get_engine函数"""
+import logging
+
+from common.config import SysConfig
 from sql.engines.models import ResultSet
-from sql.utils.ssh_tunnel import SSHConnection
+from sql.engines.pool import get_pool, pool_key
+from sql.utils.ssh_tunnel import acquire_tunnel, release_tunnel
+
+logger = logging.getLogger('default')
 
 
 class EngineBase:
@@ -9,6 +15,10 @@ class EngineBase:
     def __init__(self, instance=None):
         self.conn = None
         self.thread_id = None
+        # 当前连接所属的连接池，为空表示独占连接
+        self.pool = None
+        # 当前连接是否可以归还连接池，修改会话状态的操作需要置为False
+        self.conn_reusable = True
         if instance:
             self.instance = instance
             self.instance_name = instance.instance_name
@@ -18,27 +28,53 @@ class EngineBase:
             self.password = instance.password
             self.db_name = instance.db_name
 
-            # 判断如果配置了隧道则连接隧道，只测试了MySQL
+            # 判断如果配置了隧道则使用进程内共享的隧道，只测试了MySQL
             if self.instance.tunnel:
-                self.ssh = SSHConnection(
-                    self.host,
-                    self.port,
-                    instance.tunnel.host,
-                    instance.tunnel.port,
-                    instance.tunnel.user,
-                    instance.tunnel.password,
-                    instance.tunnel.pkey_path,
-                    instance.tunnel.pkey_password,
-                )
-                self.host,self.port = self.ssh.get_ssh()
+                self.host, self.port = acquire_tunnel(self.instance)
+                self.tunnel_acquired = True
 
     def __del__(self):
-        if hasattr(self, 'ssh'):
-            del self.ssh
+        # 未显式关闭的池化连接归还连接池
+        if getattr(self, 'pool', None):
+            self.close()
+        if getattr(self, 'tunnel_acquired', False):
+            release_tunnel(self.instance)
+            self.tunnel_acquired = False
 
     def get_connection(self, db_name=None):
         """返回一个conn实例"""
 
+    def pooled_connection(self, creator, db_name=None, ping=None, reset=None):
+        """
+        从连接池获取连接，未开启连接池时直接调用creator创建连接
+        :param creator: 创建连接的函数
+        :param db_name: 连接池按实例+库区分
+        :param ping: 健康检查函数
+        :param reset: 归还连接时重置会话状态的函数，为空时只回滚事务
+        :return:
+        """
+        config = SysConfig()
+        if not config.get('engine_pool'):
+            return creator()
+        self.pool = get_pool(pool_key(self.instance, db_name), creator, ping=ping, reset=reset,
+                             max_size=int(config.get('engine_pool_size', 10)),
+                             idle_timeout=int(config.get('engine_pool_idle_timeout', 300)),
+                             max_lifetime=int(config.get('engine_pool_max_lifetime', 3600)))
+        self.conn_reusable = True
+        return self.pool.acquire()
+
+    def close(self):
+        """关闭连接，池化的连接归还连接池"""
+        if self.conn:
+            if self.pool and self.conn_reusable:
+                self.pool.release(self.conn)
+            elif self.pool:
+                self.pool.discard(self.conn)
+            else:
+                self.conn.close()
+            self.conn = None
+        self.pool = None
+
     @property
     def name(self):
         """返回engine名称"""
@@ -67,6 +103,10 @@ class EngineBase:
     def kill_connection(self, thread_id):
         """终止数据库连接"""
 
+    def kill_query(self, thread_id):
+        """终止连接正在执行的语句，不支持时终止连接"""
+        self.kill_connection(thread_id)
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet，rows=list"""
         return ResultSet()
@@ -79,6 +119,19 @@ class EngineBase:
         """获取所有字段, 返回一个ResultSet，rows=list"""
         return ResultSet()
 
+    def get_all_columns_by_db(self, db_name, **kwargs):
+        """获取库内全部表的字段, 返回一个ResultSet，rows=[(table, [column])]，默认逐表获取"""
+        tables = self.get_all_tables(db_name=db_name, **kwargs)
+        if tables.error:
+            return tables
+        result = ResultSet(full_sql=tables.full_sql)
+        for tb_name in tables.rows:
+            columns = self.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name, **kwargs)
+            if columns.error:
+                return columns
+            result.rows.append((tb_name, columns.rows))
+        return result
+
     def describe_table(self, db_name, tb_name, **kwargs):
         """获取表结构, 返回一个 ResultSet，rows=list"""
         return ResultSet()
@@ -93,11 +146,33 @@ class EngineBase:
     def query(self, db_name=None, sql='', limit_num=0, close_conn=True, **kwargs):
         """实际查询 返回一个ResultSet"""
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, batch_size=1000, **kwargs):
+        """流式查询, 返回一个生成器, 逐批返回ResultSet, 查询异常时返回带error的ResultSet后结束
+        默认一次性查询后整体返回, 支持服务端游标的engine自行实现"""
+        yield self.query(db_name=db_name, sql=sql, limit_num=limit_num, **kwargs)
+
     def query_masking(self, db_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
         return resultset
 
+    def query_masking_stream(self, db_name=None, sql='', resultsets=None, ignore_error=False):
+        """对流式查询的结果逐批脱敏, 返回生成器
+        ignore_error为True时脱敏异常按原结果返回"""
+        for resultset in resultsets:
+            # 查询异常直接返回
+            if resultset.error:
+                yield resultset
+                return
+            masking_result = self.query_masking(db_name, sql, resultset)
+            if masking_result.error:
+                if not ignore_error:
+                    yield masking_result
+                    return
+                logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql}，错误信息：{masking_result.error}')
+                masking_result.error = None
+            yield masking_result
+
     def execute_check(self, db_name=None, sql=''):
         """执行语句的检查 返回一个ReviewSet"""
 
@@ -22,8 +22,23 @@ class SqlItem:
         self.object_name = object_name
 
 
-class ReviewResult:
+class _SlotsBase:
+    """
+    使用__slots__存储属性，减少大量结果对象的内存占用，对象不再有__dict__；
+    as_dict返回已赋值的属性字典，未赋值的属性（如非Oracle结果的stmt_type）不包含在内
+    """
+    __slots__ = ()
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+
+class ReviewResult(_SlotsBase):
     """审核的单条结果"""
+    __slots__ = ('id', 'stage', 'errlevel', 'stagestatus', 'errormessage', 'sql', 'affected_rows', 'sequence',
+                 'backup_dbname', 'execute_time', 'sqlsha1', 'backup_time', 'actual_affected_rows',
+                 # Oracle的自定义属性
+                 'stmt_type', 'object_owner', 'object_type', 'object_name')
 
     def __init__(self, inception_result=None, **kwargs):
         """
@@ -61,14 +76,18 @@ class ReviewResult:
             self.backup_time = kwargs.get('backup_time', '')
             self.actual_affected_rows = kwargs.get('actual_affected_rows', '')
 
-        # 自定义属性
+        # 自定义属性，如Oracle的stmt_type、object_owner等
         for key, value in kwargs.items():
             if not hasattr(self, key):
                 setattr(self, key, value)
 
 
-class ReviewSet:
+class ReviewSet(_SlotsBase):
     """review和执行后的结果集, rows中是review result, 有设定好的字段"""
+    __slots__ = ('full_sql', 'is_execute', 'checked', 'warning', 'error', 'warning_count', 'error_count',
+                 'is_critical', 'syntax_type', 'rows', 'column_list', 'status', 'affected_rows',
+                 # 数据脱敏时设置
+                 'is_masked', 'mask_rule_hit')
 
     def __init__(self, full_sql='', rows=None, status=None,
                  affected_rows=0, column_list=None, **kwargs):
@@ -88,24 +107,16 @@ class ReviewSet:
         self.affected_rows = affected_rows
 
     def json(self):
-        tmp_list = []
-        for r in self.rows:
-            if isinstance(r, dict):
-                tmp_list += [r]
-            else:
-                tmp_list += [r.__dict__]
-
-        return json.dumps(tmp_list)
+        return json.dumps([r if isinstance(r, dict) else r.as_dict() for r in self.rows])
 
     def to_dict(self):
-        tmp_list = []
-        for r in self.rows:
-            tmp_list += [r.__dict__]
-        return tmp_list
+        return [r.as_dict() for r in self.rows]
 
 
-class ResultSet:
+class ResultSet(_SlotsBase):
     """查询的结果集, rows 内只有值, column_list 中的是key"""
+    __slots__ = ('full_sql', 'is_execute', 'checked', 'is_masked', 'query_time', 'mask_rule_hit', 'mask_time',
+                 'warning', 'error', 'is_critical', 'rows', 'column_list', 'status', 'affected_rows')
 
     def __init__(self, full_sql='', rows=None, status=None,
                  affected_rows=0, column_list=None, **kwargs):
@@ -119,23 +130,29 @@ class ResultSet:
         self.warning = None
         self.error = None
         self.is_critical = False
-        # rows 为普通列表
+        # rows 直接引用驱动返回的结果，不复制
         self.rows = rows or []
         self.column_list = column_list if column_list else []
         self.status = status
         self.affected_rows = affected_rows
 
+    def iter_dicts(self):
+        """按需将每行转换为字典"""
+        column_list = self.column_list
+        return (dict(zip(column_list, r)) for r in self.rows)
+
     def json(self):
-        tmp_list = []
-        for r in self.rows:
-            tmp_list += [dict(zip(self.column_list, r))]
-        return json.dumps(tmp_list)
+        return json.dumps(self.to_dict())
+
+    def iter_json(self):
+        """逐行输出JSON数组的各部分，用于流式返回，不需要一次构造全部行的字典"""
+        yield '['
+        for i, row in enumerate(self.iter_dicts()):
+            yield (',' if i else '') + json.dumps(row)
+        yield ']'
 
     def to_dict(self):
-        tmp_list = []
-        for r in self.rows:
-            tmp_list += [dict(zip(self.column_list, r))]
-        return tmp_list
+        return list(self.iter_dicts())
 
     def to_sep_dict(self):
         return {'column_list': self.column_list, 'rows': self.rows}
@@ -19,7 +19,8 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
                                                                  self.instance.charset or 'UTF8')
         if self.conn:
             return self.conn
-        self.conn = pyodbc.connect(connstr)
+        self.conn = self.pooled_connection(lambda: pyodbc.connect(connstr), db_name=db_name,
+                                           ping=lambda conn: conn.cursor().execute('select 1').fetchone())
         return self.conn
 
     def get_all_databases(self):
@@ -123,7 +124,7 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         """返回 ResultSet """
         result_set = ResultSet(full_sql=sql)
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(db_name=db_name)
             cursor = conn.cursor()
             if db_name:
                 cursor.execute('use [{}];'.format(db_name))
@@ -189,6 +190,8 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         """执行sql语句 返回 Review set"""
         execute_result = ReviewSet(full_sql=sql)
         conn = self.get_connection(db_name=db_name)
+        # 执行语句可能修改会话状态，连接不再归还连接池
+        self.conn_reusable = False
         cursor = conn.cursor()
         split_reg = re.compile('^GO$', re.I | re.M)
         sql = re.split(split_reg, sql, 0)
@@ -246,8 +249,3 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         if close_conn:
             self.close()
         return execute_result
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
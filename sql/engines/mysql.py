@@ -1,4 +1,5 @@
 # -*- coding: UTF-8 -*-
+import hashlib
 import logging
 import traceback
 import MySQLdb
@@ -14,8 +15,10 @@ from sql.utils.sql_utils import get_syntax_type, remove_comments
 from . import EngineBase
 from .models import ResultSet, ReviewResult, ReviewSet
 from .inception import InceptionEngine
-from sql.utils.data_masking import data_masking
+from sql.utils.data_masking import data_masking, masking_columns, mask_rows
+from sql.utils.query_tree import cache_version, normalize_sql
 from common.config import SysConfig
+from django.core.cache import cache
 
 logger = logging.getLogger('default')
 
@@ -26,6 +29,8 @@ class MysqlEngine(EngineBase):
         super().__init__(instance=instance)
         self.config = SysConfig()
         self.inc_engine = InceptionEngine() if self.config.get('inception') else GoInceptionEngine()
+        # 与数据库的交互次数，新建连接数和执行的语句数（含会话设置语句），用于观察单次查询的往返开销
+        self.round_trips = {'connections': 0, 'statements': 0}
 
     def get_connection(self, db_name=None):
         # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
@@ -34,16 +39,32 @@ class MysqlEngine(EngineBase):
         if self.conn:
             self.thread_id = self.conn.thread_id()
             return self.conn
+        kwargs = dict(host=self.host, port=self.port, user=self.user, passwd=self.password,
+                      charset=self.instance.charset or 'utf8mb4', conv=conversions, connect_timeout=10)
         if db_name:
-            self.conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
-                                        db=db_name, charset=self.instance.charset or 'utf8mb4',
-                                        conv=conversions,
-                                        connect_timeout=10)
-        else:
-            self.conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
-                                        charset=self.instance.charset or 'utf8mb4',
-                                        conv=conversions,
-                                        connect_timeout=10)
+            kwargs['db'] = db_name
+
+        def connect():
+            self.round_trips['connections'] += 1
+            return MySQLdb.connect(**kwargs)
+
+        def reset(conn):
+            # 恢复查询时修改的会话状态：事务、autocommit、max_execution_time和默认库
+            conn.rollback()
+            conn.autocommit(False)
+            cursor = conn.cursor()
+            try:
+                cursor.execute('set session max_execution_time=default;')
+            except MySQLdb.OperationalError:
+                pass
+            if db_name:
+                conn.select_db(db_name)
+            else:
+                # 未指定库的连接执行过use后无法恢复，直接丢弃
+                cursor.execute('select database();')
+                return cursor.fetchone()[0] is None
+
+        self.conn = self.pooled_connection(connect, db_name=db_name, ping=lambda conn: conn.ping(), reset=reset)
         self.thread_id = self.conn.thread_id()
         return self.conn
 
@@ -93,6 +114,10 @@ class MysqlEngine(EngineBase):
         """终止数据库连接"""
         self.query(sql=f'kill {thread_id}')
 
+    def kill_query(self, thread_id):
+        """终止连接正在执行的语句，保留连接"""
+        self.query(sql=f'kill query {thread_id}')
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet"""
         sql = "show databases"
@@ -131,6 +156,23 @@ class MysqlEngine(EngineBase):
         result.rows = column_list
         return result
 
+    def get_all_columns_by_db(self, db_name, **kwargs):
+        """获取库内全部表的字段, 一次查询information_schema, 返回一个ResultSet"""
+        sql = f"""SELECT 
+            TABLE_NAME,
+            COLUMN_NAME
+        FROM
+            information_schema.COLUMNS
+        WHERE
+            TABLE_SCHEMA = '{db_name}'
+        ORDER BY TABLE_NAME, ORDINAL_POSITION;"""
+        result = self.query(db_name=db_name, sql=sql)
+        columns = {}
+        for tb_name, column_name in result.rows:
+            columns.setdefault(tb_name, []).append(column_name)
+        result.rows = list(columns.items())
+        return result
+
     def describe_table(self, db_name, tb_name, **kwargs):
         """return ResultSet 类似查询"""
         sql = f"show create table `{tb_name}`;"
@@ -146,6 +188,7 @@ class MysqlEngine(EngineBase):
             conn = self.get_connection(db_name=db_name)
             conn.autocommit(True)
             cursor = conn.cursor(cursorclass)
+            self.round_trips['statements'] += 2
             try:
                 cursor.execute(f"set session max_execution_time={max_execution_time};")
             except MySQLdb.OperationalError:
@@ -168,6 +211,44 @@ class MysqlEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, batch_size=1000, **kwargs):
+        """使用SSCursor流式查询，逐批返回ResultSet，客户端内存占用与结果集大小无关"""
+        max_execution_time = kwargs.get('max_execution_time', 0)
+        close_conn = kwargs.get('close_conn', True)
+        limit_num = int(limit_num)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            conn.autocommit(True)
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            self.round_trips['statements'] += 2
+            try:
+                cursor.execute(f"set session max_execution_time={max_execution_time};")
+            except MySQLdb.OperationalError:
+                pass
+            cursor.execute(sql)
+            fields = cursor.description
+            column_list = [i[0] for i in fields] if fields else []
+            fetched = 0
+            while True:
+                size = min(batch_size, limit_num - fetched) if limit_num > 0 else batch_size
+                rows = cursor.fetchmany(size=size) if size > 0 else ()
+                # 保证至少返回一批，用于输出列信息
+                if not rows and fetched > 0:
+                    break
+                fetched += len(rows)
+                yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, affected_rows=len(rows))
+                if not rows:
+                    break
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            if close_conn:
+                self.close()
+
     def query_check(self, db_name=None, sql=''):
         # 查询语句的检查、注释去除、切分
         result = {'msg': '', 'bad_query': False, 'filtered_sql': sql, 'has_star': False}
@@ -187,12 +268,42 @@ class MysqlEngine(EngineBase):
             result['msg'] = 'SQL语句中含有 * '
         # select语句先使用Explain判断语法是否正确
         if re.match(r"^select", sql, re.I):
-            explain_result = self.query(db_name=db_name, sql=f"explain {sql}")
-            if explain_result.error:
+            error = self._explain_check(db_name, sql)
+            if error:
                 result['bad_query'] = True
-                result['msg'] = explain_result.error
+                result['msg'] = error
         return result
 
+    def _explain_check(self, db_name, sql):
+        """
+        使用Explain判断select语句语法是否正确，返回错误信息
+        系统配置query_check_defer开启时不单独校验，语法错误由执行查询时返回；
+        query_check_cache_ttl大于0时，校验通过的语句按实例+库+语句指纹缓存，有效期单位秒；
+        Explain复用后续查询的连接，不再单独建立连接
+        """
+        if self.config.get('query_check_defer'):
+            return None
+        ttl = int(self.config.get('query_check_cache_ttl', 0))
+        key = None
+        if ttl > 0:
+            sql_hash = hashlib.md5(normalize_sql(sql).encode('utf-8')).hexdigest()
+            key = f'query_check:{self.instance.id}:{cache_version(self.instance.id)}:{db_name}:{sql_hash}'
+            try:
+                if cache.get(key):
+                    return None
+            except Exception as m:
+                logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        explain_result = self.query(db_name=db_name, sql=f"explain {sql}", close_conn=False)
+        if explain_result.error:
+            self.close()
+            return explain_result.error
+        if key:
+            try:
+                cache.set(key, True, timeout=ttl)
+            except Exception as m:
+                logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return None
+
     def filter_sql(self, sql='', limit_num=0):
         # 对查询sql增加limit限制,limit n 或 limit n,n 或 limit n offset n统一改写成limit n
         sql = sql.rstrip(';').strip()
@@ -225,6 +336,34 @@ class MysqlEngine(EngineBase):
             mask_result = resultset
         return mask_result
 
+    def query_masking_stream(self, db_name=None, sql='', resultsets=None, ignore_error=False):
+        """流式结果脱敏，仅解析一次语句获取命中列，再逐批脱敏"""
+        if not re.match(r"^select", sql, re.I):
+            yield from resultsets
+            return
+        hit_columns = None
+        mask_rule_hit = False
+        for resultset in resultsets:
+            if resultset.error:
+                yield resultset
+                return
+            if hit_columns is None:
+                try:
+                    mask_rule_hit, hit_columns = masking_columns(self.instance, db_name, sql, resultset.column_list)
+                except Exception as msg:
+                    logger.warning(f'数据脱敏异常，错误信息：{traceback.format_exc()}')
+                    if not ignore_error:
+                        resultset.error = str(msg)
+                        resultset.status = 1
+                        yield resultset
+                        return
+                    hit_columns = []
+            resultset.mask_rule_hit = mask_rule_hit
+            if hit_columns and resultset.rows:
+                resultset.rows = mask_rows(resultset.rows, hit_columns)
+                resultset.is_masked = True
+            yield resultset
+
     def execute_check(self, db_name=None, sql=''):
         """上线单执行前的检查, 返回Review set"""
         # 进行Inception检查，获取检测结果
@@ -309,6 +448,8 @@ class MysqlEngine(EngineBase):
         """原生执行语句"""
         result = ResultSet(full_sql=sql)
         conn = self.get_connection(db_name=db_name)
+        # 原生执行可能修改会话状态，连接不再归还连接池
+        self.conn_reusable = False
         try:
             cursor = conn.cursor()
             for statement in sqlparse.split(sql):
@@ -347,8 +488,3 @@ class MysqlEngine(EngineBase):
             get、kill、pause、resume
         """
         return self.inc_engine.osc_control(**kwargs)
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
@@ -31,12 +31,13 @@ class OracleEngine(EngineBase):
             return self.conn
         if self.sid:
             dsn = cx_Oracle.makedsn(self.host, self.port, self.sid)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         elif self.service_name:
             dsn = cx_Oracle.makedsn(self.host, self.port, service_name=self.service_name)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         else:
             raise ValueError('sid 和 dsn 均未填写, 请联系管理页补充该实例配置.')
+        self.conn = self.pooled_connection(
+            lambda: cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8"),
+            db_name=db_name, ping=lambda conn: conn.ping())
         return self.conn
 
     @property
@@ -262,7 +263,7 @@ class OracleEngine(EngineBase):
         # 使用explain进行支持的SQL语法审核，连接需不中断，防止数据库不断fork进程的大批量消耗
         result = {'msg': '', 'rows': 0}
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(db_name=db_name)
             cursor = conn.cursor()
             if db_name:
                 cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
@@ -329,7 +330,7 @@ class OracleEngine(EngineBase):
         """返回 ResultSet """
         result_set = ResultSet(full_sql=sql)
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(db_name=db_name)
             cursor = conn.cursor()
             if db_name:
                 cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
@@ -361,6 +362,48 @@ class OracleEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, batch_size=1000, **kwargs):
+        """按arraysize分批读取，逐批返回ResultSet"""
+        close_conn = kwargs.get('close_conn', True)
+        limit_num = int(limit_num)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            cursor = conn.cursor()
+            cursor.arraysize = batch_size
+            if db_name:
+                cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
+            sql = sql.rstrip(';')
+            # 支持oralce查询SQL执行计划语句
+            if re.match(r"^explain", sql, re.I):
+                cursor.execute(sql)
+                sql = "select PLAN_TABLE_OUTPUT from table(dbms_xplan.display)"
+            cursor.execute(sql)
+            fields = cursor.description
+            column_list = [i[0] for i in fields] if fields else []
+            has_lob = any(x[1] == cx_Oracle.CLOB for x in fields) if fields else False
+            fetched = 0
+            while True:
+                size = min(batch_size, limit_num - fetched) if limit_num > 0 else batch_size
+                rows = cursor.fetchmany(size) if size > 0 else []
+                if not rows and fetched > 0:
+                    break
+                if has_lob:
+                    rows = [tuple([(c.read() if type(c) == cx_Oracle.LOB else c) for c in r]) for r in rows]
+                else:
+                    rows = [tuple(x) for x in rows]
+                fetched += len(rows)
+                yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, affected_rows=len(rows))
+                if not rows:
+                    break
+        except Exception as e:
+            logger.warning(f"Oracle 语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            if close_conn:
+                self.close()
+
     def query_masking(self, schema_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
@@ -618,6 +661,8 @@ class OracleEngine(EngineBase):
         statement = None
         try:
             conn = self.get_connection()
+            # 执行语句可能修改会话状态，连接不再归还连接池
+            self.conn_reusable = False
             cursor = conn.cursor()
             # 获取执行工单时间，用于备份SQL的日志挖掘起始时间
             cursor.execute(f"alter session set nls_date_format='yyyy-mm-dd hh24:mi:ss'")
@@ -812,6 +857,7 @@ class OracleEngine(EngineBase):
         task_begin = 0
         try:
             conn = self.get_connection()
+            self.conn_reusable = False
             cursor = conn.cursor()
             sql = sql.rstrip(';')
             # 创建分析任务
@@ -856,8 +902,3 @@ class OracleEngine(EngineBase):
             if close_conn:
                 self.close()
         return result_set
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
@@ -26,8 +26,12 @@ class PgSQLEngine(EngineBase):
     def get_connection(self, db_name=None):
         if self.conn:
             return self.conn
-        self.conn = psycopg2.connect(host=self.host, port=self.port, user=self.user,
-                                     password=self.password, dbname=db_name)
+        self.conn = self.pooled_connection(
+            lambda: psycopg2.connect(host=self.host, port=self.port, user=self.user,
+                                     password=self.password, dbname=db_name),
+            db_name=db_name, ping=lambda conn: conn.cursor().execute('select 1'),
+            # 回滚事务并执行RESET ALL，恢复set修改的会话参数
+            reset=lambda conn: conn.reset())
         return self.conn
 
     @property
@@ -168,6 +172,45 @@ class PgSQLEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, batch_size=1000, **kwargs):
+        """使用服务端命名游标流式查询，逐批返回ResultSet"""
+        schema_name = kwargs.get('schema_name')
+        close_conn = kwargs.get('close_conn', True)
+        limit_num = int(limit_num)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            if schema_name:
+                conn.cursor().execute(f"SET search_path TO {schema_name};")
+            # 命名游标仅支持查询语句，其他语句使用普通游标
+            if re.match(r"^select|^with", sql.strip(), re.I):
+                cursor = conn.cursor(name=f'archery_stream_{id(self)}')
+                cursor.itersize = batch_size
+            else:
+                cursor = conn.cursor()
+            cursor.execute(sql)
+            fetched = 0
+            while True:
+                size = min(batch_size, limit_num - fetched) if limit_num > 0 else batch_size
+                rows = cursor.fetchmany(size=size) if size > 0 else []
+                if not rows and fetched > 0:
+                    break
+                # 命名游标在首次fetch之后才有description
+                fields = cursor.description
+                column_list = [i[0] for i in fields] if fields else []
+                fetched += len(rows)
+                yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, affected_rows=len(rows))
+                if not rows:
+                    break
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"PgSQL命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            if close_conn:
+                self.close()
+
     def filter_sql(self, sql='', limit_num=0):
         # 对查询sql增加limit限制，# TODO limit改写待优化
         sql_lower = sql.lower().rstrip(';').strip()
@@ -239,6 +282,8 @@ class PgSQLEngine(EngineBase):
         db_name = workflow.db_name
         try:
             conn = self.get_connection(db_name=db_name)
+            # 执行语句可能修改会话状态，连接不再归还连接池
+            self.conn_reusable = False
             cursor = conn.cursor()
             # 逐条执行切分语句，追加到执行结果中
             for statement in split_sql:
@@ -286,8 +331,3 @@ class PgSQLEngine(EngineBase):
             if close_conn:
                 self.close()
         return execute_result
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
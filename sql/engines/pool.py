@@ -0,0 +1,245 @@
+# -*- coding: UTF-8 -*-
+"""
+engine 连接池，按实例+库缓存数据库连接，避免每次查询都重新建立连接（TCP、TLS及认证握手）
+每个进程独立维护，连接在取出时做健康检查，并按空闲时间、最大存活时间淘汰
+"""
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger('default')
+
+_pools = {}
+_redis_pools = {}
+_lock = threading.Lock()
+
+
+class PoolExhausted(RuntimeError):
+    """连接池已满并且等待超时"""
+
+
+class ConnectionPool:
+    """单个实例+库的连接池"""
+
+    def __init__(self, key, creator, ping=None, reset=None, max_size=10, idle_timeout=300, max_lifetime=3600,
+                 wait_timeout=10):
+        """
+        :param key: 连接池标识
+        :param creator: 创建连接的函数
+        :param ping: 健康检查函数，入参为连接，返回False或者抛出异常表示连接不可用
+        :param reset: 归还时重置会话状态的函数，入参为连接，返回False或者抛出异常表示无法重置，连接将被关闭；
+                      为空时只回滚未提交的事务
+        :param max_size: 最大连接数（空闲+使用中）
+        :param idle_timeout: 空闲超时时间，单位秒
+        :param max_lifetime: 连接最大存活时间，单位秒
+        :param wait_timeout: 连接池满时等待可用连接的时间，单位秒
+        """
+        self.key = key
+        self.creator = creator
+        self.ping = ping
+        self.reset = reset
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        # 空闲连接 [(conn, created_at, last_used_at)]，后进先出
+        self._idle = []
+        # 使用中连接的创建时间 {id(conn): created_at}
+        self._in_use = {}
+        self._cond = threading.Condition(threading.Lock())
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.errors = 0
+
+    def acquire(self):
+        """取出一个可用连接，无空闲连接时新建"""
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    conn, created_at, _ = self._idle.pop()
+                    break
+                if len(self._in_use) < self.max_size:
+                    conn, created_at = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted(f'连接池{self.key[0]}已满，等待可用连接超时')
+                self._cond.wait(remaining)
+            # 先占位，避免新建连接期间超过最大连接数
+            placeholder = object()
+            self._in_use[id(placeholder)] = created_at
+        try:
+            if conn is not None and self._alive(conn):
+                self.hits += 1
+            else:
+                if conn is not None:
+                    self._close(conn)
+                    self.evicted += 1
+                conn = self.creator()
+                created_at = time.time()
+                self.created += 1
+                self.misses += 1
+        except Exception:
+            with self._cond:
+                self._in_use.pop(id(placeholder), None)
+                self.errors += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._in_use.pop(id(placeholder), None)
+            self._in_use[id(conn)] = created_at
+        return conn
+
+    def release(self, conn):
+        """归还连接，超过最大存活时间或者重置失败的连接直接关闭"""
+        with self._cond:
+            created_at = self._in_use.pop(id(conn), None)
+            self._cond.notify()
+        if created_at is None or time.time() - created_at > self.max_lifetime:
+            self._close(conn)
+            self.evicted += 1
+            return
+        try:
+            # 结束未提交的事务并恢复会话变量、默认库等，防止会话状态残留到下一次使用
+            if self.reset is None:
+                conn.rollback()
+            elif self.reset(conn) is False:
+                raise RuntimeError('会话状态无法重置')
+        except Exception as e:
+            logger.debug(f'连接池{self.key[0]}重置连接失败，连接将被丢弃：{e}')
+            self._close(conn)
+            self.evicted += 1
+            return
+        with self._cond:
+            if len(self._idle) + len(self._in_use) < self.max_size:
+                self._idle.append((conn, created_at, time.time()))
+                self._cond.notify()
+                return
+        self._close(conn)
+        self.evicted += 1
+
+    def discard(self, conn):
+        """丢弃连接，用于会话状态被修改或者异常的连接"""
+        with self._cond:
+            self._in_use.pop(id(conn), None)
+            self._cond.notify()
+        self._close(conn)
+
+    def clear(self):
+        """关闭全部空闲连接，使用中的连接归还时按需关闭"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        """连接池统计信息"""
+        with self._cond:
+            return {
+                'instance_id': self.key[0],
+                'db_name': self.key[1],
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'created': self.created,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'errors': self.errors,
+            }
+
+    def _evict_idle(self):
+        """淘汰空闲超时和超过最大存活时间的连接，需持有锁"""
+        now = time.time()
+        alive = []
+        for conn, created_at, last_used_at in self._idle:
+            if now - last_used_at > self.idle_timeout or now - created_at > self.max_lifetime:
+                self._close(conn)
+                self.evicted += 1
+            else:
+                alive.append((conn, created_at, last_used_at))
+        self._idle = alive
+
+    def _alive(self, conn):
+        """取出时的健康检查"""
+        if self.ping is None:
+            return True
+        try:
+            return self.ping(conn) is not False
+        except Exception as e:
+            logger.debug(f'连接池{self.key[0]}健康检查失败，连接将被丢弃：{e}')
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def pool_key(instance, db_name=None):
+    """连接池key，实例连接信息变化后自动使用新的连接池"""
+    tunnel_id = instance.tunnel_id if instance.tunnel_id else 0
+    conn_info = f'{instance.host}:{instance.port}:{instance.user}:{instance.password}:' \
+                f'{instance.charset}:{instance.sid}:{instance.service_name}:{tunnel_id}'
+    return instance.id, db_name, hashlib.md5(conn_info.encode('utf-8')).hexdigest()
+
+
+def get_pool(key, creator, ping=None, reset=None, **options):
+    """获取连接池，不存在则创建"""
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                # 实例连接信息变化时清理旧的连接池
+                for old_key in [k for k in _pools if k[0] == key[0] and k[1] == key[1]]:
+                    _pools.pop(old_key).clear()
+                pool = _pools[key] = ConnectionPool(key, creator, ping=ping, reset=reset, **options)
+    # 使用最新的creator，隧道重连后本地映射端口可能变化
+    pool.creator = creator
+    return pool
+
+
+def get_redis_pool(key, max_size=10, **connection_kwargs):
+    """获取Redis连接池，Redis客户端本身线程安全，直接共享redis-py的ConnectionPool"""
+    import redis
+    pool = _redis_pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _redis_pools.get(key)
+            if pool is None:
+                for old_key in [k for k in _redis_pools if k[0] == key[0] and k[1] == key[1]]:
+                    _redis_pools.pop(old_key).disconnect()
+                pool = _redis_pools[key] = redis.ConnectionPool(max_connections=max_size, **connection_kwargs)
+    return pool
+
+
+def clear_pools(instance_id=None):
+    """关闭连接池，instance_id为空时关闭全部"""
+    with _lock:
+        for key in [k for k in _pools if instance_id is None or k[0] == instance_id]:
+            _pools.pop(key).clear()
+        for key in [k for k in _redis_pools if instance_id is None or k[0] == instance_id]:
+            _redis_pools.pop(key).disconnect()
+
+
+def pool_stats():
+    """当前进程全部连接池的统计信息，用于监控"""
+    stats = [pool.stats() for pool in list(_pools.values())]
+    for key, pool in list(_redis_pools.items()):
+        stats.append({
+            'instance_id': key[0],
+            'db_name': key[1],
+            'max_size': pool.max_connections,
+            'idle': len(pool._available_connections),
+            'in_use': len(pool._in_use_connections),
+            'created': pool._created_connections,
+        })
+    return stats
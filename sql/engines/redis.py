@@ -13,8 +13,10 @@ import redis
 import logging
 import traceback
 
+from common.config import SysConfig
 from common.utils.timer import FuncTimer
 from . import EngineBase
+from .pool import get_redis_pool, pool_key
 from .models import ResultSet, ReviewSet, ReviewResult
 
 __author__ = 'hhyo'
@@ -25,6 +27,14 @@ logger = logging.getLogger('default')
 class RedisEngine(EngineBase):
     def get_connection(self, db_name=None):
         db_name = db_name or self.db_name
+        config = SysConfig()
+        # 开启连接池后同实例同库共享redis-py连接池
+        if config.get('engine_pool'):
+            pool = get_redis_pool(pool_key(self.instance, db_name) + (self.host, self.port),
+                                  max_size=int(config.get('engine_pool_size', 10)),
+                                  host=self.host, port=self.port, db=db_name, password=self.password,
+                                  encoding_errors='ignore', decode_responses=True)
+            return redis.Redis(connection_pool=pool)
         return redis.Redis(host=self.host, port=self.port, db=db_name, password=self.password,
                            encoding_errors='ignore', decode_responses=True)
 
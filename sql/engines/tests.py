@@ -1,5 +1,6 @@
 import MySQLdb
 import json
+import pickle
 from datetime import timedelta, datetime
 from unittest.mock import patch, Mock, ANY
 
@@ -18,6 +19,7 @@ from sql.engines.pgsql import PgSQLEngine
 from sql.engines.oracle import OracleEngine
 from sql.engines.mongo import MongoEngine
 from sql.engines.inception import InceptionEngine, _repair_json_str
+from sql.engines.pool import ConnectionPool, PoolExhausted, clear_pools, pool_stats
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent
 
 User = get_user_model()
@@ -73,6 +75,70 @@ class TestEngineBase(TestCase):
         self.assertEqual(self.ins1.user, engine.user)
 
 
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.creator = Mock(side_effect=lambda: Mock())
+        self.pool = ConnectionPool((1, 'some_db', 'some_hash'), self.creator, max_size=2, wait_timeout=0)
+
+    def test_reuse(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+        self.creator.assert_called_once()
+        conn.rollback.assert_called_once()
+        self.assertEqual(self.pool.stats()['hits'], 1)
+
+    def test_exhausted(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        with self.assertRaises(PoolExhausted):
+            self.pool.acquire()
+
+    def test_ping_failed(self):
+        self.pool.ping = Mock(side_effect=RuntimeError('gone away'))
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        new_conn = self.pool.acquire()
+        self.assertIsNot(new_conn, conn)
+        conn.close.assert_called_once()
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertIsNot(self.pool.acquire(), conn)
+        self.assertEqual(self.pool.stats()['evicted'], 1)
+
+    def test_max_lifetime(self):
+        self.pool.max_lifetime = -1
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        conn.close.assert_called_once()
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_discard(self):
+        conn = self.pool.acquire()
+        self.pool.discard(conn)
+        conn.close.assert_called_once()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_reset(self):
+        self.pool.reset = Mock()
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.pool.reset.assert_called_once_with(conn)
+        conn.rollback.assert_not_called()
+        self.assertIs(self.pool.acquire(), conn)
+
+    def test_reset_failed(self):
+        self.pool.reset = Mock(return_value=False)
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        conn.close.assert_called_once()
+        self.assertIsNot(self.pool.acquire(), conn)
+        self.assertEqual(self.pool.stats()['evicted'], 1)
+
+
 class TestMssql(TestCase):
 
     @classmethod
@@ -182,9 +248,9 @@ class TestMssql(TestCase):
         test_sql = 'use database\ngo\nsome sql1\nGO\nsome sql2\n\r\nGo\nsome sql3\n\r\ngO\n'
         check_result = new_engine.execute_check(db_name=None, sql=test_sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[1].__dict__['sql'], "use database\n")
-        self.assertEqual(check_result.rows[2].__dict__['sql'], "\nsome sql1\n")
-        self.assertEqual(check_result.rows[4].__dict__['sql'], "\nsome sql3\n\r\n")
+        self.assertEqual(check_result.rows[1].as_dict()['sql'], "use database\n")
+        self.assertEqual(check_result.rows[2].as_dict()['sql'], "\nsome sql1\n")
+        self.assertEqual(check_result.rows[4].as_dict()['sql'], "\nsome sql3\n\r\n")
 
     @patch('sql.engines.mssql.MssqlEngine.execute')
     def test_execute_workflow(self, mock_execute):
@@ -272,6 +338,68 @@ class TestMysql(TestCase):
         connect.return_value.close.assert_called_once()
         self.assertIsInstance(query_result, ResultSet)
 
+    @patch('MySQLdb.connect')
+    def test_query_with_pool(self, connect):
+        self.sys_config.set('engine_pool', 'true')
+        connect.return_value.cursor.return_value.fetchall.return_value = ((1,),)
+        connect.return_value.cursor.return_value.description = (('1', 'some_other_des'),)
+        MysqlEngine(instance=self.ins1).query(sql='select 1')
+        MysqlEngine(instance=self.ins1).query(sql='select 1')
+        connect.assert_called_once()
+        connect.return_value.close.assert_not_called()
+        self.assertEqual(pool_stats()[0]['hits'], 1)
+        clear_pools()
+        connect.return_value.close.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def test_query_with_pool_reset_session(self, connect):
+        self.sys_config.set('engine_pool', 'true')
+        conn = connect.return_value
+        cursor = conn.cursor.return_value
+        cursor.fetchall.return_value = ((1,),)
+        cursor.description = (('1', 'some_other_des'),)
+        MysqlEngine(instance=self.ins1).query(db_name='some_db', sql='select 1', max_execution_time=1000)
+        # 归还时恢复默认的会话状态，下一次取出的连接与新建连接一致
+        conn.rollback.assert_called_once()
+        conn.autocommit.assert_called_with(False)
+        cursor.execute.assert_called_with('set session max_execution_time=default;')
+        conn.select_db.assert_called_once_with('some_db')
+        MysqlEngine(instance=self.ins1).query(db_name='some_db', sql='select 1')
+        connect.assert_called_once()
+        clear_pools()
+
+    @patch('MySQLdb.connect')
+    def test_query_with_pool_discard_changed_db(self, connect):
+        self.sys_config.set('engine_pool', 'true')
+        cursor = connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = ((1,),)
+        cursor.description = (('1', 'some_other_des'),)
+        # 未指定库的连接执行use后当前库不为空，归还时直接关闭
+        cursor.fetchone.return_value = ('some_db',)
+        MysqlEngine(instance=self.ins1).query(sql='use some_db')
+        connect.return_value.close.assert_called_once()
+        self.assertEqual(pool_stats()[0]['idle'], 0)
+        clear_pools()
+
+    @patch('MySQLdb.connect')
+    def test_query_stream(self, connect):
+        cursor = connect.return_value.cursor.return_value
+        cursor.description = (('id', 'some_other_des'),)
+        cursor.fetchmany.side_effect = [((1,), (2,)), ((3,),), ()]
+        new_engine = MysqlEngine(instance=self.ins1)
+        batches = list(new_engine.query_stream(sql='select id from t', limit_num=3, batch_size=2))
+        self.assertEqual([b.rows for b in batches], [((1,), (2,)), ((3,),)])
+        self.assertEqual(batches[0].column_list, ['id'])
+        connect.return_value.close.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def test_query_stream_error(self, connect):
+        connect.return_value.cursor.return_value.execute.side_effect = [None, Exception('some error')]
+        new_engine = MysqlEngine(instance=self.ins1)
+        batches = list(new_engine.query_stream(sql='select id from t'))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].error, 'some error')
+
     @patch.object(MysqlEngine, 'query')
     def testAllDb(self, mock_query):
         db_result = ResultSet()
@@ -327,6 +455,40 @@ class TestMysql(TestCase):
                              {'msg': '不支持的查询语法类型!', 'bad_query': True, 'filtered_sql': 'update user set id=0',
                               'has_star': False})
 
+    @patch('MySQLdb.connect')
+    def test_query_check_reuse_connection(self, connect):
+        connect.return_value.cursor.return_value.description = (('id', 'some_other_des'),)
+        new_engine = MysqlEngine(instance=self.ins1)
+        check_result = new_engine.query_check(db_name='some_db', sql='select id from t')
+        self.assertFalse(check_result['bad_query'])
+        # explain后连接不关闭，后续查询复用
+        connect.return_value.close.assert_not_called()
+        new_engine.query(db_name='some_db', sql='select id from t')
+        connect.assert_called_once()
+        self.assertDictEqual(new_engine.round_trips, {'connections': 1, 'statements': 4})
+
+    @patch.object(MysqlEngine, 'query')
+    def test_query_check_cache(self, mock_query):
+        mock_query.return_value = ResultSet()
+        self.sys_config.set('query_check_cache_ttl', '60')
+        MysqlEngine(instance=self.ins1).query_check(db_name='some_db', sql='select id from t')
+        MysqlEngine(instance=self.ins1).query_check(db_name='some_db', sql='select  id\nfrom t;')
+        mock_query.assert_called_once()
+        # 校验失败的语句不缓存
+        mock_query.return_value = ResultSet()
+        mock_query.return_value.error = 'some error'
+        for _ in range(2):
+            check_result = MysqlEngine(instance=self.ins1).query_check(db_name='some_db', sql='select id from t1')
+            self.assertTrue(check_result['bad_query'])
+        self.assertEqual(mock_query.call_count, 3)
+
+    @patch.object(MysqlEngine, 'query')
+    def test_query_check_defer(self, mock_query):
+        self.sys_config.set('query_check_defer', 'true')
+        check_result = MysqlEngine(instance=self.ins1).query_check(db_name='some_db', sql='select id from t')
+        self.assertFalse(check_result['bad_query'])
+        mock_query.assert_not_called()
+
     def test_filter_sql_with_delimiter(self):
         new_engine = MysqlEngine(instance=self.ins1)
         sql_without_limit = 'select user from usertable;'
@@ -408,7 +570,7 @@ class TestMysql(TestCase):
         new_engine = MysqlEngine(instance=self.ins1)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('sql.engines.mysql.InceptionEngine')
     def test_execute_check_critical_sql(self, _inception_engine):
@@ -431,7 +593,7 @@ class TestMysql(TestCase):
         new_engine = MysqlEngine(instance=self.ins1)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('sql.engines.mysql.InceptionEngine')
     def test_execute_check_normal_sql(self, _inception_engine):
@@ -448,7 +610,7 @@ class TestMysql(TestCase):
         new_engine = MysqlEngine(instance=self.ins1)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('sql.engines.mysql.InceptionEngine')
     def test_execute_check_normal_sql_with_Exception(self, _inception_engine):
@@ -626,7 +788,7 @@ class TestRedis(TestCase):
         new_engine = RedisEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name=0, sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('redis.Redis.execute_command', return_value='text')
     def test_execute_workflow_success(self, _execute_command):
@@ -655,7 +817,7 @@ class TestRedis(TestCase):
         new_engine = RedisEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
         self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        self.assertEqual(execute_result.rows[0].as_dict().keys(), row.as_dict().keys())
 
 
 class TestPgSQL(TestCase):
@@ -784,7 +946,7 @@ class TestPgSQL(TestCase):
         new_engine = PgSQLEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     def test_execute_check_critical_sql(self):
         self.sys_config.set('critical_ddl_regex', '^|update')
@@ -797,7 +959,7 @@ class TestPgSQL(TestCase):
         new_engine = PgSQLEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     def test_execute_check_normal_sql(self):
         self.sys_config.purge()
@@ -812,7 +974,7 @@ class TestPgSQL(TestCase):
         new_engine = PgSQLEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('psycopg2.connect.cursor.execute')
     @patch('psycopg2.connect.cursor')
@@ -843,7 +1005,7 @@ class TestPgSQL(TestCase):
         new_engine = PgSQLEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
         self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+        self.assertEqual(execute_result.rows[0].as_dict().keys(), row.as_dict().keys())
 
     @patch('psycopg2.connect.cursor.execute')
     @patch('psycopg2.connect.cursor')
@@ -875,7 +1037,7 @@ class TestPgSQL(TestCase):
             new_engine = PgSQLEngine(instance=self.ins)
             execute_result = new_engine.execute_workflow(workflow=wf)
             self.assertIsInstance(execute_result, ReviewSet)
-            self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+            self.assertEqual(execute_result.rows[0].as_dict().keys(), row.as_dict().keys())
 
 
 class TestModel(TestCase):
@@ -901,6 +1063,42 @@ class TestModel(TestCase):
         brand_new_review_set = ReviewSet()
         self.assertEqual(brand_new_review_set.rows, [])
 
+    def test_result_set_slots(self):
+        """使用__slots__，as_dict返回属性字典，pickle后属性不变"""
+        rows = ((1, 'a'), (2, 'b'))
+        result_set = ResultSet(full_sql='select id,name from t', rows=rows, column_list=['id', 'name'])
+        self.assertIs(result_set.to_sep_dict()['rows'], rows)
+        self.assertEqual(result_set.to_dict(), [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+        self.assertEqual(json.loads(result_set.json()), result_set.to_dict())
+        self.assertEqual(json.loads(''.join(result_set.iter_json())), result_set.to_dict())
+        self.assertEqual(result_set.as_dict()['full_sql'], 'select id,name from t')
+        self.assertEqual(pickle.loads(pickle.dumps(result_set)).as_dict(), result_set.as_dict())
+        self.assertFalse(hasattr(result_set, '__dict__'))
+        with self.assertRaises(AttributeError):
+            result_set.not_exists = 1
+
+    def test_review_set_masking_attributes(self):
+        """ReviewSet的数据脱敏属性仅在设置后出现在as_dict中"""
+        review_set = ReviewSet(full_sql='select 1', rows=[(1,)], column_list=['1'])
+        self.assertNotIn('is_masked', review_set.as_dict())
+        review_set.mask_rule_hit = True
+        review_set.is_masked = False
+        self.assertEqual(review_set.as_dict()['is_masked'], False)
+        restored = pickle.loads(pickle.dumps(review_set))
+        self.assertEqual(restored.as_dict(), review_set.as_dict())
+
+    def test_review_result_extra_attributes(self):
+        """ReviewResult的自定义属性"""
+        row = ReviewResult(id=1, sql='begin null; end;', stmt_type='PLSQL', object_name='P1')
+        self.assertEqual(row.stmt_type, 'PLSQL')
+        self.assertEqual(row.as_dict()['object_name'], 'P1')
+        self.assertNotIn('object_type', row.as_dict())
+        self.assertNotIn('stmt_type', ReviewResult(id=1).as_dict())
+        review_set = ReviewSet(full_sql=row.sql, rows=[row])
+        restored = pickle.loads(pickle.dumps(review_set))
+        self.assertEqual(restored.to_dict(), review_set.to_dict())
+        self.assertEqual(restored.rows[0].stmt_type, 'PLSQL')
+
 
 class TestInception(TestCase):
     def setUp(self):
@@ -1439,7 +1637,7 @@ class TestOracle(TestCase):
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     def test_execute_check_critical_sql(self):
         self.sys_config.set('critical_ddl_regex', '^|update')
@@ -1452,7 +1650,7 @@ class TestOracle(TestCase):
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('sql.engines.oracle.OracleEngine.explain_check', return_value={'msg': '', 'rows': 0})
     @patch('sql.engines.oracle.OracleEngine.get_sql_first_object_name', return_value='tb')
@@ -1475,7 +1673,7 @@ class TestOracle(TestCase):
         new_engine = OracleEngine(instance=self.ins)
         check_result = new_engine.execute_check(db_name='archery', sql=sql)
         self.assertIsInstance(check_result, ReviewSet)
-        self.assertEqual(check_result.rows[0].__dict__, row.__dict__)
+        self.assertEqual(check_result.rows[0].as_dict(), row.as_dict())
 
     @patch('cx_Oracle.connect.cursor.execute')
     @patch('cx_Oracle.connect.cursor')
@@ -1518,7 +1716,7 @@ class TestOracle(TestCase):
         new_engine = OracleEngine(instance=self.ins)
         execute_result = new_engine.execute_workflow(workflow=wf)
         self.assertIsInstance(execute_result, ReviewSet)
-        self.assertEqual(execute_result.rows[0].__dict__.keys(), execute_row.__dict__.keys())
+        self.assertEqual(execute_result.rows[0].as_dict().keys(), execute_row.as_dict().keys())
 
     @patch('cx_Oracle.connect.cursor.execute')
     @patch('cx_Oracle.connect.cursor')
@@ -1555,7 +1753,7 @@ class TestOracle(TestCase):
             new_engine = OracleEngine(instance=self.ins)
             execute_result = new_engine.execute_workflow(workflow=wf)
             self.assertIsInstance(execute_result, ReviewSet)
-            self.assertEqual(execute_result.rows[0].__dict__.keys(), row.__dict__.keys())
+            self.assertEqual(execute_result.rows[0].as_dict().keys(), row.as_dict().keys())
 
 
 class MongoTest(TestCase):
@@ -6,11 +6,15 @@ import simplejson as json
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse
-from django.views.decorators.cache import cache_page
 
 from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder
+from common.utils.permission import superuser_required
 from sql.engines import get_engine
+from sql.engines.pool import pool_stats as get_pool_stats
+from sql.utils.replication import replication_lag as get_replication_lag, lag_history
+from sql.utils.schema_metadata import get_resource
+from sql.utils.ssh_tunnel import tunnel_stats
 from sql.plugins.schemasync import SchemaSync
 from .models import Instance, ParamTemplate, ParamHistory
 
@@ -242,10 +246,9 @@ def schemasync(request):
     return HttpResponse(json.dumps(result), content_type='application/json')
 
 
-@cache_page(60 * 5, key_prefix="insRes")
 def instance_resource(request):
     """
-    获取实例内的资源信息，database、schema、table、column
+    获取实例内的资源信息，database、schema、table、column，优先读取元数据缓存
     :param request:
     :return:
     """
@@ -267,17 +270,7 @@ def instance_resource(request):
     result = {'status': 0, 'msg': 'ok', 'data': []}
 
     try:
-        query_engine = get_engine(instance=instance)
-        if resource_type == 'database':
-            resource = query_engine.get_all_databases()
-        elif resource_type == 'schema' and db_name:
-            resource = query_engine.get_all_schemas(db_name=db_name)
-        elif resource_type == 'table' and db_name:
-            resource = query_engine.get_all_tables(db_name=db_name, schema_name=schema_name)
-        elif resource_type == 'column' and db_name and tb_name:
-            resource = query_engine.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name, schema_name=schema_name)
-        else:
-            raise TypeError('不支持的资源类型或者参数不完整！')
+        resource = get_resource(instance, resource_type, db_name=db_name, schema_name=schema_name, tb_name=tb_name)
     except Exception as msg:
         result['status'] = 1
         result['msg'] = str(msg)
@@ -290,6 +283,27 @@ def instance_resource(request):
     return HttpResponse(json.dumps(result), content_type='application/json')
 
 
+@superuser_required
+def pool_stats(request):
+    """获取当前进程的实例连接池、ssh隧道统计信息，用于监控"""
+    result = {'status': 0, 'msg': 'ok', 'data': {'pools': get_pool_stats(), 'tunnels': tunnel_stats()}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+@permission_required('sql.menu_instance_list', raise_exception=True)
+def replication_lag(request):
+    """获取实例当前复制状态和延迟历史，需开启复制状态采集"""
+    instance_id = request.POST.get('instance_id')
+    try:
+        instance = Instance.objects.get(id=instance_id)
+    except Instance.DoesNotExist:
+        result = {'status': 1, 'msg': '实例不存在', 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    result = {'status': 0, 'msg': 'ok', 'data': {'current': get_replication_lag(instance.id),
+                                                 'history': lag_history(instance.id)}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
 def describe(request):
     """获取表结构"""
     instance_name = request.POST.get('instance_name')
@@ -306,7 +320,7 @@ def describe(request):
     try:
         query_engine = get_engine(instance=instance)
         query_result = query_engine.describe_table(db_name, tb_name, schema_name=schema_name)
-        result['data'] = query_result.__dict__
+        result['data'] = query_result.as_dict()
     except Exception as msg:
         result['status'] = 1
         result['msg'] = str(msg)
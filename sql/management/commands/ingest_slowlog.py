@@ -0,0 +1,24 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from sql.models import Instance
+from sql.utils.slowlog_ingest import ingest
+
+
+class Command(BaseCommand):
+    help = '增量采集慢日志文件，写入慢查询分析表，可通过crontab定期执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instance', required=True, help='实例名称，需与Archery实例配置一致')
+        parser.add_argument('--file', required=True, help='慢日志文件路径')
+
+    def handle(self, *args, **options):
+        try:
+            instance = Instance.objects.get(instance_name=options['instance'])
+        except Instance.DoesNotExist:
+            raise CommandError(f'实例{options["instance"]}不存在')
+        try:
+            written = ingest(instance, options['file'])
+        except FileNotFoundError:
+            raise CommandError(f'慢日志文件{options["file"]}不存在')
+        self.stdout.write(f'写入慢查询明细{written}条')
@@ -0,0 +1,22 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from sql.utils import slow_query_history
+
+
+class Command(BaseCommand):
+    help = '维护慢日志明细表：增加分区、清理过期数据、压缩历史明细，可通过crontab每天执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--init-partitions', action='store_true',
+                            help='将明细表转换为按月分区的分区表，需要复制全表，建议在业务低峰执行')
+
+    def handle(self, *args, **options):
+        if options['init_partitions']:
+            if slow_query_history.is_partitioned():
+                self.stdout.write('明细表已经是分区表')
+            else:
+                slow_query_history.init_partitions()
+                self.stdout.write('明细表已转换为分区表')
+        slow_query_history.maintain()
+        self.stdout.write('维护完成')
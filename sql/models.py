@@ -132,6 +132,8 @@ class Instance(models.Model):
     resource_group = models.ManyToManyField(ResourceGroup, verbose_name='资源组', blank=True)
     instance_tag = models.ManyToManyField(InstanceTag, verbose_name='实例标签', blank=True)
     tunnel = models.ForeignKey(Tunnel, blank=True, null=True, on_delete=models.CASCADE, default=None)
+    query_cache_ttl = models.IntegerField('查询结果缓存时间', null=True, blank=True,
+                                          help_text='单位秒，为空使用系统配置QUERY_RESULT_CACHE_TTL，0不缓存')
     create_time = models.DateTimeField('创建时间', auto_now_add=True)
     update_time = models.DateTimeField('更新时间', auto_now=True)
 
@@ -400,6 +402,7 @@ class QueryLog(models.Model):
     masking = models.BooleanField('查询结果是否正常脱敏', choices=((False, '否'), (True, '是'),), default=False)
     favorite = models.BooleanField('是否收藏', choices=((False, '否'), (True, '是'),), default=False)
     alias = models.CharField('语句标识', max_length=64, default='', blank=True)
+    cache_hit = models.BooleanField('是否命中结果缓存', choices=((False, '否'), (True, '是'),), default=False)
     create_time = models.DateTimeField('操作时间', auto_now_add=True)
     sys_time = models.DateTimeField(auto_now=True)
 
@@ -749,6 +752,7 @@ class SlowQueryHistory(models.Model):
     SlowQueryHistory
     """
     hostname_max = models.CharField(max_length=64, null=False)
+    instance = models.ForeignKey(Instance, db_constraint=False, null=True, blank=True, on_delete=models.DO_NOTHING)
     client_max = models.CharField(max_length=64, null=True)
     user_max = models.CharField(max_length=64, null=False)
     db_max = models.CharField(max_length=64, null=True, default=None)
@@ -850,6 +854,74 @@ class SlowQueryHistory(models.Model):
         managed = False
         db_table = 'mysql_slow_query_review_history'
         unique_together = ('checksum', 'ts_min', 'ts_max')
-        index_together = ('hostname_max', 'ts_min')
+        index_together = (('hostname_max', 'ts_min'), ('instance', 'ts_min'))
         verbose_name = u'慢日志明细'
         verbose_name_plural = u'慢日志明细'
+
+
+class QueryLogRollup(models.Model):
+    """
+    查询日志按日、用户、数据库汇总，用于dashboard
+    """
+    stat_date = models.DateField('统计日期')
+    user_display = models.CharField('操作人中文名', max_length=50, default='')
+    db_name = models.CharField('数据库名称', max_length=64, default='')
+    query_count = models.BigIntegerField('检索次数', default=0)
+    effect_row = models.BigIntegerField('检索行数', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'query_log_rollup'
+        unique_together = ('stat_date', 'user_display', 'db_name')
+        verbose_name = u'查询日志汇总'
+        verbose_name_plural = u'查询日志汇总'
+
+
+class SlowQueryRollup(models.Model):
+    """
+    慢日志按小时、数据库、用户汇总，用于dashboard
+    """
+    stat_hour = models.DateTimeField('统计小时')
+    db_max = models.CharField(max_length=64, default='')
+    user_max = models.CharField(max_length=64, default='')
+    ts_cnt = models.FloatField('执行次数', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'mysql_slow_query_rollup'
+        unique_together = ('stat_hour', 'db_max', 'user_max')
+        verbose_name = u'慢日志汇总'
+        verbose_name_plural = u'慢日志汇总'
+
+
+class RollupWatermark(models.Model):
+    """
+    汇总任务的处理进度，记录已汇总的明细表最大ID
+    """
+    name = models.CharField('明细表', max_length=64, unique=True)
+    last_id = models.BigIntegerField('已汇总的最大ID', default=0)
+    update_time = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = 'rollup_watermark'
+        verbose_name = u'汇总进度'
+        verbose_name_plural = u'汇总进度'
+
+
+class SlowLogCheckpoint(models.Model):
+    """
+    慢日志文件的读取位置，用于增量读取
+    """
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    file_path = models.CharField('慢日志文件', max_length=255)
+    inode = models.BigIntegerField('文件inode', default=0)
+    offset = models.BigIntegerField('已处理的位置', default=0)
+    update_time = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = 'slow_log_checkpoint'
+        unique_together = ('instance', 'file_path')
+        verbose_name = u'慢日志读取位置'
+        verbose_name_plural = u'慢日志读取位置'
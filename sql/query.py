@@ -1,21 +1,22 @@
 # -*- coding: UTF-8 -*-
-import datetime
 import logging
 import re
-import time
 import traceback
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
-from django.db import connection, close_old_connections
-from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from common.config import SysConfig
+from common.utils import columnar_json
 from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
 from common.utils.timer import FuncTimer
 from sql.query_privileges import query_priv_check
+from sql.utils import query_cache, query_job
+from sql.utils.query_log import save as save_query_log
+from sql.utils.replication import seconds_behind_master as get_seconds_behind_master
 from sql.utils.resource_group import user_instances
-from sql.utils.tasks import add_kill_conn_schedule, del_schedule
+from sql.utils.search import search as search_list, count as search_count
+from sql.utils import query_watchdog
 from .models import QueryLog, Instance
 from sql.engines import get_engine
 
@@ -35,6 +36,12 @@ def query(request):
     tb_name = request.POST.get('tb_name')
     limit_num = int(request.POST.get('limit_num', 0))
     schema_name = request.POST.get('schema_name', None)
+    # 流式返回结果，JSON Lines格式，适用于大结果集
+    stream = request.POST.get('stream') == 'true'
+    # 异步查询，返回作业ID，通过轮询接口获取执行状态和结果
+    async_query = request.POST.get('async') == 'true'
+    # 返回格式，columns为按列返回，序列化更快，适用于大结果集
+    response_format = request.POST.get('format')
     user = request.user
 
     result = {'status': 0, 'msg': 'ok', 'data': {}}
@@ -83,26 +90,62 @@ def query(request):
         # 对查询sql增加limit限制或者改写语句
         sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
 
+        # 查询结果缓存，命中时不再执行查询
+        use_cache = not stream and query_cache.cacheable(instance, sql_content)
+        if use_cache:
+            with FuncTimer() as t:
+                cached_data = query_cache.get_result(instance, db_name, sql_content, limit_num, priv_check)
+            if cached_data is not None:
+                query_engine.close()
+                cached_data['cache_hit'] = True
+                result['data'] = cached_data
+                save_query_log(QueryLog(
+                    username=user.username,
+                    user_display=user.display,
+                    db_name=db_name,
+                    instance_name=instance.instance_name,
+                    sqllog=sql_content,
+                    effect_row=cached_data['affected_rows'],
+                    cost_time=t.cost,
+                    priv_check=priv_check,
+                    hit_rule=cached_data['mask_rule_hit'],
+                    masking=cached_data['is_masked'],
+                    cache_hit=True
+                ))
+                return _query_response(result, response_format)
+
+        if async_query and not stream:
+            query_engine.close()
+            job_id = query_job.submit(user, instance, db_name, sql_content, limit_num, priv_check,
+                                      schema_name=schema_name, tb_name=tb_name)
+            result['data'] = {'job_id': job_id}
+            return HttpResponse(json.dumps(result), content_type='application/json')
+
+        max_execution_time = int(config.get('max_execution_time', 60))
+        if stream:
+            # 连接在开始输出时才获取，响应未输出就被关闭时不会占用连接和看门狗登记
+            stream_result = _query_stream(query_engine, user, instance, db_name, sql_content, limit_num, priv_check,
+                                          max_execution_time,
+                                          schema_name=schema_name,
+                                          tb_name=tb_name)
+            return StreamingHttpResponse(stream_result, content_type='application/x-ndjson')
         # 先获取查询连接，用于后面查询复用连接以及终止会话
         query_engine.get_connection(db_name=db_name)
         thread_id = query_engine.thread_id
-        max_execution_time = int(config.get('max_execution_time', 60))
-        # 执行查询语句，并增加一个定时终止语句的schedule，timeout=max_execution_time
-        if thread_id:
-            schedule_name = f'query-{time.time()}'
-            run_date = (datetime.datetime.now() + datetime.timedelta(seconds=max_execution_time))
-            add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
-        with FuncTimer() as t:
-            # 获取主从延迟信息
-            seconds_behind_master = query_engine.seconds_behind_master
-            query_result = query_engine.query(db_name, sql_content, limit_num,
-                                              schema_name=schema_name,
-                                              tb_name=tb_name,
-                                              max_execution_time=max_execution_time * 1000)
-        query_result.query_time = t.cost
-        # 返回查询结果后删除schedule
-        if thread_id:
-            del_schedule(schedule_name)
+        # 执行查询语句，并登记到看门狗，超过max_execution_time后终止会话
+        watchdog_token = query_watchdog.register(instance.id, thread_id, max_execution_time) if thread_id else None
+        try:
+            # 获取主从延迟信息，不计入查询耗时
+            seconds_behind_master = get_seconds_behind_master(query_engine, instance)
+            with FuncTimer() as t:
+                query_result = query_engine.query(db_name, sql_content, limit_num,
+                                                  schema_name=schema_name,
+                                                  tb_name=tb_name,
+                                                  max_execution_time=max_execution_time * 1000)
+            query_result.query_time = t.cost
+        finally:
+            # 返回查询结果后注销，避免连接复用后被误终止
+            query_watchdog.unregister(watchdog_token)
 
         # 查询异常
         if query_result.error:
@@ -124,10 +167,11 @@ def query(request):
                     else:
                         logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{masking_result.error}')
                         query_result.error = None
-                        result['data'] = query_result.__dict__
+                        result['data'] = query_result.as_dict()
+                        use_cache = False
                 # 正常脱敏
                 else:
-                    result['data'] = masking_result.__dict__
+                    result['data'] = masking_result.as_dict()
             except Exception as msg:
                 # 抛出未定义异常，并且开启query_check，直接返回异常，禁止执行
                 if config.get('query_check'):
@@ -137,14 +181,24 @@ def query(request):
                 else:
                     logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{msg}')
                     query_result.error = None
-                    result['data'] = query_result.__dict__
+                    result['data'] = query_result.as_dict()
+                    use_cache = False
         # 无需脱敏的语句
         else:
-            result['data'] = query_result.__dict__
+            result['data'] = query_result.as_dict()
 
         # 仅将成功的查询语句记录存入数据库
         if not query_result.error:
+            # 缓存脱敏后的结果，脱敏异常放行的结果不缓存
+            if use_cache and result['status'] == 0:
+                query_cache.set_result(instance, db_name, sql_content, limit_num, priv_check, dict(result['data']))
+            result['data']['cache_hit'] = False
             result['data']['seconds_behind_master'] = seconds_behind_master
+            # 与数据库的交互次数
+            round_trips = getattr(query_engine, 'round_trips', None)
+            if isinstance(round_trips, dict):
+                result['data']['round_trips'] = round_trips
+                logger.debug(f'查询语句：{sql_content}，数据库交互次数：{round_trips}')
             if int(limit_num) == 0:
                 limit_num = int(query_result.affected_rows)
             else:
@@ -159,18 +213,23 @@ def query(request):
                 cost_time=query_result.query_time,
                 priv_check=priv_check,
                 hit_rule=query_result.mask_rule_hit,
-                masking=query_result.is_masked
+                masking=query_result.is_masked,
+                cache_hit=False
             )
-            # 防止查询超时
-            if connection.connection and not connection.is_usable():
-                close_old_connections()
-            query_log.save()
+            save_query_log(query_log)
     except Exception as e:
         logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
         result['status'] = 1
         result['msg'] = f'查询异常报错，错误信息：{e}'
         return HttpResponse(json.dumps(result), content_type='application/json')
     # 返回查询结果
+    return _query_response(result, response_format)
+
+
+def _query_response(result, response_format=None):
+    """序列化查询结果，response_format为columns时返回按列的格式"""
+    if response_format == 'columns':
+        return HttpResponse(columnar_json.dumps(result), content_type='application/json')
     try:
         return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
                             content_type='application/json')
@@ -180,6 +239,144 @@ def query(request):
                             content_type='application/json')
 
 
+def _query_stream(query_engine, user, instance, db_name, sql_content, limit_num, priv_check, max_execution_time,
+                  **kwargs):
+    """
+    流式执行查询并逐批输出结果，每行一个JSON对象：
+    首行为列信息{"column_list": [], "seconds_behind_master": n}，中间每行为一批数据{"rows": []}，
+    末行为执行结果{"status": 0, "msg": "ok", "data": {...}}，异常时为{"status": 1, "msg": "错误信息"}
+    获取连接、登记看门狗都在生成器内执行，客户端断开时StreamingHttpResponse.close()关闭生成器，由finally释放
+    """
+    config = SysConfig()
+    batch_size = int(config.get('query_stream_batch_size', 1000))
+    effect_row = 0
+    mask_rule_hit = False
+    is_masked = False
+    error = None
+    watchdog_token = None
+    stream = resultsets = None
+    try:
+        # 先获取查询连接，用于后面查询复用连接以及终止会话，超过max_execution_time后由看门狗终止
+        query_engine.get_connection(db_name=db_name)
+        if query_engine.thread_id:
+            watchdog_token = query_watchdog.register(instance.id, query_engine.thread_id, max_execution_time)
+        seconds_behind_master = get_seconds_behind_master(query_engine, instance)
+        with FuncTimer() as t:
+            stream = resultsets = query_engine.query_stream(db_name, sql_content, limit_num, batch_size=batch_size,
+                                                            max_execution_time=max_execution_time * 1000, **kwargs)
+            # 数据脱敏，关闭query_check时忽略脱敏异常，返回未脱敏数据
+            if config.get('data_masking'):
+                resultsets = query_engine.query_masking_stream(db_name, sql_content, stream,
+                                                               ignore_error=not config.get('query_check'))
+            header = False
+            for resultset in resultsets:
+                if resultset.error:
+                    error = resultset.error
+                    break
+                if not header:
+                    header = True
+                    yield _json_line({'column_list': resultset.column_list,
+                                      'seconds_behind_master': seconds_behind_master})
+                if resultset.rows:
+                    yield _json_line({'rows': resultset.rows})
+                effect_row += len(resultset.rows)
+                mask_rule_hit = mask_rule_hit or resultset.mask_rule_hit
+                is_masked = is_masked or resultset.is_masked
+    except Exception as e:
+        logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
+        error = f'查询异常报错，错误信息：{e}'
+    finally:
+        # 注销看门狗后再归还连接，避免连接复用后被误终止；提前结束时先关闭引擎的生成器，结束未读完的结果集
+        query_watchdog.unregister(watchdog_token)
+        for generator in (resultsets, stream):
+            if hasattr(generator, 'close'):
+                generator.close()
+        query_engine.close()
+
+    if error:
+        yield _json_line({'status': 1, 'msg': error})
+        return
+    data = {'affected_rows': effect_row, 'query_time': t.cost, 'mask_rule_hit': mask_rule_hit, 'is_masked': is_masked}
+    if isinstance(getattr(query_engine, 'round_trips', None), dict):
+        data['round_trips'] = query_engine.round_trips
+    yield _json_line({'status': 0, 'msg': 'ok', 'data': data})
+    # 仅将成功的查询语句记录存入数据库
+    save_query_log(QueryLog(
+        username=user.username,
+        user_display=user.display,
+        db_name=db_name,
+        instance_name=instance.instance_name,
+        sqllog=sql_content,
+        effect_row=effect_row,
+        cost_time=t.cost,
+        priv_check=priv_check,
+        hit_rule=mask_rule_hit,
+        masking=is_masked
+    ))
+
+
+def _json_line(data):
+    """序列化为JSON Lines的一行"""
+    try:
+        return json.dumps(data, cls=ExtendJSONEncoderFTime, bigint_as_string=True) + '\n'
+    except UnicodeDecodeError:
+        return json.dumps(data, default=str, bigint_as_string=True, encoding='latin1') + '\n'
+
+
+def _user_job(request):
+    """获取当前用户的异步查询作业，仅提交人和管理员可以访问"""
+    job = query_job.get_job(request.POST.get('job_id', ''))
+    if job is None or (job['username'] != request.user.username and not request.user.is_superuser):
+        return None
+    return job
+
+
+@permission_required('sql.query_submit', raise_exception=True)
+def job_status(request):
+    """获取异步查询作业状态"""
+    job = _user_job(request)
+    if job is None:
+        result = {'status': 1, 'msg': '查询作业不存在或已过期', 'data': {}}
+    else:
+        job.pop('sql', None)
+        result = {'status': 0, 'msg': 'ok', 'data': job}
+    return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
+                        content_type='application/json')
+
+
+@permission_required('sql.query_submit', raise_exception=True)
+def job_rows(request):
+    """分页获取异步查询作业的结果"""
+    offset = request.POST.get('offset', '0')
+    limit = request.POST.get('limit', str(query_job.PAGE_SIZE))
+    job = _user_job(request)
+    if not (offset.isdigit() and limit.isdigit()):
+        result = {'status': 1, 'msg': 'offset、limit必须为非负整数', 'data': {}}
+    elif job is None:
+        result = {'status': 1, 'msg': '查询作业不存在或已过期', 'data': {}}
+    elif job['status'] != 'finished':
+        result = {'status': 1, 'msg': f'查询作业未完成，当前状态：{job["status"]}', 'data': {}}
+    else:
+        result = {'status': 0, 'msg': 'ok', 'data': {
+            'column_list': job['column_list'],
+            'total': job['affected_rows'],
+            'rows': query_job.get_rows(job['job_id'], int(offset), int(limit))}}
+    return _query_response(result, request.POST.get('format'))
+
+
+@permission_required('sql.query_submit', raise_exception=True)
+def job_cancel(request):
+    """终止异步查询作业"""
+    job = _user_job(request)
+    if job is None:
+        result = {'status': 1, 'msg': '查询作业不存在或已过期', 'data': {}}
+    elif not query_job.cancel(job['job_id']):
+        result = {'status': 1, 'msg': f'查询作业已结束，当前状态：{job["status"]}', 'data': {}}
+    else:
+        result = {'status': 0, 'msg': 'ok', 'data': {}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
 @permission_required('sql.menu_sqlquery', raise_exception=True)
 def querylog(request):
     """
@@ -213,15 +410,13 @@ def querylog(request):
     sql_log = QueryLog.objects.filter(**filter_dict)
 
     # 过滤搜索信息
-    sql_log = sql_log.filter(Q(sqllog__icontains=search) |
-                             Q(user_display__icontains=search) |
-                             Q(alias__icontains=search))
+    sql_log = search_list(sql_log, ['sqllog', 'user_display', 'alias'], search)
 
-    sql_log_count = sql_log.count()
+    sql_log_count = search_count(sql_log)
     sql_log_list = sql_log.order_by('-id')[offset:limit].values(
         "id", "instance_name", "db_name", "sqllog",
         "effect_row", "cost_time", "user_display", "favorite", "alias",
-        "create_time")
+        "cache_hit", "create_time")
     # QuerySet 序列化
     rows = [row for row in sql_log_list]
     result = {"total": sql_log_count, "rows": rows}
@@ -246,7 +441,7 @@ def favorite(request):
 
 
 def kill_query_conn(instance_id, thread_id):
-    """终止查询会话，用于schedule调用"""
+    """终止查询会话"""
     instance = Instance.objects.get(pk=instance_id)
     query_engine = get_engine(instance)
     query_engine.kill_connection(thread_id)
@@ -12,8 +12,11 @@ import traceback
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
@@ -26,11 +29,15 @@ from sql.engines.goinception import GoInceptionEngine
 from sql.models import QueryPrivilegesApply, QueryPrivileges, Instance, ResourceGroup
 from sql.notify import notify_for_audit
 from sql.utils.resource_group import user_groups, user_instances
+from sql.utils.query_tree import cached_parse
 from sql.utils.workflow_audit import Audit
 from sql.utils.sql_utils import extract_tables
 
 logger = logging.getLogger('default')
 
+# 权限快照最长缓存时间，单位秒
+PRIV_CACHE_TIMEOUT = 3600
+
 __author__ = 'hhyo'
 
 
@@ -404,8 +411,13 @@ def _table_ref(sql_content, instance, db_name):
     :return:
     """
     engine = GoInceptionEngine()
-    query_tree = engine.query_print(instance=instance, db_name=db_name, sql=sql_content).get('query_tree')
-    return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
+
+    def table_ref():
+        query_tree = engine.query_print(instance=instance, db_name=db_name, sql=sql_content).get('query_tree')
+        return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
+
+    # 按语句哈希缓存解析结果，相同语句不再请求goInception
+    return cached_parse('table_ref', instance, db_name, sql_content, table_ref)
 
 
 def _db_priv(user, instance, db_name):
@@ -423,6 +435,8 @@ def _db_priv(user, instance, db_name):
                                                      priv_type=1)
     if user.is_superuser:
         return int(SysConfig().get('admin_query_limit', 5000))
+    elif SysConfig().get('query_priv_cache'):
+        return _user_privileges(user, instance)['db'].get(str(db_name).lower(), False)
     else:
         if user_privileges.exists():
             return user_privileges.first().limit_num
@@ -444,12 +458,67 @@ def _tb_priv(user, instance, db_name, tb_name):
                                                      is_deleted=0, priv_type=2)
     if user.is_superuser:
         return int(SysConfig().get('admin_query_limit', 5000))
+    elif SysConfig().get('query_priv_cache'):
+        return _user_privileges(user, instance)['tb'].get((str(db_name).lower(), str(tb_name).lower()), False)
     else:
         if user_privileges.exists():
             return user_privileges.first().limit_num
     return False
 
 
+def _user_privileges(user, instance):
+    """
+    获取用户在实例上全部有效权限的快照，缓存至最早的权限过期时间，权限变更时失效
+    :return: {'db': {库名: limit_num}, 'tb': {(库名, 表名): limit_num}}，库名、表名为小写
+    """
+    key = _priv_cache_key(user.username, instance.id)
+    try:
+        privileges = cache.get(key)
+    except Exception as m:
+        privileges = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if privileges is not None:
+        return privileges
+
+    privileges = {'db': {}, 'tb': {}}
+    timeout = PRIV_CACHE_TIMEOUT
+    now = datetime.datetime.now()
+    for priv in QueryPrivileges.objects.filter(user_name=user.username, instance=instance, valid_date__gte=now,
+                                               is_deleted=0).order_by('privilege_id').values(
+            'db_name', 'table_name', 'valid_date', 'limit_num', 'priv_type'):
+        if priv['priv_type'] == 1:
+            privileges['db'].setdefault(priv['db_name'].lower(), priv['limit_num'])
+        elif priv['priv_type'] == 2:
+            privileges['tb'].setdefault((priv['db_name'].lower(), priv['table_name'].lower()), priv['limit_num'])
+        # 权限在有效日期当天结束后过期
+        expire_time = datetime.datetime.combine(priv['valid_date'], datetime.time.min) + datetime.timedelta(days=1)
+        timeout = min(timeout, max(int((expire_time - now).total_seconds()), 1))
+    try:
+        cache.set(key, privileges, timeout=timeout)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    return privileges
+
+
+def _priv_cache_key(user_name, instance_id):
+    return f'query_privs:{user_name}:{instance_id}'
+
+
+@receiver(post_save, sender=QueryPrivileges)
+@receiver(post_delete, sender=QueryPrivileges)
+def _invalidate_user_privileges(instance, **kwargs):
+    """权限变更、删除后使用户权限快照失效"""
+    invalidate_user_privileges(instance.user_name, instance.instance_id)
+
+
+def invalidate_user_privileges(user_name, instance_id):
+    """使用户权限快照失效，批量操作不会触发信号，需要手动调用"""
+    try:
+        cache.delete(_priv_cache_key(user_name, instance_id))
+    except Exception as m:
+        logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
+
+
 def _priv_limit(user, instance, db_name, tb_name=None):
     """
     获取用户拥有的查询权限的最小limit限制，用于返回结果集限制
@@ -510,3 +579,4 @@ def _query_apply_audit_call_back(apply_id, workflow_status):
                 limit_num=apply_queryset.limit_num, priv_type=apply_queryset.priv_type) for table_name in
                 apply_queryset.table_list.split(',')]
         QueryPrivileges.objects.bulk_create(insert_list)
+        invalidate_user_privileges(apply_queryset.user_name, apply_queryset.instance_id)
@@ -7,7 +7,6 @@ import simplejson as json
 from django.contrib.auth.decorators import permission_required
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.db.models import Q
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
@@ -20,6 +19,7 @@ from sql.engines.models import ReviewResult, ReviewSet
 from sql.notify import notify_for_audit
 from sql.models import ResourceGroup
 from sql.utils.resource_group import user_groups, user_instances
+from sql.utils.search import search as search_list, count as search_count
 from sql.utils.tasks import add_sql_schedule, del_schedule
 from sql.utils.sql_review import can_timingtask, can_cancel, can_execute, on_correct_time_period, can_view, can_rollback
 from sql.utils.workflow_audit import Audit
@@ -80,11 +80,10 @@ def sql_workflow_list(request):
     # 过滤组合筛选项
     workflow = SqlWorkflow.objects.filter(**filter_dict)
 
-    # 过滤搜索项，模糊检索项包括提交人名称、工单名
-    if search:
-        workflow = workflow.filter(Q(engineer_display__icontains=search) | Q(workflow_name__icontains=search))
+    # 过滤搜索项，模糊检索项包括工单名、提交人名称
+    workflow = search_list(workflow, ['workflow_name', 'engineer_display'], search)
 
-    count = workflow.count()
+    count = search_count(workflow)
     workflow_list = workflow.order_by('-create_time')[offset:limit].values(
         "id", "workflow_name", "engineer_display",
         "status", "is_backup", "create_time",
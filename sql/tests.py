@@ -15,10 +15,12 @@ from sql.binlog import binlog2sql_file
 from sql.engines.models import ResultSet, ReviewSet, ReviewResult
 from sql.notify import notify_for_audit, notify_for_execute, notify_for_binlog2sql
 from sql.utils.execute_sql import execute_callback
+from sql.utils.query_tree import invalidate_query_tree
+from sql.utils import query_job
 from sql.query import kill_query_conn
 from sql.models import Users, Instance, QueryPrivilegesApply, QueryPrivileges, SqlWorkflow, SqlWorkflowContent, \
     ResourceGroup, ParamTemplate, WorkflowAudit, QueryLog, WorkflowLog, WorkflowAuditSetting, \
-    ArchiveConfig
+    ArchiveConfig, SlowQuery, SlowQueryHistory
 
 User = Users
 
@@ -473,6 +475,34 @@ class TestQueryPrivilegesCheck(TestCase):
                                           tb_name='table_name')
         self.assertTrue(r)
 
+    def test_priv_cache(self):
+        """
+        测试开启权限缓存后验证库表权限，权限变更后缓存失效
+        :return:
+        """
+        self.sys_config.set('query_priv_cache', 'true')
+        self.sys_config.get_all_config()
+        sql.query_privileges.invalidate_user_privileges(self.user.username, self.slave.id)
+        self.assertFalse(sql.query_privileges._db_priv(user=self.user, instance=self.slave, db_name=self.db_name))
+        priv = QueryPrivileges.objects.create(user_name=self.user.username,
+                                              instance=self.slave,
+                                              db_name=self.db_name,
+                                              table_name='table_name',
+                                              valid_date=date.today() + timedelta(days=1),
+                                              limit_num=10,
+                                              priv_type=2)
+        r = sql.query_privileges._tb_priv(user=self.user, instance=self.slave, db_name=self.db_name,
+                                          tb_name='TABLE_NAME')
+        self.assertEqual(r, 10)
+        with self.assertNumQueries(0):
+            sql.query_privileges._tb_priv(user=self.user, instance=self.slave, db_name=self.db_name,
+                                          tb_name='table_name')
+        priv.is_deleted = 1
+        priv.save(update_fields=['is_deleted'])
+        r = sql.query_privileges._tb_priv(user=self.user, instance=self.slave, db_name=self.db_name,
+                                          tb_name='table_name')
+        self.assertFalse(r)
+
     @patch('sql.query_privileges._db_priv')
     def test_priv_limit_from_db(self, __db_priv):
         """
@@ -922,6 +952,163 @@ class TestQuery(TransactionTestCase):
         self.assertEqual(r_json['data']['column_list'], ['some'])
         self.assertEqual(r_json['data']['seconds_behind_master'], 100)
 
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def testColumnsFormat(self, _priv_check, _get_engine, _user_instances):
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        q_result = ResultSet(full_sql=some_sql, rows=[(1, 'a'), (2, 'b')], affected_rows=2)
+        q_result.column_list = ['id', 'name']
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query.return_value = q_result
+        _get_engine.return_value.seconds_behind_master = None
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post('/query/', data={'instance_name': self.slave1.instance_name, 'sql_content': some_sql,
+                                    'db_name': 'some_db', 'limit_num': 100, 'format': 'columns'})
+        r_json = r.json()
+        self.assertEqual(r_json['data']['columns'], [[1, 2], ['a', 'b']])
+        self.assertEqual(r_json['data']['column_types'], ['integer', 'string'])
+        self.assertNotIn('rows', r_json['data'])
+
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def testQueryResultCache(self, _priv_check, _get_engine, _user_instances):
+        archer_config = SysConfig()
+        archer_config.set('query_result_cache_ttl', '60')
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        q_result = ResultSet(full_sql=some_sql, rows=[('value',)], affected_rows=1)
+        q_result.column_list = ['some']
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query.return_value = q_result
+        _get_engine.return_value.seconds_behind_master = None
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        data = {'instance_name': self.slave1.instance_name, 'sql_content': some_sql, 'db_name': 'some_db',
+                'limit_num': 100}
+        try:
+            r1 = c.post('/query/', data=data).json()
+            r2 = c.post('/query/', data=data).json()
+            _get_engine.return_value.query.assert_called_once()
+            self.assertFalse(r1['data']['cache_hit'])
+            self.assertTrue(r2['data']['cache_hit'])
+            self.assertEqual(r2['data']['rows'], [['value']])
+            self.assertEqual(QueryLog.objects.filter(cache_hit=True).count(), 1)
+            # 不确定函数不缓存
+            _get_engine.return_value.filter_sql.return_value = 'select now() limit 100;'
+            c.post('/query/', data=data)
+            c.post('/query/', data=data)
+            self.assertEqual(_get_engine.return_value.query.call_count, 3)
+        finally:
+            archer_config.set('query_result_cache_ttl', '0')
+            invalidate_query_tree(self.slave1.id)
+
+    @patch('sql.query.query_watchdog')
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def testStreamQuery(self, _priv_check, _get_engine, _user_instances, _watchdog):
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        engine = _get_engine.return_value
+        engine.query_check.return_value = {'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        engine.filter_sql.return_value = some_sql
+        engine.seconds_behind_master = None
+        engine.thread_id = 123
+        engine.query_stream.return_value = iter([ResultSet(full_sql=some_sql, rows=[(1,), (2,)],
+                                                           column_list=['some'], affected_rows=2)])
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        data = {'instance_name': self.slave1.instance_name, 'sql_content': some_sql, 'db_name': 'some_db',
+                'limit_num': 100, 'stream': 'true'}
+        r = c.post('/query/', data=data)
+        # 开始输出前不占用连接，也不登记看门狗
+        engine.get_connection.assert_not_called()
+        _watchdog.register.assert_not_called()
+        lines = [json.loads(line) for line in b''.join(r.streaming_content).splitlines()]
+        self.assertEqual(lines[0]['column_list'], ['some'])
+        self.assertEqual(lines[1]['rows'], [[1], [2]])
+        self.assertEqual(lines[2]['data']['affected_rows'], 2)
+        _watchdog.register.assert_called_once_with(self.slave1.id, 123, 60)
+        _watchdog.unregister.assert_called_once_with(_watchdog.register.return_value)
+        engine.close.assert_called()
+        # 客户端读取首行后断开，关闭响应时注销看门狗并归还连接
+        _watchdog.reset_mock()
+        engine.reset_mock()
+        engine.query_stream.return_value = iter([ResultSet(full_sql=some_sql, rows=[(1,)], column_list=['some'],
+                                                           affected_rows=1)] * 3)
+        r = c.post('/query/', data=data)
+        next(iter(r.streaming_content))
+        _watchdog.unregister.assert_not_called()
+        r.close()
+        _watchdog.unregister.assert_called_once_with(_watchdog.register.return_value)
+        engine.close.assert_called()
+
+    @patch('sql.utils.query_job.get_engine')
+    @patch('sql.utils.query_job.async_task')
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def testAsyncQuery(self, _priv_check, _get_engine, _user_instances, _async_task, _job_engine):
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post('/query/', data={'instance_name': self.slave1.instance_name, 'sql_content': some_sql,
+                                    'db_name': 'some_db', 'limit_num': 100, 'async': 'true'})
+        job_id = r.json()['data']['job_id']
+        _get_engine.return_value.query.assert_not_called()
+        _async_task.assert_called_once()
+        self.assertEqual(c.post('/query/job/status/', data={'job_id': job_id}).json()['data']['status'], 'pending')
+        # 执行作业
+        q_result = ResultSet(full_sql=some_sql, rows=[(i,) for i in range(1500)], affected_rows=1500)
+        q_result.column_list = ['some']
+        _job_engine.return_value.query.return_value = q_result
+        _job_engine.return_value.thread_id = None
+        _job_engine.return_value.seconds_behind_master = None
+        query_job.execute(job_id)
+        status = c.post('/query/job/status/', data={'job_id': job_id}).json()
+        self.assertEqual(status['data']['status'], 'finished')
+        self.assertEqual(status['data']['pages'], 2)
+        rows = c.post('/query/job/rows/', data={'job_id': job_id, 'offset': 990, 'limit': 20}).json()
+        self.assertEqual(rows['data']['rows'], [[i] for i in range(990, 1010)])
+        self.assertEqual(rows['data']['total'], 1500)
+        # offset、limit必须为非负整数
+        for data in ({'offset': -1}, {'limit': -20}, {'offset': 'a'}):
+            r = c.post('/query/job/rows/', data=dict(data, job_id=job_id)).json()
+            self.assertEqual(r['status'], 1)
+        self.assertEqual(query_job.get_rows(job_id, -10, 20), [])
+        # 已结束的作业无法终止
+        self.assertEqual(c.post('/query/job/cancel/', data={'job_id': job_id}).json()['status'], 1)
+        self.assertEqual(QueryLog.objects.filter(sqllog=some_sql).count(), 1)
+
+    @patch('sql.utils.query_job.get_engine')
+    def testAsyncQueryCancel(self, _job_engine):
+        c = Client()
+        c.force_login(self.u2)
+        with patch('sql.utils.query_job.async_task'):
+            job_id = query_job.submit(self.u2, self.slave1, 'some_db', 'select 1;', 100, True)
+        job = query_job.get_job(job_id)
+        job.update(status='running', thread_id=123)
+        query_job._save(job)
+        self.assertEqual(c.post('/query/job/cancel/', data={'job_id': job_id}).json()['status'], 0)
+        _job_engine.return_value.kill_query.assert_called_once_with(123)
+        self.assertEqual(query_job.get_job(job_id)['status'], 'canceled')
+
     @patch('sql.query.user_instances')
     @patch('sql.query.get_engine')
     @patch('sql.query.query_priv_check')
@@ -1619,6 +1806,49 @@ class TestOptimize(TestCase):
         self.assertListEqual(list(json.loads(r.content)['data'].keys()), ['session_status', 'sqltext'])
 
 
+class TestSlowLog(TestCase):
+    """
+    测试慢日志
+    """
+
+    def setUp(self):
+        self.superuser = User.objects.create(username='super', is_superuser=True)
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.other_ins = Instance.objects.create(instance_name='other_ins', type='slave', db_type='mysql',
+                                                 host='other_host', port=3306, user='ins_user', password='some_str')
+        SlowQuery.objects.create(checksum='ABC', fingerprint='select ?', sample='select 1')
+        for ins, db_name in ((self.ins, 'some_db'), (self.ins, 'other_db'), (self.other_ins, 'some_db')):
+            SlowQueryHistory.objects.create(instance=ins, hostname_max=f'{ins.host}:{ins.port}', user_max='root',
+                                            db_max=db_name, checksum_id='ABC', sample='select 1',
+                                            ts_min=datetime(2020, 1, 1), ts_max=datetime(2020, 1, 1, 0, 1), ts_cnt=1,
+                                            query_time_sum=1, query_time_pct_95=1, lock_time_sum=0)
+        self.client = Client()
+        self.client.force_login(self.superuser)
+        self.data = {'instance_name': 'some_ins', 'StartTime': '2020-01-01', 'EndTime': '2020-01-01',
+                     'limit': 14, 'offset': 0, 'search': ''}
+
+    def tearDown(self):
+        SlowQueryHistory.objects.all().delete()
+        SlowQuery.objects.all().delete()
+        self.ins.delete()
+        self.other_ins.delete()
+        self.superuser.delete()
+
+    def test_slowquery_review(self):
+        """按实例外键过滤"""
+        r = self.client.post('/slowquery/review/', data=self.data)
+        self.assertEqual(json.loads(r.content)['rows'][0]['MySQLTotalExecutionCounts'], 2)
+        r = self.client.post('/slowquery/review/', data={**self.data, 'db_name': 'some_db'})
+        self.assertEqual(json.loads(r.content)['rows'][0]['MySQLTotalExecutionCounts'], 1)
+
+    def test_slowquery_review_history(self):
+        r = self.client.post('/slowquery/review_history/', data={**self.data, 'SQLId': 'ABC'})
+        self.assertEqual(json.loads(r.content)['total'], 2)
+        r = self.client.post('/slowquery/review_history/', data={**self.data, 'db_name': 'other_db', 'search': '1'})
+        self.assertEqual(json.loads(r.content)['total'], 1)
+
+
 class TestSchemaSync(TestCase):
     """
     测试SchemaSync
@@ -44,6 +44,7 @@ urlpatterns = [
     path('workflow/<int:audit_id>/', views.workflowsdetail),
     path('dbaprinciples/', views.dbaprinciples),
     path('dashboard/', dashboard.pyecharts),
+    path('dashboard/chart/', dashboard.chart),
     path('group/', views.group),
     path('grouprelations/<int:group_id>/', views.groupmgmt),
     path('instance/', views.instance),
@@ -102,6 +103,8 @@ urlpatterns = [
     path('instance/schemasync/', instance.schemasync),
     path('instance/instance_resource/', instance.instance_resource),
     path('instance/describetable/', instance.describe),
+    path('instance/pool_stats/', instance.pool_stats),
+    path('instance/replication_lag/', instance.replication_lag),
 
     path('data_dictionary/', views.data_dictionary),
     path('data_dictionary/table_list/', data_dictionary.table_list),
@@ -113,6 +116,9 @@ urlpatterns = [
     path('param/edit/', instance.param_edit),
 
     path('query/', query.query),
+    path('query/job/status/', query.job_status),
+    path('query/job/rows/', query.job_rows),
+    path('query/job/cancel/', query.job_cancel),
     path('query/querylog/', query.querylog),
     path('query/favorite/', query.favorite),
     path('query/explain/', sql.sql_optimize.explain),
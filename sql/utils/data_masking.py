@@ -1,85 +1,276 @@
 # -*- coding:utf-8 -*-
 import logging
 import traceback
+import uuid
+from functools import lru_cache
 
 import sqlparse
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from sqlparse.tokens import Keyword
 
 from common.config import SysConfig
+from sql.engines import get_engine
 from sql.engines.inception import InceptionEngine
 from sql.models import DataMaskingRules, DataMaskingColumns
+from sql.utils.extract_tables import extract_columns
+from sql.utils.query_tree import get_query_tree, cache_version
 import re
 
 logger = logging.getLogger('default')
 
+MASKING_INDEX_KEY = 'data_masking_index'
+MASKING_VERSION_KEY = 'data_masking_version'
+SCHEMA_SNAPSHOT_TTL = 3600
+# 进程内缓存的脱敏配置索引，版本号与缓存中的一致时直接使用
+_masking_index = {'version': None, 'index': None}
 
-# TODO 待优化，没想好
 
 def data_masking(instance, db_name, sql, sql_result):
     """脱敏数据"""
     try:
-        if SysConfig().get('query_check'):
-            # 解析查询语句，禁用部分Inception无法解析关键词
-            p = sqlparse.parse(sql)[0]
-            for token in p.tokens:
-                if token.ttype is Keyword and token.value.upper() in ['UNION', 'UNION ALL']:
-                    logger.warning(f'数据脱敏异常，错误信息：不支持该查询语句脱敏！请联系管理员')
-                    sql_result.error = '不支持该查询语句脱敏！请联系管理员'
-                    sql_result.status = 1
-                    return sql_result
-        # 通过inception获取语法树,并进行解析
-        inception_engine = InceptionEngine()
-        query_tree = inception_engine.query_print(instance=instance, db_name=db_name, sql=sql)
-        # 分析语法树获取命中脱敏规则的列数据
-        table_hit_columns, hit_columns = analyze_query_tree(query_tree, instance)
-        sql_result.mask_rule_hit = True if table_hit_columns or hit_columns else False
+        mask_rule_hit, hit_columns = masking_columns(instance, db_name, sql, sql_result.column_list)
+        sql_result.mask_rule_hit = mask_rule_hit
     except Exception as msg:
         logger.warning(f'数据脱敏异常，错误信息：{traceback.format_exc()}')
         sql_result.error = str(msg)
         sql_result.status = 1
     else:
-        # 存在select * 的查询,遍历column_list,获取命中列的index,添加到hit_columns
-        if table_hit_columns and sql_result.rows:
-            column_list = sql_result.column_list
-            table_hit_column = dict()
-            for column_info in table_hit_columns:
-                table_hit_column[column_info['column_name']] = column_info['rule_type']
-            for index, item in enumerate(column_list):
-                if item in table_hit_column.keys():
-                    hit_columns.append({
-                        "column_name": item,
-                        "index": index,
-                        "rule_type": table_hit_column.get(item)
-                    })
-
         # 对命中规则列hit_columns的数据进行脱敏
-        # 获取全部脱敏规则信息，减少循环查询，提升效率
-        masking_rules = DataMaskingRules.objects.all()
         if hit_columns and sql_result.rows:
-            rows = list(sql_result.rows)
-            for column in hit_columns:
-                index = column['index']
-                for idx, item in enumerate(rows):
-                    rows[idx] = list(item)
-                    rows[idx][index] = regex(masking_rules, column['rule_type'], rows[idx][index])
-                sql_result.rows = rows
+            sql_result.rows = mask_rows(sql_result.rows, hit_columns)
             # 脱敏结果
             sql_result.is_masked = True
     return sql_result
 
 
+def masking_columns(instance, db_name, sql, column_list):
+    """
+    解析查询语句，获取命中脱敏规则的列信息，供结果集整体脱敏和分批脱敏使用
+    :return: (是否命中脱敏规则, 命中规则的列信息列表)
+    """
+    config = SysConfig()
+    # 使用本地SQL解析，不依赖Inception
+    if config.get('data_masking_native'):
+        return native_masking_columns(instance, db_name, sql, column_list)
+    if config.get('query_check'):
+        # 解析查询语句，禁用部分Inception无法解析关键词
+        p = sqlparse.parse(sql)[0]
+        for token in p.tokens:
+            if token.ttype is Keyword and token.value.upper() in ['UNION', 'UNION ALL']:
+                logger.warning(f'数据脱敏异常，错误信息：不支持该查询语句脱敏！请联系管理员')
+                raise Exception('不支持该查询语句脱敏！请联系管理员')
+    # 通过inception获取语法树,并进行解析
+    query_tree = get_query_tree(InceptionEngine(), instance, db_name, sql)
+    # 分析语法树获取命中脱敏规则的列数据
+    table_hit_columns, hit_columns = analyze_query_tree(query_tree, instance)
+    mask_rule_hit = True if table_hit_columns or hit_columns else False
+
+    # 存在select * 的查询,遍历column_list,获取命中列的index,添加到hit_columns
+    if table_hit_columns:
+        table_hit_column = dict()
+        for column_info in table_hit_columns:
+            table_hit_column[column_info['column_name']] = column_info['rule_type']
+        for index, item in enumerate(column_list):
+            if item in table_hit_column.keys():
+                hit_columns.append({
+                    "column_name": item,
+                    "index": index,
+                    "rule_type": table_hit_column.get(item)
+                })
+    return mask_rule_hit, hit_columns
+
+
+def native_masking_columns(instance, db_name, sql, column_list):
+    """使用sqlparse解析查询语句每个输出列对应的源字段，获取命中脱敏规则的列信息"""
+    index = masking_index()
+    # 实例未配置脱敏字段时无需解析
+    if instance.id not in index['instance_rule_types']:
+        return False, []
+    snapshot = {}
+
+    def table_columns(table_schema, table_name):
+        if table_schema not in snapshot:
+            snapshot[table_schema] = schema_snapshot(instance, table_schema)
+        return snapshot[table_schema].get(str(table_name).lower())
+
+    columns = extract_columns(sql, db_name=db_name, table_columns=table_columns)
+    if len(columns) != len(column_list):
+        raise Exception('不支持该查询语句脱敏！请联系管理员')
+    hit_columns = []
+    for idx, column in enumerate(columns):
+        for table_schema, table_name, column_name in column.sources:
+            column_info = index['columns'].get(_table_key(instance.id, table_schema, table_name), {}).get(
+                column_name.lower())
+            if column_info:
+                hit_columns.append({
+                    "instance_name": instance.instance_name,
+                    "table_schema": table_schema,
+                    "table_name": table_name,
+                    "column_name": column_name,
+                    "rule_type": column_info[1],
+                    "is_hit": True,
+                    "index": idx
+                })
+                break
+    return bool(hit_columns), hit_columns
+
+
+def schema_snapshot(instance, table_schema):
+    """
+    获取库中全部表的字段列表{table_name: [column_name]}，表名为小写，用于展开*和确定字段所属表
+    缓存key包含实例缓存版本号，DDL工单执行结束后失效
+    """
+    key = f'schema_snapshot:{instance.id}:{cache_version(instance.id)}:{table_schema}'
+    try:
+        snapshot = cache.get(key)
+    except Exception as m:
+        snapshot = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if snapshot is not None:
+        return snapshot
+    schema = str(table_schema).replace('\\', '\\\\').replace("'", "''")
+    sql = f"""SELECT TABLE_NAME, COLUMN_NAME
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = '{schema}'
+        ORDER BY TABLE_NAME, ORDINAL_POSITION;"""
+    result = get_engine(instance=instance).query('information_schema', sql)
+    if result.error:
+        raise Exception(f'获取表结构失败：{result.error}')
+    snapshot = {}
+    for table_name, column_name in result.rows:
+        snapshot.setdefault(table_name.lower(), []).append(column_name)
+    try:
+        cache.set(key, snapshot, timeout=SCHEMA_SNAPSHOT_TTL)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    return snapshot
+
+
+def mask_rows(rows, hit_columns):
+    """
+    对命中规则列hit_columns的数据进行脱敏，返回脱敏后的rows
+    结果集先按列转置，每个命中列使用预编译的规则一次性处理，最后再统一重组为行
+    """
+    if not rows:
+        return list(rows)
+    rules = compiled_rules()
+    columns = list(zip(*rows))
+    for column in hit_columns:
+        rule = rules.get(column['rule_type'])
+        if rule is None:
+            continue
+        index = column['index']
+        columns[index] = mask_column(columns[index], *rule)
+    return [list(row) for row in zip(*columns)]
+
+
+def compiled_rules():
+    """获取全部脱敏规则并预编译正则，返回{rule_type: (pattern, hide_group)}"""
+    return {rule_type: (_compile(rule_regex), hide_group)
+            for rule_type, (rule_regex, hide_group) in masking_index()['rules'].items()}
+
+
+def masking_index():
+    """
+    获取脱敏配置索引，优先使用进程内缓存，其次是Redis缓存，都失效时从数据库加载
+    columns: {(instance_id, table_schema, table_name): {column_name: (column_name, rule_type)}}，仅包含激活的字段，
+             库名、表名、字段名均转为小写，与数据库默认排序规则下的查询保持一致
+    instance_rule_types: {instance_id: [rule_type]}，实例关联的全部规则类型，供brute_mask使用
+    rules: {rule_type: (rule_regex, hide_group)}
+    """
+    global _masking_index
+    try:
+        version = cache.get(MASKING_VERSION_KEY)
+    except Exception as m:
+        version = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if version is not None and _masking_index['version'] == version:
+        return _masking_index['index']
+
+    index = None
+    if version is not None:
+        try:
+            index = cache.get(MASKING_INDEX_KEY)
+        except Exception as m:
+            logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if index is None or index['version'] != version:
+        version = version or uuid.uuid4().hex
+        index = _load_masking_index(version)
+        try:
+            cache.add(MASKING_VERSION_KEY, version, timeout=None)
+            cache.set(MASKING_INDEX_KEY, index, timeout=None)
+        except Exception as m:
+            logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    _masking_index = {'version': version, 'index': index}
+    return index
+
+
+def _load_masking_index(version):
+    """从数据库加载脱敏配置索引"""
+    columns = {}
+    instance_rule_types = {}
+    for column in DataMaskingColumns.objects.all().values('instance_id', 'table_schema', 'table_name',
+                                                         'column_name', 'rule_type', 'active'):
+        rule_types = instance_rule_types.setdefault(column['instance_id'], [])
+        if column['rule_type'] not in rule_types:
+            rule_types.append(column['rule_type'])
+        if column['active']:
+            key = _table_key(column['instance_id'], column['table_schema'], column['table_name'])
+            columns.setdefault(key, {})[column['column_name'].lower()] = (column['column_name'], column['rule_type'])
+    rules = {rule['rule_type']: (rule['rule_regex'], int(rule['hide_group']))
+             for rule in DataMaskingRules.objects.all().values('rule_type', 'rule_regex', 'hide_group')}
+    return {'version': version, 'columns': columns, 'instance_rule_types': instance_rule_types, 'rules': rules}
+
+
+def _table_key(instance_id, table_schema, table_name):
+    return instance_id, str(table_schema or '').lower(), str(table_name or '').lower()
+
+
+@receiver(post_save, sender=DataMaskingColumns)
+@receiver(post_delete, sender=DataMaskingColumns)
+@receiver(post_save, sender=DataMaskingRules)
+@receiver(post_delete, sender=DataMaskingRules)
+def invalidate_masking_index(**kwargs):
+    """脱敏字段、脱敏规则变更后使索引失效，通过更新版本号通知其他进程"""
+    global _masking_index
+    _masking_index = {'version': None, 'index': None}
+    try:
+        cache.set(MASKING_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        cache.delete(MASKING_INDEX_KEY)
+    except Exception as m:
+        logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
+
+
+def mask_column(values, pattern, hide_group):
+    """对单列数据脱敏"""
+    search = pattern.search
+    result = []
+    for value in values:
+        m = search(str(value))
+        if m is None or not m.lastindex:
+            result.append(value)
+            continue
+        groups = [group or '' for group in m.groups()[:m.lastindex]]
+        if 0 < hide_group <= len(groups):
+            groups[hide_group - 1] = '****'
+        result.append(''.join(groups))
+    return result
+
+
 def analyze_query_tree(query_tree, instance):
     """解析query_tree,获取语句信息,并返回命中脱敏规则的列信息"""
     old_select_list = query_tree.get('select_list', [])
     table_ref = query_tree.get('table_ref', [])
 
-    # 获取全部激活的脱敏字段信息，减少循环查询，提升效率
-    masking_columns = DataMaskingColumns.objects.filter(active=True)
+    # 获取全部激活的脱敏字段索引，不再逐表逐列查询数据库
+    masking_columns = masking_index()['columns']
 
     # 判断语句涉及的表是否存在脱敏字段配置
     hit = False
     for table in table_ref:
-        if masking_columns.filter(instance=instance, table_schema=table['db'], table_name=table['table']).exists():
+        if _table_key(instance.id, table['db'], table['table']) in masking_columns:
             hit = True
     # 不存在脱敏字段则直接跳过规则解析
     if not hit:
@@ -194,8 +385,8 @@ def analyze_query_tree(query_tree, instance):
 
 def hit_column(masking_columns, instance, table_schema, table_name, column_name):
     """判断字段是否命中脱敏规则,如果命中则返回脱敏的规则id和规则类型"""
-    column_info = masking_columns.filter(instance=instance, table_schema=table_schema,
-                                         table_name=table_name, column_name=column_name)
+    column_info = masking_columns.get(_table_key(instance.id, table_schema, table_name), {}).get(
+        str(column_name or '').lower())
 
     hit_column_info = {
         "instance_name": instance.instance_name,
@@ -208,7 +399,7 @@ def hit_column(masking_columns, instance, table_schema, table_name, column_name)
 
     # 命中规则
     if column_info:
-        hit_column_info['rule_type'] = column_info[0].rule_type
+        hit_column_info['rule_type'] = column_info[1]
         hit_column_info['is_hit'] = True
 
     return hit_column_info
@@ -216,18 +407,18 @@ def hit_column(masking_columns, instance, table_schema, table_name, column_name)
 
 def hit_table(masking_columns, instance, table_schema, table_name):
     """获取表中所有命中脱敏规则的字段信息，用于select *的查询"""
-    columns_info = masking_columns.filter(instance=instance, table_schema=table_schema, table_name=table_name)
+    columns_info = masking_columns.get(_table_key(instance.id, table_schema, table_name), {})
 
     # 命中规则列
     hit_columns_info = []
-    for column in columns_info:
+    for column_name, rule_type in columns_info.values():
         hit_columns_info.append({
             "instance_name": instance.instance_name,
             "table_schema": table_schema,
             "table_name": table_name,
             "is_hit": True,
-            "column_name": column.column_name,
-            "rule_type": column.rule_type
+            "column_name": column_name,
+            "rule_type": rule_type
         })
     return hit_columns_info
 
@@ -236,26 +427,22 @@ def regex(masking_rules, rule_type, value):
     """利用正则表达式脱敏数据"""
     rules_info = masking_rules.get(rule_type=rule_type)
     if rules_info:
-        rule_regex = rules_info.rule_regex
-        hide_group = rules_info.hide_group
-        # 正则匹配必须分组，隐藏的组会使用****代替
-        try:
-            p = re.compile(rule_regex, re.I)
-            m = p.search(str(value))
-            masking_str = ''
-            for i in range(m.lastindex):
-                if i == hide_group - 1:
-                    group = '****'
-                else:
-                    group = m.group(i + 1)
-                masking_str = masking_str + group
-            return masking_str
-        except AttributeError:
-            return value
+        return _mask_value(_compile(rules_info.rule_regex), rules_info.hide_group, value)
     else:
         return value
 
 
+@lru_cache(maxsize=128)
+def _compile(rule_regex):
+    """编译脱敏规则正则，规则数量很少，跨请求缓存"""
+    return re.compile(rule_regex, re.I)
+
+
+def _mask_value(pattern, hide_group, value):
+    """正则匹配必须分组，隐藏的组会使用****代替，未匹配的数据原样返回"""
+    return mask_column((value,), pattern, hide_group)[0]
+
+
 def brute_mask(instance, sql_result):
     """输入的是一个resultset 
     sql_result.full_sql
@@ -264,14 +451,16 @@ def brute_mask(instance, sql_result):
     返回同样结构的sql_result , error 中写入脱敏时产生的错误.
     """
     # 读取所有关联实例的脱敏规则，去重后应用到结果集，不会按照具体配置的字段匹配
-    rule_types = DataMaskingColumns.objects.filter(instance=instance).values_list('rule_type', flat=True).distinct()
-    masking_rules = DataMaskingRules.objects.filter(rule_type__in=rule_types)
-    for reg in masking_rules:
-        compiled_r = re.compile(reg.rule_regex, re.I)
+    index = masking_index()
+    rule_types = index['instance_rule_types'].get(instance.id, [])
+    for rule_type, (rule_regex, hide_group) in index['rules'].items():
+        if rule_type not in rule_types:
+            continue
+        compiled_r = _compile(rule_regex)
         replace_pattern = r""
         rows = list(sql_result.rows)
         for i in range(1, compiled_r.groups + 1):
-            if i == int(reg.hide_group):
+            if i == hide_group:
                 replace_pattern += r"****"
             else:
                 replace_pattern += r"\{}".format(i)
@@ -1,11 +1,13 @@
 # -*- coding: UTF-8 -*-
 
 from django.db import close_old_connections, connection, transaction
-from django_redis import get_redis_connection
+from django_q.tasks import async_task
 from common.utils.const import WorkflowDict
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.models import SqlWorkflow
 from sql.notify import notify_for_execute
+from sql.utils.query_tree import invalidate_query_tree
+from sql.utils.schema_metadata import cache_interval, invalidate as invalidate_schema_metadata
 from sql.utils.workflow_audit import Audit
 from sql.engines import get_engine
 
@@ -84,11 +86,15 @@ def execute_callback(task):
                   operator_display='系统'
                   )
 
-    # DDL工单结束后清空实例资源缓存
+    # DDL工单结束后更新实例资源缓存和语法树缓存
     if workflow.syntax_type == 1:
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match='*insRes*', count=2000):
-            r.delete(key)
+        invalidate_query_tree(workflow.instance_id)
+        # 开启元数据预取时在后台刷新工单对应库的元数据，否则使该实例的资源缓存失效
+        if cache_interval() > 0:
+            async_task('sql.utils.schema_metadata.refresh', workflow.instance_id, workflow.db_name,
+                       task_name=f'schema-metadata-{workflow.instance_id}')
+        else:
+            invalidate_schema_metadata(workflow.instance_id)
 
     # 发送消息
     notify_for_execute(workflow)
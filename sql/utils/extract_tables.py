@@ -31,8 +31,8 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import sqlparse
 from collections import namedtuple
-from sqlparse.sql import IdentifierList, Identifier, Function
-from sqlparse.tokens import Keyword, DML, Punctuation
+from sqlparse.sql import IdentifierList, Identifier, Function, Parenthesis, Where, Comment
+from sqlparse.tokens import Keyword, DML, Punctuation, Name, String, Wildcard, Comment as TComment
 
 TableReference = namedtuple(
     "TableReference", ["schema", "name", "alias", "is_function"]
@@ -182,3 +182,266 @@ def extract_tables(sql):
     identifiers = extract_table_identifiers(stream, allow_functions=not insert_stmt)
     # In the case 'sche.<cursor>', we get an empty TableReference; remove that
     return tuple(i for i in identifiers if i.name)
+
+
+ColumnReference = namedtuple("ColumnReference", ["name", "sources"])
+
+# 表引用之后结束FROM子句的关键字
+FROM_END_KEYWORDS = ("GROUP", "ORDER", "LIMIT", "HAVING", "WINDOW", "FOR", "LOCK", "PROCEDURE", "INTO")
+SET_OPERATORS = ("UNION", "EXCEPT", "INTERSECT", "MINUS")
+SELECT_MODIFIERS = ("ALL", "DISTINCT", "DISTINCTROW", "HIGH_PRIORITY", "STRAIGHT_JOIN", "SQL_SMALL_RESULT",
+                    "SQL_BIG_RESULT", "SQL_BUFFER_RESULT", "SQL_CACHE", "SQL_NO_CACHE", "SQL_CALC_FOUND_ROWS")
+# 表达式中的语法关键字，其他关键字（如user、date、status）可能是字段名
+SYNTAX_KEYWORDS = ("AS", "CASE", "WHEN", "THEN", "ELSE", "END", "NULL", "DISTINCT", "ALL", "AND", "OR", "NOT",
+                   "XOR", "IN", "IS", "LIKE", "REGEXP", "RLIKE", "BETWEEN", "EXISTS", "ANY", "SOME", "ASC", "DESC",
+                   "TRUE", "FALSE", "INTERVAL", "BINARY", "SEPARATOR", "DIV", "MOD", "USING", "ON")
+
+
+class ColumnResolveError(ValueError):
+    """无法解析语句输出列的来源"""
+
+
+def extract_columns(sql, db_name=None, table_columns=None):
+    """
+    解析SELECT语句，获取每个输出列对应的源字段，支持别名、t.*、子查询、UNION和函数
+    :param sql: 查询语句
+    :param db_name: 默认库名，未指定库名的表使用该库
+    :param table_columns: 获取表字段的函数，入参为(schema, table)，返回按顺序排列的字段名列表，无法获取时返回None，
+                          用于展开*以及多表关联时确定未指定表名的字段，未提供时多表关联的字段会关联到全部表
+    :return: [ColumnReference(name, sources)]，sources为((schema, table, column), ...)，
+             表达式列包含其引用的全部字段，常量列为空
+    """
+    parsed = sqlparse.parse(sql)
+    if not parsed:
+        return []
+    return _ColumnResolver(db_name, table_columns).resolve(_meaningful(parsed[0].tokens))
+
+
+def _meaningful(tokens):
+    return [t for t in tokens if not t.is_whitespace and not isinstance(t, Comment) and t.ttype not in TComment]
+
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in ('`', '"', "'"):
+        return value[1:-1]
+    return value
+
+
+def _name_parts(token):
+    """获取a.b.c格式标识符的各部分，遇到空白、别名或其他结构时结束"""
+    parts = []
+    for t in token.tokens:
+        if t.ttype in (Name, Name.Builtin, String.Symbol, Wildcard):
+            parts.append(_unquote(t.value))
+        elif t.ttype is Punctuation and t.value == '.':
+            continue
+        else:
+            break
+    return parts
+
+
+def _expression_tokens(identifier):
+    """去除标识符中的别名部分"""
+    tokens = list(identifier.tokens)
+    if identifier.get_alias() is None:
+        return tokens
+    for idx, t in enumerate(tokens):
+        if t.ttype is Keyword and t.value.upper() == 'AS':
+            return tokens[:idx]
+    meaningful = _meaningful(tokens)
+    return tokens[:tokens.index(meaningful[-1])] if len(meaningful) > 1 else tokens
+
+
+class _ColumnResolver:
+    def __init__(self, db_name, table_columns):
+        self.db_name = db_name
+        self.table_columns = table_columns
+        # 当前查询的表，{别名: ('table', schema, name) 或者 ('derived', [ColumnReference])}
+        self.tables = {}
+
+    def child(self):
+        return _ColumnResolver(self.db_name, self.table_columns)
+
+    def resolve(self, tokens):
+        """解析查询，多个分支按位置合并来源"""
+        branches = [[]]
+        for token in tokens:
+            if token.ttype is Keyword and token.value.upper().split()[0] in SET_OPERATORS:
+                branches.append([])
+            else:
+                branches[-1].append(token)
+        results = [self.child().select(branch) for branch in branches]
+        columns = results[0]
+        for other in results[1:]:
+            if len(other) != len(columns):
+                raise ColumnResolveError('UNION各分支的列数不一致')
+        return [ColumnReference(column.name, _unique(s for r in results for s in r[idx].sources))
+                for idx, column in enumerate(columns)]
+
+    def select(self, tokens):
+        if not tokens:
+            raise ColumnResolveError('不是有效的查询语句')
+        if isinstance(tokens[0], Parenthesis):
+            return self.child().resolve(_meaningful(tokens[0].tokens[1:-1]))
+        if not (tokens[0].ttype is DML and tokens[0].value.upper() == 'SELECT'):
+            raise ColumnResolveError('仅支持SELECT语句')
+        # 拆分查询列和FROM子句
+        select_tokens = []
+        from_tokens = []
+        target = select_tokens
+        for token in tokens[1:]:
+            if target is select_tokens and token.ttype is Keyword and token.value.upper() == 'FROM':
+                target = from_tokens
+            else:
+                target.append(token)
+        self.parse_from(from_tokens)
+
+        # 按逗号拆分查询列，字段名为关键字时sqlparse不会将其识别为IdentifierList
+        items = [[]]
+        for token in select_tokens:
+            for t in (_meaningful(token.tokens) if isinstance(token, IdentifierList) else [token]):
+                if t.ttype is Punctuation and t.value == ',':
+                    items.append([])
+                elif not items[-1] and len(items) == 1 and t.ttype is Keyword \
+                        and t.value.upper() in SELECT_MODIFIERS:
+                    continue
+                else:
+                    items[-1].append(t)
+        columns = []
+        for item in items:
+            if len(item) == 1:
+                columns.extend(self.select_item(item[0]))
+            elif item:
+                columns.append(ColumnReference(' '.join(str(t) for t in item),
+                                               _unique(s for t in item for s in self.sources(t))))
+        return columns
+
+    def parse_from(self, tokens):
+        """解析FROM子句中的表、关联表以及派生表"""
+        expect_table = True
+        for token in tokens:
+            if isinstance(token, Where):
+                break
+            if token.ttype is Keyword:
+                value = token.value.upper()
+                if value.split()[0] in FROM_END_KEYWORDS or value.split()[0] in SET_OPERATORS:
+                    break
+                expect_table = value.endswith('JOIN')
+            elif token.ttype is Punctuation and token.value == ',':
+                expect_table = True
+            elif expect_table and isinstance(token, IdentifierList):
+                for identifier in token.get_identifiers():
+                    self.add_table(identifier)
+            elif expect_table and isinstance(token, (Identifier, Parenthesis)):
+                self.add_table(token)
+                expect_table = False
+
+    def add_table(self, token):
+        if isinstance(token, Parenthesis):
+            self.tables[None] = ('derived', self.child().resolve(_meaningful(token.tokens[1:-1])))
+            return
+        if not isinstance(token, Identifier):
+            return
+        alias = token.get_alias()
+        first = _meaningful(token.tokens)[0]
+        if isinstance(first, Parenthesis):
+            table = ('derived', self.child().resolve(_meaningful(first.tokens[1:-1])))
+        else:
+            parts = _name_parts(token)
+            if not parts:
+                return
+            schema = parts[-2] if len(parts) > 1 else self.db_name
+            table = ('table', schema, parts[-1])
+            alias = alias or parts[-1]
+        self.tables[_unquote(alias).lower() if alias else None] = table
+
+    def select_item(self, token):
+        """解析单个查询列，*和t.*展开为多个列"""
+        if token.ttype is Wildcard:
+            return [c for table in self.tables.values() for c in self.expand(table)]
+        if isinstance(token, Identifier) and token.is_wildcard():
+            parts = _name_parts(token)
+            return self.expand(self.find_table(parts[:-1]))
+        alias = token.get_alias() if isinstance(token, Identifier) else None
+        parts = _name_parts(token) if isinstance(token, Identifier) else []
+        if alias:
+            name = _unquote(alias)
+        elif parts and len(token.tokens) == 2 * len(parts) - 1:
+            name = parts[-1]
+        else:
+            name = _unquote(str(token))
+        return [ColumnReference(name, _unique(self.sources(token)))]
+
+    def expand(self, table):
+        """展开表的全部字段"""
+        if table[0] == 'derived':
+            return list(table[1])
+        _, schema, name = table
+        columns = self.table_columns(schema, name) if self.table_columns else None
+        if columns is None:
+            raise ColumnResolveError(f'无法获取表{schema}.{name}的字段信息')
+        return [ColumnReference(column, ((schema, name, column),)) for column in columns]
+
+    def find_table(self, qualifier):
+        """根据[库名, ]表名或别名查找表"""
+        if len(qualifier) == 1 and qualifier[0].lower() in self.tables:
+            return self.tables[qualifier[0].lower()]
+        for table in self.tables.values():
+            if table[0] == 'table' and table[2].lower() == qualifier[-1].lower() and (
+                    len(qualifier) == 1 or str(table[1]).lower() == qualifier[-2].lower()):
+                return table
+        raise ColumnResolveError(f'无法识别的表：{".".join(qualifier)}')
+
+    def sources(self, token):
+        """获取表达式引用的全部源字段"""
+        if token.ttype in (Name, Name.Builtin) or (token.ttype is Keyword and token.value.upper() not in SYNTAX_KEYWORDS):
+            return self.column_sources([], _unquote(token.value))
+        if not token.is_group:
+            return []
+        if isinstance(token, (Parenthesis, Identifier)) and is_subselect(token):
+            tokens = _meaningful(token.tokens)
+            if isinstance(token, Parenthesis):
+                tokens = tokens[1:-1]
+            return [s for column in self.child().resolve(tokens) for s in column.sources]
+        if isinstance(token, Identifier):
+            tokens = _expression_tokens(token)
+            first = _meaningful(tokens)[0] if _meaningful(tokens) else None
+            if first is not None and first.ttype in (Name, String.Symbol):
+                parts = _name_parts(token)
+                return self.column_sources(parts[:-1], parts[-1])
+        elif isinstance(token, Function):
+            # 跳过函数名
+            tokens = [t for t in token.tokens if isinstance(t, Parenthesis)]
+        else:
+            tokens = token.tokens
+        return [s for t in tokens for s in self.sources(t)]
+
+    def column_sources(self, qualifier, column):
+        if qualifier:
+            return self.table_column(self.find_table(qualifier), column)
+        if len(self.tables) == 1:
+            return self.table_column(list(self.tables.values())[0], column)
+        # 多表关联时根据字段信息确定所属表，无法获取字段信息的表全部作为候选
+        sources = []
+        for table in self.tables.values():
+            if table[0] == 'derived':
+                sources.extend(self.table_column(table, column))
+                continue
+            columns = self.table_columns(table[1], table[2]) if self.table_columns else None
+            if columns is None or column.lower() in (c.lower() for c in columns):
+                sources.extend(self.table_column(table, column))
+        return sources
+
+    @staticmethod
+    def table_column(table, column):
+        if table[0] == 'derived':
+            return [s for c in table[1] if c.name.lower() == column.lower() for s in c.sources]
+        return [(table[1], table[2], column)]
+
+
+def _unique(sources):
+    result = []
+    for source in sources:
+        if source not in result:
+            result.append(source)
+    return tuple(result)
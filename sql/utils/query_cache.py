@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+"""
+在线查询结果缓存，相同语句重复查询时直接返回缓存的结果（已脱敏）
+key包含实例、库、规范化后的语句、limit、权限校验结果、脱敏配置版本号以及实例缓存版本号，
+结果集pickle后使用zlib压缩存入Redis，超过大小限制的结果集不缓存；
+包含不确定函数、变量以及加锁读的语句不缓存
+缓存时间优先使用实例配置，其次为系统配置query_result_cache_ttl，单位秒，为0或未配置时不缓存
+"""
+import hashlib
+import logging
+import pickle
+import re
+import traceback
+import zlib
+
+import sqlparse
+from django.core.cache import cache
+
+from common.config import SysConfig
+from sql.utils.data_masking import masking_index
+from sql.utils.query_tree import cache_version, normalize_sql
+
+logger = logging.getLogger('default')
+
+# 缓存的结果集压缩后的默认大小上限，单位KB
+DEFAULT_MAX_SIZE = 1024
+
+NON_DETERMINISTIC = re.compile(
+    r'\b(now|sysdate|curdate|curtime|current_date|current_time|current_timestamp|localtime|localtimestamp|'
+    r'utc_date|utc_time|utc_timestamp|unix_timestamp|rand|uuid|uuid_short|connection_id|last_insert_id|'
+    r'found_rows|row_count|user|current_user|session_user|system_user|database|schema|sleep|benchmark|'
+    r'get_lock|release_lock|is_free_lock|is_used_lock|master_pos_wait|nextval|lastval)\s*\(|'
+    r'\bcurrent_(date|time|timestamp|user)\b|@|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|\bfor\s+share\b',
+    re.I)
+
+
+def cache_ttl(instance):
+    """查询结果的缓存时间，实例未单独配置时使用系统配置"""
+    if instance.query_cache_ttl is not None:
+        return instance.query_cache_ttl
+    return int(SysConfig().get('query_result_cache_ttl', 0) or 0)
+
+
+def cacheable(instance, sql):
+    """是否可以缓存，仅缓存不包含不确定函数的select语句"""
+    if cache_ttl(instance) <= 0:
+        return False
+    sql = normalize_sql(sql)
+    if not re.match(r'^select\s', sql, re.I):
+        return False
+    # 去除字符串常量后再判断，避免误判
+    return NON_DETERMINISTIC.search(re.sub(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"", "''", sql)) is None
+
+
+def get_result(instance, db_name, sql, limit_num, priv_check):
+    """读取缓存的查询结果，未命中返回None"""
+    try:
+        data = cache.get(_cache_key(instance, db_name, sql, limit_num, priv_check))
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return None
+    if data is None:
+        return None
+    try:
+        return pickle.loads(zlib.decompress(data))
+    except Exception:
+        logger.error(f"查询结果缓存解析失败：{traceback.format_exc()}")
+        return None
+
+
+def set_result(instance, db_name, sql, limit_num, priv_check, result):
+    """缓存查询结果，压缩后超过大小限制的不缓存，返回是否缓存成功"""
+    try:
+        data = zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        logger.error(f"查询结果缓存序列化失败：{traceback.format_exc()}")
+        return False
+    max_size = int(SysConfig().get('query_result_cache_max_size', DEFAULT_MAX_SIZE) or DEFAULT_MAX_SIZE)
+    if len(data) > max_size * 1024:
+        logger.debug(f'查询结果压缩后{len(data)}字节，超过缓存大小限制，不缓存')
+        return False
+    try:
+        cache.set(_cache_key(instance, db_name, sql, limit_num, priv_check), data, timeout=cache_ttl(instance))
+        return True
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return False
+
+
+def _cache_key(instance, db_name, sql, limit_num, priv_check):
+    """脱敏配置变更、开关脱敏以及实例执行DDL工单后缓存自动失效"""
+    masking = masking_index()['version'] if SysConfig().get('data_masking') else 'off'
+    # 不合并空白字符，避免字符串常量中的空白不同的语句命中同一缓存
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    sql_hash = hashlib.md5(sql.encode('utf-8')).hexdigest()
+    return f'query_result:{instance.id}:{cache_version(instance.id)}:{masking}:' \
+           f'{db_name}:{limit_num}:{int(bool(priv_check))}:{sql_hash}'
@@ -0,0 +1,233 @@
+# -*- coding: UTF-8 -*-
+"""
+异步查询，提交后返回作业ID，由django-q执行查询，页面轮询作业状态、分页获取结果，可随时终止
+作业信息和结果集保存在Redis，结果集按页压缩存储，任意进程都可以读取；
+终止作业时使用记录的thread_id立即执行KILL QUERY，不再等待超时后的定时任务
+"""
+import logging
+import pickle
+import time
+import traceback
+import uuid
+import zlib
+
+from django.core.cache import cache
+from django_q.tasks import async_task
+
+from common.config import SysConfig
+from common.utils.timer import FuncTimer
+from sql.engines import get_engine
+from sql.models import Instance, QueryLog
+from sql.utils.replication import seconds_behind_master as get_seconds_behind_master
+from sql.utils import query_watchdog
+from sql.utils.query_log import save as save_query_log
+
+logger = logging.getLogger('default')
+
+# 作业信息和结果集的保留时间，单位秒
+JOB_TIMEOUT = 3600
+# 结果集每页行数
+PAGE_SIZE = 1000
+
+
+def submit(user, instance, db_name, sql, limit_num, priv_check, **kwargs):
+    """提交异步查询作业，返回作业ID"""
+    job_id = uuid.uuid4().hex
+    job = {
+        'job_id': job_id,
+        'username': user.username,
+        'user_display': user.display,
+        'instance_id': instance.id,
+        'instance_name': instance.instance_name,
+        'db_name': db_name,
+        'sql': sql,
+        'limit_num': limit_num,
+        'priv_check': priv_check,
+        'status': 'pending',
+        'thread_id': None,
+        'error': None,
+        'create_time': int(time.time()),
+    }
+    _save(job)
+    max_execution_time = int(SysConfig().get('max_execution_time', 60))
+    async_task('sql.utils.query_job.execute', job_id, timeout=max_execution_time + 60,
+               task_name=f'query-job-{job_id}', **kwargs)
+    return job_id
+
+
+def execute(job_id, schema_name=None, tb_name=None):
+    """执行查询作业，供django-q调用"""
+    job = get_job(job_id)
+    if job is None or job['status'] != 'pending':
+        return
+    config = SysConfig()
+    max_execution_time = int(config.get('max_execution_time', 60))
+    watchdog_token = None
+    try:
+        instance = Instance.objects.get(id=job['instance_id'])
+        query_engine = get_engine(instance=instance)
+        query_engine.get_connection(db_name=job['db_name'])
+        job.update(status='running', thread_id=query_engine.thread_id)
+        _save(job)
+        # 超时终止查询会话
+        if query_engine.thread_id:
+            watchdog_token = query_watchdog.register(instance.id, query_engine.thread_id, max_execution_time)
+        seconds_behind_master = get_seconds_behind_master(query_engine, instance)
+        with FuncTimer() as t:
+            query_result = query_engine.query(job['db_name'], job['sql'], job['limit_num'],
+                                              schema_name=schema_name,
+                                              tb_name=tb_name,
+                                              max_execution_time=max_execution_time * 1000)
+        query_result.query_time = t.cost
+        if not query_result.error and config.get('data_masking'):
+            query_result = _masking(query_engine, config, job, query_result)
+    except Exception as e:
+        logger.error(f'异步查询异常报错，查询语句：{job["sql"]}\n，错误信息：{traceback.format_exc()}')
+        query_result = None
+        job['error'] = f'查询异常报错，错误信息：{e}'
+    finally:
+        query_watchdog.unregister(watchdog_token)
+
+    if _canceled(job_id):
+        job['status'] = 'canceled'
+        _save(job)
+        return
+    if query_result is None or query_result.error:
+        job['status'] = 'failed'
+        job['error'] = job['error'] or query_result.error
+        _save(job)
+        return
+
+    rows = list(query_result.rows)
+    pages = (len(rows) + PAGE_SIZE - 1) // PAGE_SIZE
+    _save_pages(job_id, rows)
+    limit_num = int(job['limit_num'])
+    effect_row = min(limit_num, int(query_result.affected_rows)) if limit_num else int(query_result.affected_rows)
+    job.update(status='finished',
+               column_list=query_result.column_list,
+               affected_rows=len(rows),
+               pages=pages,
+               query_time=query_result.query_time,
+               mask_time=query_result.mask_time,
+               mask_rule_hit=query_result.mask_rule_hit,
+               is_masked=query_result.is_masked,
+               seconds_behind_master=seconds_behind_master)
+    _save(job)
+    save_query_log(QueryLog(
+        username=job['username'],
+        user_display=job['user_display'],
+        db_name=job['db_name'],
+        instance_name=job['instance_name'],
+        sqllog=job['sql'],
+        effect_row=effect_row,
+        cost_time=query_result.query_time,
+        priv_check=job['priv_check'],
+        hit_rule=query_result.mask_rule_hit,
+        masking=query_result.is_masked
+    ))
+
+
+def get_job(job_id):
+    """获取作业信息，已终止但尚未结束的作业状态为canceled"""
+    try:
+        job = cache.get(_job_key(job_id))
+        if job and job['status'] in ('pending', 'running') and _canceled(job_id):
+            job['status'] = 'canceled'
+        return job
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return None
+
+
+def get_rows(job_id, offset=0, limit=PAGE_SIZE):
+    """分页获取作业的结果集，offset、limit为负数时返回空列表"""
+    if offset < 0 or limit <= 0:
+        return []
+    first, last = offset // PAGE_SIZE, (offset + limit - 1) // PAGE_SIZE
+    keys = [_page_key(job_id, page) for page in range(first, last + 1)]
+    try:
+        pages = cache.get_many(keys)
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return []
+    rows = []
+    for key in keys:
+        if key not in pages:
+            break
+        rows.extend(pickle.loads(zlib.decompress(pages[key])))
+    start = offset - first * PAGE_SIZE
+    return rows[start:start + limit]
+
+
+def cancel(job_id):
+    """终止作业，正在执行的语句使用KILL QUERY立即终止，返回是否终止"""
+    job = get_job(job_id)
+    if job is None or job['status'] not in ('pending', 'running'):
+        return False
+    try:
+        cache.set(_cancel_key(job_id), True, timeout=JOB_TIMEOUT)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return False
+    if job['thread_id']:
+        instance = Instance.objects.get(id=job['instance_id'])
+        get_engine(instance=instance).kill_query(job['thread_id'])
+    return True
+
+
+def _masking(query_engine, config, job, query_result):
+    """数据脱敏，脱敏异常时按照query_check配置禁止返回或者返回未脱敏数据，与同步查询一致"""
+    try:
+        with FuncTimer() as t:
+            masking_result = query_engine.query_masking(job['db_name'], job['sql'], query_result)
+        masking_result.mask_time = t.cost
+        error = masking_result.error
+    except Exception as msg:
+        masking_result, error = None, str(msg)
+    if not error:
+        return masking_result
+    if config.get('query_check'):
+        query_result.error = f'数据脱敏异常：{error}'
+    else:
+        logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{job["sql"]}，错误信息：{error}')
+        query_result.error = None
+    return query_result
+
+
+def _save(job):
+    try:
+        cache.set(_job_key(job['job_id']), job, timeout=JOB_TIMEOUT)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+
+
+def _save_pages(job_id, rows):
+    """结果集按页压缩保存"""
+    pages = {}
+    for i in range(0, len(rows), PAGE_SIZE):
+        data = pickle.dumps(rows[i:i + PAGE_SIZE], protocol=pickle.HIGHEST_PROTOCOL)
+        pages[_page_key(job_id, i // PAGE_SIZE)] = zlib.compress(data)
+    try:
+        cache.set_many(pages, timeout=JOB_TIMEOUT)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+
+
+def _canceled(job_id):
+    try:
+        return bool(cache.get(_cancel_key(job_id)))
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return False
+
+
+def _job_key(job_id):
+    return f'query_job:{job_id}'
+
+
+def _page_key(job_id, page):
+    return f'query_job_rows:{job_id}:{page}'
+
+
+def _cancel_key(job_id):
+    return f'query_job_cancel:{job_id}'
@@ -0,0 +1,160 @@
+# -*- coding: UTF-8 -*-
+"""
+查询日志异步批量写入，系统配置query_log_async开启后生效
+查询日志先放入进程内队列，由后台线程按数量或者时间间隔使用bulk_create批量写入，
+进程正常退出时写入队列中剩余的日志；队列已满、未开启或者批量写入失败时逐条同步写入
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+
+from django.db import connection, close_old_connections
+
+from common.config import SysConfig
+from sql.models import QueryLog
+
+logger = logging.getLogger('default')
+
+BATCH_SIZE = 100
+# 最长写入间隔，单位秒
+FLUSH_INTERVAL = 1
+QUEUE_SIZE = 10000
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+# 后台线程已从队列取出、尚未写入的日志，进程退出时一并写入
+_inflight = []
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_thread = None
+_pid = None
+
+
+def save(query_log):
+    """保存查询日志，query_log为未保存的QueryLog对象"""
+    if SysConfig().get('query_log_async'):
+        try:
+            _ensure_thread()
+            _queue.put_nowait(query_log)
+            return
+        except queue.Full:
+            logger.warning('查询日志队列已满，同步写入')
+    _save_sync(query_log)
+
+
+def flush():
+    """写入队列中全部日志，包括后台线程已取出尚未写入的日志"""
+    with _write_lock:
+        batch = _take_inflight()
+        while True:
+            batch.extend(_drain(BATCH_SIZE - len(batch)))
+            if not batch:
+                return
+            _write(batch)
+            batch = []
+
+
+def _save_sync(query_log):
+    _ensure_usable()
+    query_log.save()
+
+
+def _ensure_usable():
+    # 防止查询超时
+    if connection.connection and not connection.is_usable():
+        close_old_connections()
+
+
+def _ensure_thread():
+    """启动后台写入线程，fork后的子进程需重新启动"""
+    global _thread, _pid
+    if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        _thread = threading.Thread(target=_run, name='query-log-writer', daemon=True)
+        _thread.start()
+
+
+def _run():
+    while True:
+        try:
+            _run_once()
+        except Exception:
+            logger.error(f'查询日志写入线程异常，稍后重试，错误信息：{traceback.format_exc()}')
+            time.sleep(FLUSH_INTERVAL)
+
+
+def _run_once():
+    # 上次写入失败放回的日志不等待新日志
+    if not _inflight:
+        _hold(_queue.get())
+    # 等待凑满一批或者达到写入间隔
+    deadline = time.monotonic() + FLUSH_INTERVAL
+    while len(_inflight) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            _hold(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    with _write_lock:
+        batch = _take_inflight()
+        if batch:
+            try:
+                _write(batch)
+            except Exception:
+                # 写入前出错，整批放回，由下次重试
+                _restore(batch)
+                raise
+
+
+def _hold(query_log):
+    with _lock:
+        _inflight.append(query_log)
+
+
+def _take_inflight():
+    with _lock:
+        batch = _inflight[:]
+        _inflight.clear()
+    return batch
+
+
+def _restore(batch):
+    with _lock:
+        _inflight[:0] = batch
+
+
+def _drain(size):
+    batch = []
+    while len(batch) < size:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write(batch):
+    """批量写入，失败时逐条写入，避免一条日志异常导致整批丢失"""
+    _ensure_usable()
+    try:
+        QueryLog.objects.bulk_create(batch)
+        return
+    except Exception:
+        logger.error(f'查询日志批量写入失败，逐条写入，错误信息：{traceback.format_exc()}')
+    for query_log in batch:
+        try:
+            query_log.save()
+        except Exception:
+            logger.error(f'查询日志写入失败，语句：{query_log.sqllog}，错误信息：{traceback.format_exc()}')
+
+
+atexit.register(flush)
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+缓存Inception/goInception打印的语法树，相同语句不再重复请求
+进程内LRU + Redis两级缓存，key为(引擎, 实例, 库, 规范化后语句的哈希)，
+实例级版本号包含在key中，DDL工单执行结束后更新版本号即可使该实例全部缓存失效
+"""
+import hashlib
+import logging
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import sqlparse
+from django.core.cache import cache
+
+from common.config import SysConfig
+
+logger = logging.getLogger('default')
+
+LRU_SIZE = 1000
+_lru = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_query_tree(engine, instance, db_name, sql):
+    """
+    获取语法树，缓存有效期通过系统配置query_tree_cache_ttl设置，单位秒，为0或未配置时不缓存
+    :param engine: InceptionEngine或者GoInceptionEngine
+    """
+    return cached_parse(engine.name, instance, db_name, sql,
+                        lambda: engine.query_print(instance=instance, db_name=db_name, sql=sql))
+
+
+def cached_parse(namespace, instance, db_name, sql, loader):
+    """
+    缓存基于语句解析的结果，如语法树、语句涉及的表
+    :param namespace: 结果类型
+    :param loader: 缓存未命中时获取结果的函数
+    """
+    ttl = int(SysConfig().get('query_tree_cache_ttl', 0))
+    if ttl <= 0:
+        return loader()
+
+    key = _cache_key(namespace, instance, db_name, sql)
+    # 进程内缓存
+    with _lock:
+        item = _lru.get(key)
+        if item and item[0] > time.time():
+            _lru.move_to_end(key)
+            return item[1]
+    # Redis缓存
+    try:
+        result = cache.get(key)
+    except Exception as m:
+        result = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if result is None:
+        result = loader()
+        try:
+            cache.set(key, result, timeout=ttl)
+        except Exception as m:
+            logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    with _lock:
+        _lru[key] = (time.time() + ttl, result)
+        _lru.move_to_end(key)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+    return result
+
+
+def invalidate_query_tree(instance_id):
+    """使实例的语法树缓存失效，用于DDL工单执行结束后"""
+    try:
+        cache.set(_version_key(instance_id), time.time(), timeout=None)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    # 清理本进程内该实例的缓存，其他进程的缓存因版本号变化不会再命中
+    with _lock:
+        for key in [k for k in _lru if k.startswith(f'query_tree:{instance_id}:')]:
+            _lru.pop(key)
+
+
+def cache_version(instance_id):
+    """实例的缓存版本号，语法树、表结构快照等缓存的key需包含该版本号"""
+    try:
+        return cache.get(_version_key(instance_id)) or 0
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return 0
+
+
+def normalize_sql(sql):
+    """
+    去除注释、合并语句中的空白字符、去除结尾分号，用于计算语句哈希；字符串和带引号的标识符内的空白字符保持不变，
+    /*! */版本注释和/*+ */优化器提示会影响执行结果，予以保留
+    """
+    parts = []
+    for ttype, value in sqlparse.lexer.tokenize(sql):
+        if ttype in sqlparse.tokens.Comment and not value.startswith(('/*!', '/*+')):
+            ttype = sqlparse.tokens.Whitespace
+        if ttype in sqlparse.tokens.Whitespace:
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        else:
+            parts.append(value)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def _cache_key(namespace, instance, db_name, sql):
+    sql_hash = hashlib.md5(normalize_sql(sql).encode('utf-8')).hexdigest()
+    return f'query_tree:{instance.id}:{cache_version(instance.id)}:{namespace}:{db_name}:{sql_hash}'
+
+
+def _version_key(instance_id):
+    return f'query_tree_version:{instance_id}'
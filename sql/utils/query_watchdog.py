@@ -0,0 +1,102 @@
+# -*- coding: UTF-8 -*-
+"""
+查询超时看门狗，替代每次查询都添加/删除django-q定时任务终止会话的方式
+登记的会话以截止时间为score保存在Redis有序集合中，登记、注销各一次Redis操作，不读写Archery数据库；
+由django-q定时任务drain每分钟执行一次，取出已到期的会话在有限大小的线程池中终止后立即返回，不占用qcluster worker，
+会话最多在超时后一个调度周期内被终止
+"""
+import logging
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django_redis import get_redis_connection
+
+from sql.engines import get_engine
+from sql.models import Instance
+from sql.utils.tasks import add_query_watchdog_schedule
+
+logger = logging.getLogger('default')
+
+WATCHDOG_KEY = 'query_watchdog'
+# 每次最多取出的到期会话数
+BATCH_SIZE = 100
+# 同时终止会话的线程数
+KILL_WORKERS = 4
+# 当前进程是否已确认定时任务存在
+_scheduled = False
+
+
+def register(instance_id, thread_id, timeout):
+    """登记查询会话，timeout秒后仍未注销则终止会话，返回用于注销的token，登记失败返回None"""
+    _ensure_schedule()
+    token = f'{instance_id}:{thread_id}:{uuid.uuid4().hex}'
+    try:
+        get_redis_connection('default').zadd(WATCHDOG_KEY, {token: time.time() + timeout})
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return None
+    return token
+
+
+def unregister(token):
+    """查询结束后注销"""
+    if token is None:
+        return
+    try:
+        get_redis_connection('default').zrem(WATCHDOG_KEY, token)
+    except Exception as m:
+        logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
+
+
+def pending():
+    """当前登记的会话数"""
+    return get_redis_connection('default').zcard(WATCHDOG_KEY)
+
+
+def drain():
+    """定时任务，每分钟执行一次，终止当前已到期的会话后返回；多个任务同时执行时由zrem保证每个会话只终止一次"""
+    redis_conn = get_redis_connection('default')
+    with ThreadPoolExecutor(max_workers=KILL_WORKERS) as executor:
+        while True:
+            expired = _expired(redis_conn)
+            for instance_id, thread_id in expired:
+                executor.submit(_kill, instance_id, thread_id)
+            if len(expired) < BATCH_SIZE:
+                break
+
+
+def _expired(redis_conn):
+    """取出到期的会话，zrem成功才处理，避免同一会话被多次终止"""
+    expired = []
+    for token in redis_conn.zrangebyscore(WATCHDOG_KEY, '-inf', time.time(), start=0, num=BATCH_SIZE):
+        if redis_conn.zrem(WATCHDOG_KEY, token):
+            instance_id, thread_id, _ = token.decode().split(':')
+            expired.append((int(instance_id), int(thread_id)))
+    return expired
+
+
+def _ensure_schedule():
+    """每个进程首次登记时确认定时任务存在"""
+    global _scheduled
+    if _scheduled:
+        return
+    try:
+        add_query_watchdog_schedule()
+        _scheduled = True
+    except Exception:
+        logger.error(f'添加查询超时终止定时任务失败，错误信息：{traceback.format_exc()}')
+
+
+def _kill(instance_id, thread_id):
+    """终止超时的会话，在线程池中执行"""
+    try:
+        instance = Instance.objects.get(pk=instance_id)
+        get_engine(instance).kill_connection(thread_id)
+        logger.info(f'查询超时，已终止实例{instance.instance_name}的会话{thread_id}')
+    except Exception:
+        logger.error(f'终止查询会话失败，实例ID：{instance_id}，会话：{thread_id}，错误信息：{traceback.format_exc()}')
+    finally:
+        connection.close()
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+"""
+MySQL实例复制状态采集，由django-q定时任务执行，结果写入缓存
+查询时直接读取缓存中的主从延迟，不再同步执行show slave status；采集同时保留延迟历史，用于实例页面展示
+采集间隔通过系统配置replication_lag_interval设置，单位秒，为0或未配置时不采集；
+定时任务按整分钟调度，超过60秒的间隔四舍五入为整分钟，如90秒按2分钟采集，不足60秒时在每分钟内按间隔多次采集
+"""
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import MySQLdb
+from django.core.cache import cache
+from django.db import connection
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.models import Instance
+
+logger = logging.getLogger('default')
+
+# 延迟历史保留的采集点数
+HISTORY_SIZE = 1440
+HISTORY_TIMEOUT = 86400
+MAX_WORKERS = 10
+
+
+def collect():
+    """
+    采集全部MySQL实例的复制状态，定时任务最小调度间隔为1分钟，
+    采集间隔小于60秒时在一次任务内按间隔多次采集
+    """
+    interval = int(SysConfig().get('replication_lag_interval', 0))
+    if interval <= 0:
+        return
+    rounds = max(1, 60 // interval)
+    for i in range(rounds):
+        start = time.time()
+        instances = list(Instance.objects.filter(db_type='mysql'))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for instance, status in zip(instances, executor.map(_probe, instances)):
+                if status is not None:
+                    _save(instance.id, status, interval)
+        if i < rounds - 1:
+            time.sleep(max(0, interval - (time.time() - start)))
+
+
+def replication_lag(instance_id):
+    """
+    读取采集到的复制状态，未采集或者已过期返回None
+    :return: {'seconds_behind_master': n, 'collect_time': timestamp}
+    """
+    try:
+        return cache.get(_lag_key(instance_id))
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return None
+
+
+def seconds_behind_master(query_engine, instance):
+    """优先使用采集的主从延迟，未采集时同步获取，复用查询连接"""
+    if int(SysConfig().get('replication_lag_interval', 0)) > 0:
+        status = replication_lag(instance.id)
+        if status is not None:
+            return status['seconds_behind_master']
+    return query_engine.seconds_behind_master
+
+
+def lag_history(instance_id):
+    """复制延迟历史，[{'seconds_behind_master': n, 'collect_time': timestamp}]，按采集时间升序"""
+    try:
+        return cache.get(_history_key(instance_id)) or []
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return []
+
+
+def _probe(instance):
+    """获取单个实例的复制状态，非从库的延迟为None，获取失败返回None"""
+    try:
+        query_engine = get_engine(instance=instance)
+        slave_status = query_engine.query(sql='show slave status', cursorclass=MySQLdb.cursors.DictCursor)
+        if slave_status.error:
+            logger.warning(f'采集实例{instance.instance_name}复制状态失败，错误信息：{slave_status.error}')
+            return None
+        lag = slave_status.rows[0].get('Seconds_Behind_Master') if slave_status.rows else None
+        return {'seconds_behind_master': lag, 'collect_time': int(time.time())}
+    except Exception:
+        logger.error(f'采集实例{instance.instance_name}复制状态异常，错误信息：{traceback.format_exc()}')
+        return None
+    finally:
+        # 关闭采集线程内的数据库连接
+        connection.close()
+
+
+def _save(instance_id, status, interval):
+    """保存当前复制状态和延迟历史，当前状态在3个采集间隔内未更新则过期"""
+    try:
+        cache.set(_lag_key(instance_id), status, timeout=max(interval * 3, 180))
+        history = cache.get(_history_key(instance_id)) or []
+        history.append(status)
+        cache.set(_history_key(instance_id), history[-HISTORY_SIZE:], timeout=HISTORY_TIMEOUT)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+
+
+def _lag_key(instance_id):
+    return f'replication_lag:{instance_id}'
+
+
+def _history_key(instance_id):
+    return f'replication_lag_history:{instance_id}'
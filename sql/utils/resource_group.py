@@ -1,6 +1,18 @@
 # -*- coding: UTF-8 -*-
+import logging
+import time
+import traceback
 
-from sql.models import Users, Instance, ResourceGroup
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from sql.models import Users, Instance, ResourceGroup, InstanceTag
+
+logger = logging.getLogger('default')
+
+USER_INSTANCES_VERSION_KEY = 'user_instances_version'
+USER_INSTANCES_TIMEOUT = 3600
 
 
 def user_groups(user):
@@ -25,27 +37,84 @@ def user_instances(user, type=None, db_type=None, tag_codes=None):
     :param tag_codes: 标签code列表, ['can_write', 'can_read']
     :return:
     """
-    # 拥有所有实例权限的用户
-    if user.has_perm('sql.query_all_instances'):
-        instances = Instance.objects.all()
-    else:
-        # 先获取用户关联的资源组
-        resource_groups = ResourceGroup.objects.filter(users=user, is_deleted=0)
-        # 再获取实例
-        instances = Instance.objects.filter(resource_group__in=resource_groups)
-    # 过滤type
-    if type:
-        instances = instances.filter(type=type)
-
-    # 过滤db_type
-    if db_type:
-        instances = instances.filter(db_type__in=db_type)
-
-    # 过滤tag
-    if tag_codes:
-        for tag_code in tag_codes:
-            instances = instances.filter(instance_tag__tag_code=tag_code, instance_tag__active=True)
-    return instances.distinct()
+    # 拥有所有实例权限的用户，无过滤条件时直接返回全部实例
+    if user.has_perm('sql.query_all_instances') and not (type or db_type or tag_codes):
+        return Instance.objects.all()
+    return Instance.objects.filter(id__in=user_instance_ids(user, type, db_type, tag_codes))
+
+
+def user_instance_ids(user, type=None, db_type=None, tag_codes=None):
+    """
+    获取用户实例ID列表，基于用户可访问实例的快照过滤，参数同user_instances
+    :return: [instance_id]
+    """
+    tag_codes = tag_codes or []
+    return [instance['id'] for instance in _user_instance_snapshot(user)
+            if (not type or instance['type'] == type)
+            and (not db_type or instance['db_type'] in db_type)
+            and all(tag_code in instance['tags'] for tag_code in tag_codes)]
+
+
+def _user_instance_snapshot(user):
+    """
+    获取用户可访问的全部实例信息[{'id', 'type', 'db_type', 'tags'}]，tags为激活的标签code
+    一次查询获取，缓存至Redis并在当前请求的用户对象上暂存，资源组、实例、标签及其关联关系变更后失效
+    """
+    all_instances = user.has_perm('sql.query_all_instances')
+    try:
+        version = cache.get(USER_INSTANCES_VERSION_KEY) or 0
+    except Exception as m:
+        version = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    memo = getattr(user, '_instance_snapshot', None)
+    if version is not None and memo and memo[0] == (version, all_instances):
+        return memo[1]
+
+    key = f"user_instances:{'all' if all_instances else user.id}:{version}"
+    snapshot = None
+    if version is not None:
+        try:
+            snapshot = cache.get(key)
+        except Exception as m:
+            logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if snapshot is None:
+        if all_instances:
+            instances = Instance.objects.all()
+        else:
+            instances = Instance.objects.filter(resource_group__users=user, resource_group__is_deleted=0)
+        snapshot = {}
+        for ins_id, ins_type, db_type, tag_code, active in instances.values_list(
+                'id', 'type', 'db_type', 'instance_tag__tag_code', 'instance_tag__active'):
+            instance = snapshot.setdefault(ins_id, {'id': ins_id, 'type': ins_type, 'db_type': db_type, 'tags': set()})
+            if tag_code and active:
+                instance['tags'].add(tag_code)
+        snapshot = list(snapshot.values())
+        if version is not None:
+            try:
+                cache.set(key, snapshot, timeout=USER_INSTANCES_TIMEOUT)
+            except Exception as m:
+                logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+    user._instance_snapshot = ((version, all_instances), snapshot)
+    return snapshot
+
+
+@receiver(post_save, sender=ResourceGroup)
+@receiver(post_delete, sender=ResourceGroup)
+@receiver(post_save, sender=Instance)
+@receiver(post_delete, sender=Instance)
+@receiver(post_save, sender=InstanceTag)
+@receiver(post_delete, sender=InstanceTag)
+@receiver(m2m_changed, sender=Users.resource_group.through)
+@receiver(m2m_changed, sender=Instance.resource_group.through)
+@receiver(m2m_changed, sender=Instance.instance_tag.through)
+def invalidate_user_instances(action=None, **kwargs):
+    """资源组、实例、标签及其关联关系变更后使全部用户的实例快照失效"""
+    if action and not action.startswith('post_'):
+        return
+    try:
+        cache.set(USER_INSTANCES_VERSION_KEY, time.time(), timeout=None)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
 
 
 def auth_group_users(auth_group_names, group_id):
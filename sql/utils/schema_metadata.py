@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+"""
+实例元数据缓存，用于实例资源（数据库、schema、表、字段）下拉框
+元数据按实例、库、schema、表分别缓存，instance_resource直接读取缓存，未命中时才查询实例并写入缓存；
+系统配置schema_metadata_interval大于0时由django-q定时任务预取全部实例的元数据，
+DDL工单执行结束后在后台只刷新工单对应的库
+缓存key包含实例级版本号，使实例缓存失效时只需更新版本号，旧版本的缓存自然过期，不再扫描全部key
+"""
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.engines.models import ResultSet
+from sql.models import Instance
+
+logger = logging.getLogger('default')
+
+# 未开启预取时的缓存时间，单位秒
+DEFAULT_TTL = 300
+MAX_WORKERS = 5
+
+
+def get_resource(instance, resource_type, db_name=None, schema_name=None, tb_name=None):
+    """
+    获取实例资源，优先读取缓存，返回一个ResultSet，rows=list
+    :param resource_type: database、schema、table、column
+    """
+    version = cache_version(instance.id)
+    if resource_type == 'database':
+        key = _key(instance.id, version, 'database')
+    elif resource_type == 'schema' and db_name:
+        key = _key(instance.id, version, 'schema', db_name)
+    elif resource_type == 'table' and db_name:
+        key = _key(instance.id, version, 'table', db_name, schema_name)
+    elif resource_type == 'column' and db_name and tb_name:
+        key = _key(instance.id, version, 'column', db_name, schema_name, tb_name)
+    else:
+        raise TypeError('不支持的资源类型或者参数不完整！')
+
+    try:
+        rows = cache.get(key)
+    except Exception as m:
+        rows = None
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+    if rows is not None:
+        return ResultSet(rows=rows)
+
+    query_engine = get_engine(instance=instance)
+    if resource_type == 'database':
+        resource = query_engine.get_all_databases()
+    elif resource_type == 'schema':
+        resource = query_engine.get_all_schemas(db_name=db_name)
+    elif resource_type == 'table':
+        resource = query_engine.get_all_tables(db_name=db_name, schema_name=schema_name)
+    else:
+        resource = query_engine.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name, schema_name=schema_name)
+    if not resource.error:
+        _save({key: resource.rows})
+    return resource
+
+
+def prefetch():
+    """预取全部实例的元数据，供定时任务调用"""
+    if cache_interval() <= 0:
+        return
+    instances = list(Instance.objects.all())
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(_prefetch_instance, instances))
+
+
+def refresh(instance_id, db_name=None):
+    """刷新实例的数据库列表和指定库的元数据，未指定库时刷新全部库，用于DDL工单执行结束后"""
+    try:
+        instance = Instance.objects.get(id=instance_id)
+    except Instance.DoesNotExist:
+        return
+    _refresh_instance(instance, [db_name] if db_name else None)
+
+
+def invalidate(instance_id):
+    """使实例的元数据缓存失效，用于DDL工单执行结束、新建数据库后"""
+    try:
+        cache.set(_version_key(instance_id), time.time(), timeout=None)
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+
+
+def cache_version(instance_id):
+    """实例元数据缓存的版本号"""
+    try:
+        return cache.get(_version_key(instance_id)) or 0
+    except Exception as m:
+        logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
+        return 0
+
+
+def cache_interval():
+    """预取间隔，单位秒，为0时不预取"""
+    return int(SysConfig().get('schema_metadata_interval', 0) or 0)
+
+
+def cache_ttl():
+    """元数据缓存时间，开启预取时保留到下次预取之后"""
+    interval = cache_interval()
+    return max(interval * 3, DEFAULT_TTL) if interval > 0 else DEFAULT_TTL
+
+
+def _refresh_instance(instance, db_names=None):
+    """获取实例的元数据并写入缓存，db_names为空时获取全部库"""
+    try:
+        version = cache_version(instance.id)
+        query_engine = get_engine(instance=instance)
+        databases = query_engine.get_all_databases()
+        if databases.error:
+            logger.warning(f'获取实例{instance.instance_name}元数据失败，错误信息：{databases.error}')
+            return
+        data = {_key(instance.id, version, 'database'): databases.rows}
+        for db_name in db_names or databases.rows:
+            data.update(_fetch_db(query_engine, instance, version, db_name))
+        _save(data)
+    except Exception:
+        logger.error(f'获取实例{instance.instance_name}元数据异常，错误信息：{traceback.format_exc()}')
+
+
+def _prefetch_instance(instance):
+    try:
+        _refresh_instance(instance)
+    finally:
+        # 关闭预取线程内的数据库连接
+        connection.close()
+
+
+def _fetch_db(query_engine, instance, version, db_name):
+    """获取单个库的schema、表、字段，返回{缓存key: 资源列表}"""
+    data = {}
+    if hasattr(query_engine, 'get_all_schemas'):
+        schemas = query_engine.get_all_schemas(db_name=db_name)
+        if schemas.error:
+            logger.warning(f'获取实例{instance.instance_name}库{db_name}的schema失败，错误信息：{schemas.error}')
+            return data
+        data[_key(instance.id, version, 'schema', db_name)] = schemas.rows
+        schema_names = schemas.rows
+    else:
+        schema_names = [None]
+    for schema_name in schema_names:
+        tables = query_engine.get_all_tables(db_name=db_name, schema_name=schema_name)
+        columns = query_engine.get_all_columns_by_db(db_name=db_name, schema_name=schema_name)
+        if tables.error or columns.error:
+            logger.warning(f'获取实例{instance.instance_name}库{db_name}的表失败，'
+                           f'错误信息：{tables.error or columns.error}')
+            continue
+        data[_key(instance.id, version, 'table', db_name, schema_name)] = tables.rows
+        for tb_name, column_list in columns.rows:
+            data[_key(instance.id, version, 'column', db_name, schema_name, tb_name)] = column_list
+    return data
+
+
+def _save(data):
+    try:
+        cache.set_many(data, timeout=cache_ttl())
+    except Exception as m:
+        logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+
+
+def _key(instance_id, version, resource_type, *names):
+    return ':'.join(['insRes', str(instance_id), str(version), resource_type] + [str(name or '') for name in names])
+
+
+def _version_key(instance_id):
+    return f'insRes_version:{instance_id}'
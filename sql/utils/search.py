@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+列表页的模糊搜索和分页计数，用于查询日志、SQL工单
+系统配置fulltext_search开启后，先通过ngram全文索引筛选候选记录再用LIKE精确匹配，结果与只用LIKE一致，
+全文索引需先创建，见src/init_sql/v1.7.12_v1.7.13.sql；
+系统配置list_count_limit大于0时，结果数超过该值不再精确计数
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from common.config import SysConfig
+
+# 与MySQL的ngram_token_size一致，短于该长度的词无法通过全文索引检索
+NGRAM_TOKEN_SIZE = 2
+# ngram分词忽略空白字符，只使用连续的字母、数字、汉字检索全文索引
+WORD_RE = re.compile(r'\w{%d,}' % NGRAM_TOKEN_SIZE)
+
+
+def search(queryset, fields, keyword):
+    """
+    在多个字段中模糊搜索关键字，keyword为空时不过滤
+    :param fields: 字段名列表，开启全文检索时需与全文索引的字段及顺序一致
+    """
+    if not keyword:
+        return queryset
+    condition = Q()
+    for field in fields:
+        condition |= Q(**{f'{field}__icontains': keyword})
+    queryset = queryset.filter(condition)
+    words = WORD_RE.findall(keyword)
+    if SysConfig().get('fulltext_search') and words:
+        quote_name = connection.ops.quote_name
+        table = quote_name(queryset.model._meta.db_table)
+        columns = ', '.join(f'{table}.{quote_name(queryset.model._meta.get_field(field).column)}' for field in fields)
+        # 每个词作为短语且必须出现，关键字中的其他字符由LIKE匹配
+        against = ' '.join(f'+"{word}"' for word in words)
+        queryset = queryset.extra(where=[f'match ({columns}) against (%s in boolean mode)'], params=[against])
+    return queryset
+
+
+def count(queryset):
+    """
+    分页计数，未配置list_count_limit时精确计数；
+    超过list_count_limit时，未过滤的返回表的估算行数，有过滤条件的返回list_count_limit
+    """
+    limit = int(SysConfig().get('list_count_limit', 0) or 0)
+    if limit <= 0:
+        return queryset.count()
+    total = queryset[:limit + 1].count()
+    if total <= limit:
+        return total
+    if not queryset.query.where:
+        return max(_estimated_rows(queryset.model._meta.db_table), limit)
+    return limit
+
+
+def _estimated_rows(table):
+    """InnoDB统计信息中的估算行数"""
+    with connection.cursor() as cursor:
+        cursor.execute('''select table_rows from information_schema.tables
+            where table_schema = database() and table_name = %s;''', [table])
+        row = cursor.fetchone()
+    return int(row[0] or 0) if row else 0
@@ -0,0 +1,231 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志明细表mysql_slow_query_review_history的维护，包括按月分区、过期数据清理和历史数据压缩
+分区需要先执行python manage.py slowquery_history --init-partitions将明细表转换为按ts_min的月分区表，
+之后由定时任务或者python manage.py slowquery_history每天维护：
+增加后续月份的分区，删除超过slow_query_retention_days的数据（分区表直接删除分区），
+将超过slow_query_hourly_days、slow_query_daily_days的明细分别压缩为每小时、每天一条，
+压缩进度记录在汇总进度表rollup_watermark中，每次只处理上次之后新到期的天；
+三个配置都未设置时不添加定时任务，分区表需要通过crontab每天执行python manage.py slowquery_history增加分区
+"""
+import logging
+from datetime import date, datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+
+from common.config import SysConfig
+from sql.models import RollupWatermark
+
+logger = logging.getLogger('default')
+
+TABLE = 'mysql_slow_query_review_history'
+# 提前创建的分区月数
+MONTHS_AHEAD = 3
+# 非分区表每次删除的行数
+DELETE_BATCH_SIZE = 10000
+# 压缩时的分组字段，分组内的明细合并为一条
+GROUP_COLUMNS = ('instance_id', 'hostname_max', 'checksum', 'db_max', 'user_max')
+# 压缩粒度：名称、保留明细的天数配置、分组表达式
+GRANULARITIES = (
+    ('hour', 'slow_query_hourly_days', "date_format(ts_min, '%%Y-%%m-%%d %%H')"),
+    ('day', 'slow_query_daily_days', 'date(ts_min)'),
+)
+
+
+def maintain():
+    """每天的维护任务，供定时任务和管理命令调用"""
+    config = SysConfig()
+    if is_partitioned():
+        add_partitions()
+    retention_days = int(config.get('slow_query_retention_days', 0) or 0)
+    if retention_days > 0:
+        purge(date.today() - timedelta(days=retention_days))
+    backfill_instance()
+    for granularity, key, bucket in GRANULARITIES:
+        days = int(config.get(key, 0) or 0)
+        if days > 0:
+            compact(date.today() - timedelta(days=days), bucket, granularity)
+
+
+def is_partitioned():
+    """明细表是否为分区表"""
+    return bool(_partitions())
+
+
+def init_partitions(months_ahead=MONTHS_AHEAD):
+    """
+    将明细表转换为按月的range分区表，需要复制全表，数据量较大时建议在业务低峰执行；
+    分区表的主键和唯一索引需包含分区字段，主键改为(id, ts_min)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'select min(ts_min) from {TABLE};')
+        first_time = cursor.fetchone()[0] or datetime.now()
+        months = _months(first_time.date().replace(day=1), _last_month(months_ahead))
+        cursor.execute(f'''alter table {TABLE} drop primary key, add primary key (id, ts_min)
+            partition by range (to_days(ts_min)) ({_partition_definitions(months)});''')
+    logger.info(f'{TABLE}已转换为分区表，分区：{months[0]:%Y%m}-{months[-1]:%Y%m}')
+
+
+def add_partitions(months_ahead=MONTHS_AHEAD):
+    """拆分pmax分区，保证后续months_ahead个月都有独立的分区"""
+    partitions = [name for name, _ in _partitions() if name != 'pmax']
+    if not partitions:
+        return
+    last_month = datetime.strptime(max(partitions), 'p%Y%m').date()
+    months = _months(last_month + relativedelta(months=1), _last_month(months_ahead))
+    if not months:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'alter table {TABLE} reorganize partition pmax into ({_partition_definitions(months)});')
+    logger.info(f'{TABLE}增加分区：{months[0]:%Y%m}-{months[-1]:%Y%m}')
+
+
+def purge(before):
+    """删除ts_min早于before的明细，分区表直接删除整个分区，其余分区内的少量数据按批删除"""
+    expired = [name for name, less_than in _partitions() if less_than is not None and less_than <= _to_days(before)]
+    with connection.cursor() as cursor:
+        if expired:
+            cursor.execute(f'alter table {TABLE} drop partition {", ".join(expired)};')
+            logger.info(f'{TABLE}删除分区：{", ".join(expired)}')
+        while True:
+            cursor.execute(f'delete from {TABLE} where ts_min < %s limit {DELETE_BATCH_SIZE};', [before])
+            if cursor.rowcount < DELETE_BATCH_SIZE:
+                break
+
+
+def backfill_instance():
+    """补充写入时未匹配到实例的明细的instance_id，如先采集慢日志后添加实例"""
+    with connection.cursor() as cursor:
+        cursor.execute(f'''update {TABLE} h join sql_instance i on h.hostname_max = concat(i.host, ':', i.port)
+            set h.instance_id = i.id where h.instance_id is null;''')
+
+
+def compact(before, bucket, granularity):
+    """
+    将ts_min早于before的明细按bucket分组压缩，逐天处理；
+    每种粒度的进度以下一个待压缩日期的to_days值记录在rollup_watermark中，已压缩的天不再扫描，
+    进度之前补采集的明细不再压缩，由过期清理删除
+    """
+    watermark, _ = RollupWatermark.objects.get_or_create(name=f'{TABLE}:{granularity}')
+    if watermark.last_id:
+        day = _from_days(watermark.last_id)
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(f'select min(ts_min) from {TABLE} where ts_min < %s;', [before])
+            first_time = cursor.fetchone()[0]
+        if first_time is None:
+            return
+        day = first_time.date()
+    columns = _columns() if day < before else None
+    while day < before:
+        _compact_day(day, bucket, columns)
+        day += timedelta(days=1)
+        watermark.last_id = _to_days(day)
+        watermark.save(update_fields=['last_id', 'update_time'])
+
+
+def _compact_day(day, bucket, columns):
+    """
+    压缩一天的明细：次数、总和直接累加，最小、最大和95分位取最值，中位数按次数加权平均，标准差按各组的均值和次数合并；
+    删除原明细和写入压缩结果在同一个事务内，同时扣减dashboard汇总表中已汇总的次数，压缩后的明细会重新汇总
+    """
+    start, end = day, day + timedelta(days=1)
+    group_by = ', '.join(GROUP_COLUMNS + (bucket,))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'''select 1 from {TABLE} where ts_min >= %s and ts_min < %s
+            group by {group_by} having count(*) > 1 limit 1;''', [start, end])
+        if cursor.fetchone() is None:
+            return
+        cursor.execute(f'select max(id) from {TABLE} where ts_min >= %s and ts_min < %s;', [start, end])
+        max_id = cursor.fetchone()[0]
+        cursor.execute(f'''select {", ".join(_aggregate(column, columns) for column in columns)} from {TABLE}
+            where ts_min >= %s and ts_min < %s and id <= %s group by {group_by};''', [start, end, max_id])
+        rows = cursor.fetchall()
+        watermark = RollupWatermark.objects.select_for_update().filter(name=TABLE).first()
+        if watermark:
+            _subtract_rollup(cursor, start, end, min(max_id, watermark.last_id))
+        cursor.execute(f'delete from {TABLE} where ts_min >= %s and ts_min < %s and id <= %s;', [start, end, max_id])
+        deleted = cursor.rowcount
+        cursor.executemany(f'''insert into {TABLE} ({", ".join(f"`{column}`" for column in columns)})
+            values ({", ".join(["%s"] * len(columns))});''', rows)
+    logger.info(f'{TABLE}压缩{day}的明细：{deleted}条合并为{len(rows)}条')
+
+
+def _subtract_rollup(cursor, start, end, max_id):
+    """扣减dashboard汇总表中已汇总的次数，与common.utils.dashboard_rollup的汇总维度一致"""
+    cursor.execute(f'''update mysql_slow_query_rollup r join (
+          select date_format(ts_min, '%%Y-%%m-%%d %%H:00:00') stat_hour, ifnull(db_max, '') db_max, user_max,
+            ifnull(sum(ts_cnt), 0) ts_cnt
+          from {TABLE}
+          where ts_min >= %s and ts_min < %s and id <= %s
+          group by 1, 2, 3) d on r.stat_hour = d.stat_hour and r.db_max = d.db_max and r.user_max = d.user_max
+        set r.ts_cnt = r.ts_cnt - d.ts_cnt;''', [start, end, max_id])
+
+
+def _aggregate(column, columns):
+    """压缩时各字段的合并方式，字段名与pt-query-digest写入的一致"""
+    name = column.lower()
+    if column in GROUP_COLUMNS:
+        return column
+    if name == 'ts_min':
+        return 'min(ts_min)'
+    if name == 'ts_max':
+        return 'max(ts_max)'
+    if name.endswith('_sum') or name.endswith('_cnt'):
+        return f'sum(`{column}`)'
+    if name.endswith('_min'):
+        return f'min(`{column}`)'
+    if name.endswith('_median'):
+        return f'sum(`{column}` * ts_cnt) / sum(ts_cnt)'
+    if name.endswith('_stddev'):
+        sum_column = {c.lower(): c for c in columns}.get(name[:-len('stddev')] + 'sum')
+        if sum_column:
+            return (f'sqrt(greatest(sum(ts_cnt * (pow(`{column}`, 2) + pow(`{sum_column}` / ts_cnt, 2))) / sum(ts_cnt)'
+                    f' - pow(sum(`{sum_column}`) / sum(ts_cnt), 2), 0))')
+    return f'max(`{column}`)'
+
+
+def _columns():
+    """明细表除id外的全部字段，pt-query-digest写入的字段比模型多"""
+    with connection.cursor() as cursor:
+        description = connection.introspection.get_table_description(cursor, TABLE)
+    return [column.name for column in description if column.name.lower() != 'id']
+
+
+def _partitions():
+    """返回明细表的分区[(分区名, 上界的to_days值)]，pmax的上界为None，非分区表返回空列表"""
+    with connection.cursor() as cursor:
+        cursor.execute('''select partition_name, partition_description from information_schema.partitions
+            where table_schema = database() and table_name = %s and partition_name is not null
+            order by partition_ordinal_position;''', [TABLE])
+        return [(name, None if less_than == 'MAXVALUE' else int(less_than)) for name, less_than in cursor.fetchall()]
+
+
+def _partition_definitions(months):
+    """每月一个分区，最后为pmax"""
+    definitions = [f"partition p{month:%Y%m} values less than (to_days('{month + relativedelta(months=1)}'))"
+                   for month in months]
+    return ', '.join(definitions + ['partition pmax values less than maxvalue'])
+
+
+def _months(first_month, last_month):
+    months = []
+    while first_month <= last_month:
+        months.append(first_month)
+        first_month += relativedelta(months=1)
+    return months
+
+
+def _last_month(months_ahead):
+    return date.today().replace(day=1) + relativedelta(months=months_ahead)
+
+
+def _to_days(day):
+    """与MySQL的to_days一致"""
+    return day.toordinal() + 365
+
+
+def _from_days(days):
+    """与MySQL的from_days一致"""
+    return date.fromordinal(days - 365)
@@ -0,0 +1,354 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志采集，替代外部pt-query-digest脚本，结果写入mysql_slow_query_review、mysql_slow_query_review_history
+从上次处理的位置增量读取慢日志文件，语句指纹化后按5分钟分桶汇总，
+执行时长等指标使用分位数估算得到95分位和中位数，每个桶写入一条明细，读取位置和明细在同一个事务内保存，
+中断后从上次位置继续；在慢日志所在服务器执行：python manage.py ingest_slowlog --instance 实例名称 --file 慢日志路径
+"""
+import calendar
+import hashlib
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.db import transaction
+
+from sql.models import SlowQuery, SlowQueryHistory, SlowLogCheckpoint
+
+logger = logging.getLogger('default')
+
+# 分桶时长，单位秒
+BUCKET_SECONDS = 300
+# 每次写入的明细数
+BATCH_SIZE = 500
+# 文件超过该时间未写入时，认为最后一条慢日志已写完，单位秒
+IDLE_SECONDS = 60
+# 汇总的数值指标，与SlowQueryHistory的字段前缀对应
+METRICS = ('query_time', 'lock_time', 'rows_sent', 'rows_examined', 'rows_affected')
+
+TIME_RE = re.compile(r'^# Time: (.+)$')
+USER_HOST_RE = re.compile(r'^# User@Host: ([^\[\s]*)\[[^\]]*\] @ ([^\[]*)\[([^\]]*)\]')
+SCHEMA_RE = re.compile(r'\bSchema: (\S+)')
+ATTRIBUTE_RE = re.compile(r'\b(\w+): (-?[\d.]+)')
+USE_RE = re.compile(r'^use [`]?([^`;\s]+)[`]?;\s*$', re.I)
+SET_TIMESTAMP_RE = re.compile(r'^SET timestamp=(\d+);\s*$', re.I)
+# 数据库重启时在慢日志中写入的文件头
+FILE_HEADER_RE = re.compile(r'^(\S+, Version: |Tcp port: |Time\s+Id\s+Command\s+Argument)')
+
+
+class QuantileSketch:
+    """
+    对数分桶的分位数估算，相对误差不超过accuracy，
+    占用空间与取值范围的对数成正比，与样本数无关
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            self.bins[math.ceil(math.log(value) / self.log_gamma)] += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        total = self.zero_count
+        if rank < total:
+            return 0.0
+        for index in sorted(self.bins):
+            total += self.bins[index]
+            if total > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class MetricStats:
+    """单个指标的汇总值"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.square_sum = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.square_sum += value * value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    def fields(self, prefix):
+        """返回SlowQueryHistory对应字段的值"""
+        if self.count == 0:
+            return {}
+        mean = self.sum / self.count
+        return {
+            f'{prefix}_sum': self.sum,
+            f'{prefix}_min': self.min,
+            f'{prefix}_max': self.max,
+            f'{prefix}_pct_95': self.sketch.quantile(0.95),
+            f'{prefix}_stddev': math.sqrt(max(self.square_sum / self.count - mean * mean, 0)),
+            f'{prefix}_median': self.sketch.quantile(0.5),
+        }
+
+
+class QueryStats:
+    """同一个桶内同一类语句的汇总"""
+
+    def __init__(self, checksum, fingerprint):
+        self.checksum = checksum
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.metrics = {metric: MetricStats() for metric in METRICS}
+        self.ts_min = None
+        self.ts_max = None
+        self.slowest = None
+        self.bytes_max = 0
+
+    def add(self, event):
+        self.count += 1
+        for metric in METRICS:
+            if event.get(metric) is not None:
+                self.metrics[metric].add(event[metric])
+        self.ts_min = event['ts'] if self.ts_min is None else min(self.ts_min, event['ts'])
+        self.ts_max = event['ts'] if self.ts_max is None else max(self.ts_max, event['ts'])
+        if self.slowest is None or event['query_time'] > self.slowest['query_time']:
+            self.slowest = event
+        self.bytes_max = max(self.bytes_max, len(event['sql'].encode('utf-8')))
+
+    def history(self, instance):
+        """生成SlowQueryHistory，字符串类的*_max字段取最慢一次执行的值"""
+        fields = {}
+        for metric in METRICS:
+            fields.update(self.metrics[metric].fields(metric))
+        return SlowQueryHistory(
+            hostname_max=f'{instance.host}:{instance.port}',
+            instance_id=instance.id,
+            client_max=self.slowest['client'],
+            user_max=self.slowest['user'],
+            db_max=self.slowest['db'],
+            bytes_max=str(self.bytes_max),
+            checksum_id=self.checksum,
+            sample=self.slowest['sql'],
+            ts_min=self.ts_min,
+            ts_max=self.ts_max,
+            ts_cnt=self.count,
+            **fields
+        )
+
+
+def fingerprint(sql):
+    """语句指纹，参照pt-query-digest：去除注释，常量替换为?，合并IN列表和空白字符，统一小写"""
+    sql = re.sub(r'/\*[^!].*?\*/', '', sql, flags=re.S)
+    sql = re.sub(r'(?:--|#)[^\n]*', '', sql)
+    sql = sql.strip().rstrip(';').lower()
+    sql = re.sub(r'\\["\']', '', sql)
+    sql = re.sub(r'"(?:[^"\\]|\\.)*"', '?', sql)
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'", '?', sql)
+    sql = re.sub(r'\btrue\b|\bfalse\b|\bnull\b', '?', sql)
+    sql = re.sub(r'\b0x[0-9a-f]+\b', '?', sql)
+    sql = re.sub(r'(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', '?', sql)
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\b(in|values?)(?:[\s,]*\([\s?,]*\))+', r'\1(?+)', sql)
+    sql = re.sub(r'\blimit \?(?:, ?\?| offset \?)?', 'limit ?', sql)
+    return sql
+
+
+def checksum(sql_fingerprint):
+    """与pt-query-digest一致，取指纹md5的后16位"""
+    return hashlib.md5(sql_fingerprint.encode('utf-8')).hexdigest()[-16:].upper()
+
+
+def parse_events(path, offset=0, final=False):
+    """
+    从offset开始读取慢日志，逐条返回(慢日志, 开始位置, 结束位置)，时间为UTC时间
+    :param final: 是否返回文件末尾的最后一条，写入中的文件最后一条可能不完整
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        position = offset
+        event, start, last_time, current_db = None, offset, None, None
+        for raw_line in f:
+            line_start = position
+            position += len(raw_line)
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            if line.startswith('# Time:') or line.startswith('# User@Host:'):
+                # 上一条的语句之后出现新的头部，上一条结束
+                if event is not None and event['lines']:
+                    complete = _complete(event, last_time, current_db)
+                    if complete:
+                        yield complete, start, line_start
+                    event = None
+                if event is None:
+                    event, start = {'lines': [], 'header': {}}, line_start
+                match = TIME_RE.match(line)
+                if match:
+                    last_time = _parse_time(match.group(1)) or last_time
+                    event['time'] = last_time
+                match = USER_HOST_RE.match(line)
+                if match:
+                    event['user'], host, ip = match.group(1), match.group(2).strip(), match.group(3).strip()
+                    event['client'] = ip or host
+            elif event is None or FILE_HEADER_RE.match(line):
+                continue
+            elif line.startswith('# ') and not event['lines']:
+                match = SCHEMA_RE.search(line)
+                if match:
+                    event['db'] = match.group(1)
+                for name, value in ATTRIBUTE_RE.findall(line):
+                    event['header'][name.lower()] = value
+            elif not event['lines'] and USE_RE.match(line):
+                current_db = USE_RE.match(line).group(1)
+            elif not event['lines'] and SET_TIMESTAMP_RE.match(line):
+                event['timestamp'] = int(SET_TIMESTAMP_RE.match(line).group(1))
+            else:
+                event['lines'].append(line)
+        if final and event is not None and event['lines']:
+            complete = _complete(event, last_time, current_db)
+            if complete:
+                yield complete, start, position
+
+
+def ingest(instance, path):
+    """增量采集慢日志文件，返回写入的明细数"""
+    stat = os.stat(path)
+    checkpoint, _ = SlowLogCheckpoint.objects.get_or_create(instance=instance, file_path=path)
+    # 文件被轮转或者截断时从头读取
+    if checkpoint.inode != stat.st_ino or checkpoint.offset > stat.st_size:
+        checkpoint.inode, checkpoint.offset = stat.st_ino, 0
+    final = time.time() - stat.st_mtime > IDLE_SECONDS
+
+    # 未结束的桶{checksum: QueryStats}、桶开始时间及桶内第一条慢日志的开始位置，出现更晚的桶时结束当前桶
+    current, current_bucket, current_offset = {}, None, None
+    closed, written, position = [], 0, checkpoint.offset
+    for event, start, end in parse_events(path, checkpoint.offset, final=final):
+        bucket = _bucket(event['ts'])
+        if current_bucket is None or bucket > current_bucket:
+            closed.extend(current.values())
+            current, current_bucket, current_offset = {}, bucket, start
+        # 执行时间较长的语句写入慢日志时可能晚于后续语句，所属的桶已结束时计入当前桶
+        sql_fingerprint = fingerprint(event['sql'])
+        sql_checksum = checksum(sql_fingerprint)
+        if sql_checksum not in current:
+            current[sql_checksum] = QueryStats(sql_checksum, sql_fingerprint)
+        current[sql_checksum].add(event)
+        position = end
+        if len(closed) >= BATCH_SIZE:
+            written += _write(checkpoint, closed, current_offset)
+            closed = []
+
+    # 当前桶结束超过一个分桶时长仍没有更晚的慢日志，认为已结束，否则下次从桶内第一条慢日志重新读取
+    if current_bucket is not None and current_bucket < datetime.utcnow() - timedelta(seconds=BUCKET_SECONDS * 2):
+        closed.extend(current.values())
+        current_offset = None
+    written += _write(checkpoint, closed, current_offset if current_offset is not None else position)
+    return written
+
+
+def _write(checkpoint, stats_list, offset):
+    """写入已结束的桶，同时更新读取位置"""
+    with transaction.atomic():
+        if stats_list:
+            _upsert_slow_query(stats_list)
+            SlowQueryHistory.objects.bulk_create([stats.history(checkpoint.instance) for stats in stats_list],
+                                                 batch_size=BATCH_SIZE, ignore_conflicts=True)
+        checkpoint.offset = offset
+        checkpoint.save()
+    logger.debug(f'慢日志{checkpoint.file_path}写入{len(stats_list)}条明细，读取位置：{offset}')
+    return len(stats_list)
+
+
+def _upsert_slow_query(stats_list):
+    """新增语句指纹，已有的更新最后出现时间"""
+    queries = {}
+    for stats in stats_list:
+        query = queries.get(stats.checksum)
+        if query is None:
+            queries[stats.checksum] = SlowQuery(checksum=stats.checksum, fingerprint=stats.fingerprint,
+                                                sample=stats.slowest['sql'], first_seen=stats.ts_min,
+                                                last_seen=stats.ts_max)
+        else:
+            query.first_seen = min(query.first_seen, stats.ts_min)
+            query.last_seen = max(query.last_seen, stats.ts_max)
+    existing = set(SlowQuery.objects.filter(checksum__in=queries).values_list('checksum', flat=True))
+    SlowQuery.objects.bulk_create([q for c, q in queries.items() if c not in existing],
+                                  batch_size=BATCH_SIZE, ignore_conflicts=True)
+    for sql_checksum in existing:
+        SlowQuery.objects.filter(checksum=sql_checksum, last_seen__lt=queries[sql_checksum].last_seen).update(
+            last_seen=queries[sql_checksum].last_seen)
+
+
+def _complete(event, last_time, current_db):
+    """补全慢日志的时间、库名等信息，缺少执行时长的忽略"""
+    header = event['header']
+    if 'query_time' not in header:
+        return None
+    sql = '\n'.join(event['lines']).strip()
+    if not sql:
+        return None
+    query_time = float(header['query_time'])
+    if 'timestamp' in event:
+        # SET timestamp为语句开始时间，加上执行时长为写入慢日志的时间
+        ts = datetime.utcfromtimestamp(event['timestamp'] + query_time)
+    else:
+        ts = event.get('time') or last_time
+    if ts is None:
+        return None
+    return {
+        'ts': ts,
+        'user': event.get('user', ''),
+        'client': event.get('client', ''),
+        'db': event.get('db') or current_db,
+        'sql': sql,
+        'query_time': query_time,
+        'lock_time': _number(header.get('lock_time')),
+        'rows_sent': _number(header.get('rows_sent')),
+        'rows_examined': _number(header.get('rows_examined')),
+        'rows_affected': _number(header.get('rows_affected')),
+    }
+
+
+def _parse_time(value):
+    """解析# Time，返回UTC时间；5.6及之前版本格式为本地时间"""
+    value = value.strip()
+    try:
+        if 'T' in value:
+            if value.endswith('Z'):
+                return datetime.strptime(value[:-1][:26], '%Y-%m-%dT%H:%M:%S.%f' if '.' in value
+                                         else '%Y-%m-%dT%H:%M:%S')
+            # log_timestamps=SYSTEM时带时区，如2020-01-01T08:00:00.123456+08:00
+            local_time, sign, offset = value[:-6], value[-6], value[-5:]
+            ts = datetime.strptime(local_time[:26], '%Y-%m-%dT%H:%M:%S.%f' if '.' in local_time
+                                   else '%Y-%m-%dT%H:%M:%S')
+            delta = timedelta(hours=int(offset[:2]), minutes=int(offset[3:]))
+            return ts - delta if sign == '+' else ts + delta
+        local_time = datetime.strptime(' '.join(value.split()), '%y%m%d %H:%M:%S')
+        return datetime.utcfromtimestamp(time.mktime(local_time.timetuple()))
+    except ValueError:
+        logger.warning(f'无法解析慢日志时间：{value}')
+        return None
+
+
+def _bucket(ts):
+    seconds = calendar.timegm(ts.timetuple())
+    return datetime.utcfromtimestamp(seconds - seconds % BUCKET_SECONDS)
+
+
+def _number(value):
+    return float(value) if value is not None else None
@@ -5,14 +5,34 @@
 @file: ssh_tunnel.py
 @time: 2020/05/09
 """
+import hashlib
+import logging
+import threading
+import time
+
 from sshtunnel import SSHTunnelForwarder
 from paramiko import RSAKey
 
+logger = logging.getLogger('default')
+
+# 隧道保活间隔，单位秒
+KEEPALIVE_INTERVAL = 30
+# 无引用隧道的空闲关闭时间，单位秒
+IDLE_TIMEOUT = 600
+
+_tunnels = {}
+# 保护_tunnels和引用计数，只做字典和计数操作，不在持有时建立或关闭隧道
+_lock = threading.Lock()
+# 每个隧道key一个锁，建立、重连隧道时只阻塞同一个隧道的请求
+_key_locks = {}
+
+
 class SSHConnection(object):
     """
     ssh隧道连接类，用于映射ssh隧道端口到本地，连接结束时需要清理
     """
-    def __init__(self, host, port, tun_host, tun_port, tun_user, tun_password, pkey_path, pkey_password):
+    def __init__(self, host, port, tun_host, tun_port, tun_user, tun_password, pkey_path, pkey_password,
+                 keepalive=0.0):
         self.host = host
         self.port = int(port)
         self.tun_host = tun_host
@@ -27,6 +47,7 @@ class SSHConnection(object):
                 ssh_username=self.tun_user,
                 ssh_pkey=self.private_key,
                 remote_bind_address=(self.host, self.port),
+                set_keepalive=keepalive,
             )
         else:
             self.server = SSHTunnelForwarder(
@@ -34,6 +55,7 @@ class SSHConnection(object):
                 ssh_username=self.tun_user,
                 ssh_password=self.tun_password,
                 remote_bind_address=(self.host, self.port),
+                set_keepalive=keepalive,
             )
         self.server.start()
 
@@ -47,3 +69,139 @@ class SSHConnection(object):
         :return:
         """
         return "127.0.0.1", self.server.local_bind_port
+
+    @property
+    def is_active(self):
+        """隧道是否可用"""
+        try:
+            self.server.check_tunnels()
+            return self.server.is_active and all(self.server.tunnel_is_up.values())
+        except Exception:
+            return False
+
+    def restart(self):
+        """重建隧道"""
+        self.server.restart()
+
+
+class SharedTunnel(object):
+    """
+    进程内共享的ssh隧道，按引用计数管理，无引用后空闲超时关闭
+    """
+    def __init__(self, key, fingerprint, connection):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.connection = connection
+        self.refs = 0
+        self.last_used = time.time()
+        self.reconnects = 0
+
+    def address(self):
+        """返回本地映射地址，隧道断开时自动重连"""
+        if not self.connection.is_active:
+            logger.warning(f'ssh隧道{self.key}已断开，尝试重连')
+            self.connection.restart()
+            self.reconnects += 1
+        return self.connection.get_ssh()
+
+    def close(self):
+        try:
+            self.connection.server.close()
+        except Exception as e:
+            logger.warning(f'关闭ssh隧道{self.key}失败：{e}')
+
+
+def _tunnel_key(instance):
+    """隧道key为(隧道, 远端地址, 远端端口)，指纹用于识别隧道配置变更"""
+    tunnel = instance.tunnel
+    key = (tunnel.id, instance.host, int(instance.port))
+    tunnel_info = f'{tunnel.host}:{tunnel.port}:{tunnel.user}:{tunnel.password}:' \
+                  f'{tunnel.pkey_path}:{tunnel.pkey_password}'
+    return key, hashlib.md5(tunnel_info.encode('utf-8')).hexdigest()
+
+
+def acquire_tunnel(instance):
+    """
+    获取实例的共享隧道并增加引用计数，返回本地映射地址，使用结束需调用release_tunnel
+    :param instance:
+    :return: (host, port)
+    """
+    key, fingerprint = _tunnel_key(instance)
+    close_idle_tunnels()
+    with _key_lock(key):
+        stale = None
+        with _lock:
+            shared = _tunnels.get(key)
+            # 隧道配置变更，无引用时直接重建
+            if shared and shared.fingerprint != fingerprint and shared.refs == 0:
+                stale = _tunnels.pop(key)
+                shared = None
+            if shared:
+                shared.refs += 1
+                shared.last_used = time.time()
+        if stale:
+            stale.close()
+        if shared is None:
+            tunnel = instance.tunnel
+            connection = SSHConnection(instance.host, instance.port, tunnel.host, tunnel.port, tunnel.user,
+                                       tunnel.password, tunnel.pkey_path, tunnel.pkey_password,
+                                       keepalive=KEEPALIVE_INTERVAL)
+            shared = SharedTunnel(key, fingerprint, connection)
+            shared.refs = 1
+            with _lock:
+                _tunnels[key] = shared
+        try:
+            return shared.address()
+        except Exception:
+            with _lock:
+                shared.refs -= 1
+            raise
+
+
+def release_tunnel(instance):
+    """释放实例共享隧道的引用"""
+    key, _ = _tunnel_key(instance)
+    with _lock:
+        shared = _tunnels.get(key)
+        if shared and shared.refs > 0:
+            shared.refs -= 1
+            shared.last_used = time.time()
+
+
+def close_idle_tunnels(idle_timeout=IDLE_TIMEOUT):
+    """关闭无引用并且空闲超时的隧道"""
+    with _lock:
+        now = time.time()
+        idle = [_tunnels.pop(k) for k, v in list(_tunnels.items()) if v.refs == 0 and now - v.last_used > idle_timeout]
+    for shared in idle:
+        shared.close()
+
+
+def _key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def tunnel_stats():
+    """当前进程共享隧道的统计信息"""
+    return [{'tunnel_id': key[0], 'host': key[1], 'port': key[2], 'refs': shared.refs,
+             'reconnects': shared.reconnects, 'idle': round(time.time() - shared.last_used, 1)}
+            for key, shared in list(_tunnels.items())]
+
+
+class TunnelAddress(object):
+    """
+    获取实例实际连接地址的上下文管理器，配置了隧道的实例返回共享隧道的本地映射地址，供插件命令行使用
+    with TunnelAddress(instance) as (host, port):
+    """
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __enter__(self):
+        if self.instance.tunnel:
+            return acquire_tunnel(self.instance)
+        return self.instance.host, int(self.instance.port)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.instance.tunnel:
+            release_tunnel(self.instance)
@@ -1,4 +1,5 @@
 # -*- coding:utf-8 -*-
+import simplejson as json
 from django_q.tasks import schedule
 from django_q.models import Schedule
 
@@ -7,6 +8,38 @@ import logging
 logger = logging.getLogger('default')
 
 
+# 系统配置中定时任务相关的配置，单位为秒或者天，需为非负整数
+SCHEDULE_CONFIGS = ('replication_lag_interval', 'schema_metadata_interval', 'dashboard_rollup_interval',
+                    'dashboard_warm_interval', 'slow_query_retention_days', 'slow_query_hourly_days',
+                    'slow_query_daily_days')
+
+
+def check_schedule_configs(configs):
+    """校验系统配置中定时任务相关的配置，configs为配置页面提交的json，返回错误信息，校验通过返回None"""
+    try:
+        items = {item['key'].strip(): str(item['value']).strip() for item in json.loads(configs)}
+    except Exception:
+        # 格式错误由保存配置时处理
+        return None
+    for key in SCHEDULE_CONFIGS:
+        value = items.get(key, '')
+        if value and not value.isdigit():
+            return f'{key}需为非负整数，当前值：{value}'
+    return None
+
+
+def add_config_schedules(sys_config):
+    """根据系统配置添加或删除复制状态采集、元数据预取、dashboard汇总、缓存预热和慢日志明细维护任务"""
+    def interval(key):
+        return int(sys_config.get(key, 0) or 0)
+    add_replication_lag_schedule(interval('replication_lag_interval'))
+    add_schema_metadata_schedule(interval('schema_metadata_interval'))
+    add_dashboard_rollup_schedule(interval('dashboard_rollup_interval'))
+    add_dashboard_warm_schedule(interval('dashboard_warm_interval'))
+    add_slow_query_history_schedule(any(interval(key) > 0 for key in (
+        'slow_query_retention_days', 'slow_query_hourly_days', 'slow_query_daily_days')))
+
+
 def add_sql_schedule(name, run_date, workflow_id):
     """添加/修改sql定时任务"""
     del_schedule(name)
@@ -30,6 +63,56 @@ def add_sync_ding_user_schedule():
              name='同步钉钉用户ID', schedule_type='D', repeats=-1, timeout=-1)
 
 
+def add_replication_lag_schedule(interval):
+    """
+    添加/修改复制状态采集定时任务，interval单位秒，为0时删除任务
+    定时任务按整分钟调度，超过60秒的间隔四舍五入为整分钟，不足60秒时由采集任务在每分钟内多次采集
+    """
+    del_schedule(name='采集复制状态')
+    if interval > 0:
+        schedule('sql.utils.replication.collect', name='采集复制状态', schedule_type='I',
+                 minutes=max(1, (interval + 30) // 60), repeats=-1, timeout=-1)
+
+
+def add_schema_metadata_schedule(interval):
+    """添加/修改实例元数据预取定时任务，interval单位秒，为0时删除任务"""
+    del_schedule(name='预取实例元数据')
+    if interval > 0:
+        schedule('sql.utils.schema_metadata.prefetch',
+                 name='预取实例元数据', schedule_type='I', minutes=max(1, interval // 60), repeats=-1, timeout=-1)
+
+
+def add_dashboard_rollup_schedule(interval):
+    """添加/修改dashboard汇总定时任务，interval单位秒，为0时删除任务"""
+    del_schedule(name='dashboard汇总')
+    if interval > 0:
+        schedule('common.utils.dashboard_rollup.rollup',
+                 name='dashboard汇总', schedule_type='I', minutes=max(1, interval // 60), repeats=-1, timeout=-1)
+
+
+def add_dashboard_warm_schedule(interval):
+    """添加/修改dashboard图表缓存预热定时任务，interval单位秒，为0时删除任务"""
+    del_schedule(name='dashboard缓存预热')
+    if interval > 0:
+        schedule('common.dashboard.warm_charts',
+                 name='dashboard缓存预热', schedule_type='I', minutes=max(1, interval // 60), repeats=-1, timeout=-1)
+
+
+def add_slow_query_history_schedule(enabled):
+    """添加/删除慢日志明细维护定时任务，每天执行一次"""
+    del_schedule(name='慢日志明细维护')
+    if enabled:
+        schedule('sql.utils.slow_query_history.maintain',
+                 name='慢日志明细维护', schedule_type='D', repeats=-1, timeout=-1)
+
+
+def add_query_watchdog_schedule():
+    """添加查询超时终止定时任务，每分钟执行一次，已存在时不重复添加"""
+    if not Schedule.objects.filter(name='查询超时终止').exists():
+        schedule('sql.utils.query_watchdog.drain',
+                 name='查询超时终止', schedule_type='I', minutes=1, repeats=-1, timeout=-1)
+
+
 def del_schedule(name):
     """删除schedule"""
     try:
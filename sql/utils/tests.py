@@ -7,26 +7,38 @@
 """
 import datetime
 import json
+import os
+import queue
+import tempfile
+import time
+import uuid
 from unittest.mock import patch, MagicMock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import Permission, Group
 from django.test import TestCase, Client
 from django_q.models import Schedule
+from django_redis import get_redis_connection
 
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
-from sql.engines.models import ReviewResult, ReviewSet
+from sql.engines.models import ReviewResult, ReviewSet, ResultSet
 from sql.models import Users, SqlWorkflow, SqlWorkflowContent, Instance, ResourceGroup, \
     WorkflowLog, WorkflowAudit, WorkflowAuditDetail, WorkflowAuditSetting, \
-    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, ArchiveConfig
-from sql.utils.resource_group import user_groups, user_instances, auth_group_users
+    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, ArchiveConfig, Tunnel, QueryLog, \
+    SlowQuery, SlowQueryHistory, SlowLogCheckpoint, SlowQueryRollup, RollupWatermark
+from sql.utils.resource_group import user_groups, user_instances, user_instance_ids, auth_group_users
 from sql.utils.sql_review import is_auto_review, can_execute, can_timingtask, can_cancel, on_correct_time_period
 from sql.utils.sql_utils import *
+from sql.utils.extract_tables import extract_columns, ColumnReference, ColumnResolveError
 from sql.utils.execute_sql import execute, execute_callback
-from sql.utils.tasks import add_sql_schedule, del_schedule, task_info
+from sql.utils.tasks import add_sql_schedule, add_replication_lag_schedule, add_schema_metadata_schedule, \
+    add_dashboard_rollup_schedule, add_dashboard_warm_schedule, add_slow_query_history_schedule, del_schedule, task_info
 from sql.utils.workflow_audit import Audit
-from sql.utils.data_masking import data_masking, brute_mask
+from sql.utils.data_masking import data_masking, brute_mask, mask_rows, masking_index
+from sql.utils import ssh_tunnel, query_tree, replication, query_cache, query_watchdog, query_log, schema_metadata, \
+    slowlog_ingest, slow_query_history, search
 
 User = Users
 __author__ = 'hhyo'
@@ -81,6 +93,36 @@ class TestSQLUtils(TestCase):
         sql = "select * from user.users a join logs.log b on a.id=b.id;"
         self.assertEqual(extract_tables(sql), [{'name': 'users', 'schema': 'user'}, {'name': 'log', 'schema': 'logs'}])
 
+    def test_extract_columns(self):
+        """
+        测试输出列的来源字段解析
+        :return:
+        """
+        table_columns = {('db', 'users'): ['id', 'phone'], ('logs', 'log'): ['id', 'user_id', 'ip']}
+        sql = """select u.*, concat(l.ip, '-') ip, user_id, 1 from users u
+        join (select id, user_id, ip from logs.log) l on u.id=l.user_id
+        union all select id, phone, id, ip, 2 from logs.log"""
+        columns = extract_columns(sql, db_name='db', table_columns=lambda s, t: table_columns.get((s, t)))
+        self.assertEqual([c.name for c in columns], ['id', 'phone', 'ip', 'user_id', '1'])
+        self.assertEqual([c.sources for c in columns], [
+            (('db', 'users', 'id'), ('logs', 'log', 'id')),
+            (('db', 'users', 'phone'), ('logs', 'log', 'phone')),
+            (('logs', 'log', 'ip'), ('logs', 'log', 'id')),
+            (('logs', 'log', 'user_id'), ('logs', 'log', 'ip')),
+            (),
+        ])
+
+    def test_extract_columns_without_table_columns(self):
+        """
+        测试无字段信息时的解析，多表关联未指定表名的字段关联到全部表，*无法展开
+        :return:
+        """
+        columns = extract_columns("select a.phone p, name from users a, log b", db_name='db')
+        self.assertEqual(columns[0], ColumnReference('p', (('db', 'users', 'phone'),)))
+        self.assertEqual(columns[1].sources, (('db', 'users', 'name'), ('db', 'log', 'name')))
+        with self.assertRaises(ColumnResolveError):
+            extract_columns("select * from users", db_name='db')
+
     def test_generate_sql_from_sql(self):
         """
         测试从SQl文本中解析SQL
@@ -518,9 +560,10 @@ class TestExecuteSql(TestCase):
             operator_display='系统',
         )
 
+    @patch('sql.utils.execute_sql.invalidate_schema_metadata')
     @patch('sql.utils.execute_sql.notify_for_execute')
     @patch('sql.utils.execute_sql.Audit')
-    def test_execute_callback_success(self, _audit, _notify):
+    def test_execute_callback_success(self, _audit, _notify, _invalidate):
         # 初始化工单执行返回对象
         self.task_result = MagicMock()
         self.task_result.args = [self.wf.id]
@@ -545,6 +588,8 @@ class TestExecuteSql(TestCase):
             operator_display='系统',
         )
         _notify.assert_called_once()
+        # DDL工单结束后使实例资源缓存失效
+        _invalidate.assert_called_once_with(self.ins.id)
 
     @patch('sql.utils.execute_sql.notify_for_execute')
     @patch('sql.utils.execute_sql.Audit')
@@ -613,6 +658,58 @@ class TestTasks(TestCase):
         add_sql_schedule('test', datetime.datetime.now(), 1)
         _schedule.assert_called_once()
 
+    @patch('sql.utils.tasks.schedule')
+    def test_add_replication_lag_schedule(self, _schedule):
+        add_replication_lag_schedule(120)
+        _schedule.assert_called_once_with('sql.utils.replication.collect', name='采集复制状态', schedule_type='I',
+                                          minutes=2, repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        # 按整分钟四舍五入
+        add_replication_lag_schedule(150)
+        self.assertEqual(_schedule.call_args[1]['minutes'], 3)
+        _schedule.reset_mock()
+        add_replication_lag_schedule(30)
+        self.assertEqual(_schedule.call_args[1]['minutes'], 1)
+        _schedule.reset_mock()
+        add_replication_lag_schedule(0)
+        _schedule.assert_not_called()
+
+    @patch('sql.utils.tasks.schedule')
+    def test_add_schema_metadata_schedule(self, _schedule):
+        add_schema_metadata_schedule(600)
+        _schedule.assert_called_once_with('sql.utils.schema_metadata.prefetch', name='预取实例元数据',
+                                          schedule_type='I', minutes=10, repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        add_schema_metadata_schedule(0)
+        _schedule.assert_not_called()
+
+    @patch('sql.utils.tasks.schedule')
+    def test_add_dashboard_rollup_schedule(self, _schedule):
+        add_dashboard_rollup_schedule(300)
+        _schedule.assert_called_once_with('common.utils.dashboard_rollup.rollup', name='dashboard汇总',
+                                          schedule_type='I', minutes=5, repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        add_dashboard_rollup_schedule(0)
+        _schedule.assert_not_called()
+
+    @patch('sql.utils.tasks.schedule')
+    def test_add_dashboard_warm_schedule(self, _schedule):
+        add_dashboard_warm_schedule(300)
+        _schedule.assert_called_once_with('common.dashboard.warm_charts', name='dashboard缓存预热',
+                                          schedule_type='I', minutes=5, repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        add_dashboard_warm_schedule(0)
+        _schedule.assert_not_called()
+
+    @patch('sql.utils.tasks.schedule')
+    def test_add_slow_query_history_schedule(self, _schedule):
+        add_slow_query_history_schedule(True)
+        _schedule.assert_called_once_with('sql.utils.slow_query_history.maintain', name='慢日志明细维护',
+                                          schedule_type='D', repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        add_slow_query_history_schedule(False)
+        _schedule.assert_not_called()
+
     def test_del_schedule(self):
         del_schedule('some_name')
         with self.assertRaises(Schedule.DoesNotExist):
@@ -1307,6 +1404,40 @@ class TestDataMasking(TestCase):
         mask_result_rows = [('188****8888',), ('188****8889',), ('188****8810',)]
         self.assertEqual(r.rows, mask_result_rows)
 
+    @patch('sql.utils.data_masking.schema_snapshot')
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_data_masking_native(self, _inception, _schema_snapshot):
+        """本地解析脱敏，支持UNION且不请求Inception"""
+        self.sys_config.set('data_masking_native', 'true')
+        self.sys_config.set('query_check', 'true')
+        _schema_snapshot.return_value = {'users': ['id', 'phone']}
+        sql = """select * from users union all select id, phone from archer_test.users;"""
+        rows = ((1, '18888888888',), (2, '18888888889',))
+        query_result = ReviewSet(column_list=['id', 'phone'], rows=rows, full_sql=sql)
+        r = data_masking(self.ins, 'archer_test', sql, query_result)
+        self.assertEqual(r.rows, [[1, '188****8888'], [2, '188****8889']])
+        self.assertTrue(r.is_masked)
+        _inception.assert_not_called()
+        _schema_snapshot.assert_called_once_with(self.ins, 'archer_test')
+
+    def test_masking_index_invalidate(self):
+        """脱敏字段变更后索引自动失效"""
+        table_key = (self.ins.id, 'archer_test', 'users')
+        self.assertEqual(masking_index()['columns'][table_key], {'phone': ('phone', 1)})
+        DataMaskingColumns.objects.create(rule_type=1, active=True, instance=self.ins,
+                                          table_schema='archer_test', table_name='Users', column_name='Email')
+        self.assertEqual(masking_index()['columns'][table_key]['email'], ('Email', 1))
+        DataMaskingColumns.objects.all().delete()
+        self.assertEqual(masking_index()['columns'], {})
+        self.assertEqual(masking_index()['rules'], {1: ('(.{3})(.*)(.{4})', 2)})
+
+    def test_mask_rows(self):
+        """按列脱敏，未匹配的值和未配置规则的列保持不变"""
+        rows = (('18888888888', 'a', '18888888889'), (None, 'b', '1888'))
+        hit_columns = [{'index': 0, 'rule_type': 1}, {'index': -1, 'rule_type': 1}, {'index': 1, 'rule_type': 2}]
+        r = mask_rows(rows, hit_columns)
+        self.assertEqual(r, [['188****8888', 'a', '188****8889'], [None, 'b', '1888']])
+
 
 class TestResourceGroup(TestCase):
     def setUp(self):
@@ -1366,6 +1497,25 @@ class TestResourceGroup(TestCase):
         ins = user_instances(self.user)
         self.assertEqual(ins.__len__(), 0)
 
+    def test_user_instance_ids_cache(self):
+        """获取用户实例ID列表，按标签过滤，关联关系变更后缓存失效"""
+        tag, _ = InstanceTag.objects.get_or_create(tag_code='can_read', defaults={'tag_name': '支持查询', 'active': True})
+        self.user.resource_group.add(self.rgp1)
+        self.ins1.resource_group.add(self.rgp1)
+        self.ins2.resource_group.add(self.rgp1)
+        self.ins1.instance_tag.add(tag)
+        self.assertEqual(user_instance_ids(self.user, tag_codes=['can_read']), [self.ins1.id])
+        # 同一请求内重复获取不访问数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(user_instance_ids(self.user, db_type=['mysql'])),
+                             sorted([self.ins1.id, self.ins2.id]))
+        self.ins2.instance_tag.add(tag)
+        self.assertEqual(sorted(user_instance_ids(self.user, tag_codes=['can_read'])),
+                         sorted([self.ins1.id, self.ins2.id]))
+        self.rgp1.is_deleted = 1
+        self.rgp1.save()
+        self.assertEqual(user_instance_ids(self.user), [])
+
     def test_auth_group_users(self):
         """获取资源组内关联指定权限组的用户"""
         # 用户关联权限组
@@ -1375,3 +1525,584 @@ class TestResourceGroup(TestCase):
         # 获取资源组内关联指定权限组的用户
         users = auth_group_users(auth_group_names=[self.agp.name], group_id=self.rgp1.group_id)
         self.assertIn(self.user, users)
+
+
+class TestSSHTunnel(TestCase):
+    def setUp(self):
+        self.tunnel = Tunnel.objects.create(tunnel_name='some_tunnel', host='some_host', port=22)
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str',
+                                           tunnel=self.tunnel)
+
+    def tearDown(self):
+        ssh_tunnel._tunnels.clear()
+        ssh_tunnel._key_locks.clear()
+        self.ins.delete()
+        self.tunnel.delete()
+
+    @patch('sql.utils.ssh_tunnel.SSHConnection')
+    def test_shared_tunnel(self, _conn):
+        _conn.return_value.get_ssh.return_value = ('127.0.0.1', 10000)
+        self.assertEqual(ssh_tunnel.acquire_tunnel(self.ins), ('127.0.0.1', 10000))
+        self.assertEqual(ssh_tunnel.acquire_tunnel(self.ins), ('127.0.0.1', 10000))
+        _conn.assert_called_once()
+        self.assertEqual(ssh_tunnel.tunnel_stats()[0]['refs'], 2)
+        ssh_tunnel.release_tunnel(self.ins)
+        ssh_tunnel.release_tunnel(self.ins)
+        self.assertEqual(ssh_tunnel.tunnel_stats()[0]['refs'], 0)
+
+    @patch('sql.utils.ssh_tunnel.SSHConnection')
+    def test_connect_without_global_lock(self, _conn):
+        """建立隧道时不持有全局锁，其他隧道的获取、释放不被阻塞"""
+        def connect(*args, **kwargs):
+            self.assertFalse(ssh_tunnel._lock.locked())
+            return MagicMock()
+        _conn.side_effect = connect
+        ssh_tunnel.acquire_tunnel(self.ins)
+        _conn.assert_called_once()
+
+    @patch('sql.utils.ssh_tunnel.SSHConnection')
+    def test_reconnect(self, _conn):
+        _conn.return_value.is_active = False
+        ssh_tunnel.acquire_tunnel(self.ins)
+        _conn.return_value.restart.assert_called_once()
+        self.assertEqual(ssh_tunnel.tunnel_stats()[0]['reconnects'], 1)
+
+    @patch('sql.utils.ssh_tunnel.SSHConnection')
+    def test_close_idle_tunnels(self, _conn):
+        ssh_tunnel.acquire_tunnel(self.ins)
+        ssh_tunnel.close_idle_tunnels(idle_timeout=-1)
+        self.assertEqual(len(ssh_tunnel.tunnel_stats()), 1)
+        ssh_tunnel.release_tunnel(self.ins)
+        ssh_tunnel.close_idle_tunnels(idle_timeout=-1)
+        self.assertEqual(ssh_tunnel.tunnel_stats(), [])
+        _conn.return_value.server.close.assert_called_once()
+
+
+class TestQueryTree(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.engine = MagicMock()
+        self.engine.name = 'Inception'
+        self.engine.query_print.return_value = {'command': 'select'}
+
+    def tearDown(self):
+        self.sys_config.purge()
+        query_tree._lru.clear()
+        query_tree.invalidate_query_tree(self.ins.id)
+        self.ins.delete()
+
+    def test_cache_disabled(self):
+        query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1')
+        query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1')
+        self.assertEqual(self.engine.query_print.call_count, 2)
+
+    def test_cache_hit(self):
+        self.sys_config.set('query_tree_cache_ttl', '60')
+        r = query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1;')
+        self.assertEqual(r, {'command': 'select'})
+        # 注释、空白字符不影响缓存命中
+        r = query_tree.get_query_tree(self.engine, self.ins, 'some_db', '/* some comment */ select  1')
+        self.assertEqual(r, {'command': 'select'})
+        self.engine.query_print.assert_called_once()
+        # 进程内缓存失效后从Redis获取
+        query_tree._lru.clear()
+        query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1')
+        self.engine.query_print.assert_called_once()
+
+    def test_normalize_sql(self):
+        self.assertEqual(query_tree.normalize_sql('/* some comment */ select  1,\n\t2 ;'), 'select 1, 2')
+        # 字符串内的空白字符不合并，结果不同的语句不能命中同一个缓存
+        self.assertEqual(query_tree.normalize_sql("select  'a  b' from `t  1`"), "select 'a  b' from `t  1`")
+        self.assertNotEqual(query_tree.normalize_sql("select 'a  b'"), query_tree.normalize_sql("select 'a b'"))
+        # 保留版本注释和优化器提示
+        self.assertEqual(query_tree.normalize_sql('select /*+ MAX_EXECUTION_TIME(1000) */ 1 -- some comment\n'),
+                         'select /*+ MAX_EXECUTION_TIME(1000) */ 1')
+        self.assertEqual(query_tree.normalize_sql('select /*!40001 SQL_NO_CACHE */ 1'),
+                         'select /*!40001 SQL_NO_CACHE */ 1')
+        self.assertNotEqual(query_tree.normalize_sql('select /*+ NO_INDEX(t) */ * from t'),
+                            query_tree.normalize_sql('select * from t'))
+
+    def test_invalidate(self):
+        self.sys_config.set('query_tree_cache_ttl', '60')
+        query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1')
+        query_tree.invalidate_query_tree(self.ins.id)
+        query_tree.get_query_tree(self.engine, self.ins, 'some_db', 'select 1')
+        self.assertEqual(self.engine.query_print.call_count, 2)
+
+
+class TestReplication(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+
+    def tearDown(self):
+        self.sys_config.purge()
+        cache.delete_many([replication._lag_key(self.ins.id), replication._history_key(self.ins.id)])
+        self.ins.delete()
+
+    @patch('sql.utils.replication._probe')
+    def test_collect(self, _probe):
+        self.sys_config.set('replication_lag_interval', '60')
+        _probe.return_value = {'seconds_behind_master': 3, 'collect_time': 1}
+        replication.collect()
+        replication.collect()
+        self.assertEqual(replication.replication_lag(self.ins.id), {'seconds_behind_master': 3, 'collect_time': 1})
+        self.assertEqual(len(replication.lag_history(self.ins.id)), 2)
+        # 查询时使用采集的延迟，不再同步获取
+        query_engine = MagicMock()
+        query_engine.seconds_behind_master = 10
+        self.assertEqual(replication.seconds_behind_master(query_engine, self.ins), 3)
+
+    @patch('sql.utils.replication._probe')
+    def test_collect_disabled(self, _probe):
+        replication.collect()
+        _probe.assert_not_called()
+        query_engine = MagicMock()
+        query_engine.seconds_behind_master = 10
+        self.assertEqual(replication.seconds_behind_master(query_engine, self.ins), 10)
+
+
+class TestSchemaMetadata(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.engine = MagicMock(spec=['get_all_databases', 'get_all_tables', 'get_all_columns_by_tb',
+                                      'get_all_columns_by_db'])
+        self.engine.get_all_databases.return_value = ResultSet(rows=['some_db'])
+        self.engine.get_all_tables.return_value = ResultSet(rows=['some_tb'])
+        self.engine.get_all_columns_by_tb.return_value = ResultSet(rows=['id'])
+        self.engine.get_all_columns_by_db.return_value = ResultSet(rows=[('some_tb', ['id', 'name'])])
+
+    def tearDown(self):
+        self.sys_config.purge()
+        schema_metadata.invalidate(self.ins.id)
+        self.ins.delete()
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_get_resource(self, _get_engine):
+        _get_engine.return_value = self.engine
+        for _ in range(2):
+            resource = schema_metadata.get_resource(self.ins, 'table', db_name='some_db')
+            self.assertEqual(resource.rows, ['some_tb'])
+        self.engine.get_all_tables.assert_called_once()
+        with self.assertRaises(TypeError):
+            schema_metadata.get_resource(self.ins, 'column', db_name='some_db')
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_invalidate(self, _get_engine):
+        """更新版本号后缓存失效，其他实例不受影响"""
+        _get_engine.return_value = self.engine
+        other_ins = Instance.objects.create(instance_name='other_ins', type='slave', db_type='mysql',
+                                            host='some_host', port=3306, user='ins_user', password='some_str')
+        schema_metadata.get_resource(self.ins, 'database')
+        schema_metadata.get_resource(other_ins, 'database')
+        schema_metadata.invalidate(self.ins.id)
+        schema_metadata.get_resource(self.ins, 'database')
+        schema_metadata.get_resource(other_ins, 'database')
+        self.assertEqual(self.engine.get_all_databases.call_count, 3)
+        schema_metadata.invalidate(other_ins.id)
+        other_ins.delete()
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_get_resource_error(self, _get_engine):
+        """获取失败不缓存"""
+        _get_engine.return_value = self.engine
+        self.engine.get_all_databases.return_value = ResultSet(rows=[])
+        self.engine.get_all_databases.return_value.error = 'some error'
+        for _ in range(2):
+            resource = schema_metadata.get_resource(self.ins, 'database')
+            self.assertEqual(resource.error, 'some error')
+        self.assertEqual(self.engine.get_all_databases.call_count, 2)
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_prefetch(self, _get_engine):
+        _get_engine.return_value = self.engine
+        self.sys_config.set('schema_metadata_interval', '600')
+        schema_metadata.prefetch()
+        self.engine.get_all_columns_by_tb.assert_not_called()
+        _get_engine.reset_mock()
+        self.assertEqual(schema_metadata.get_resource(self.ins, 'database').rows, ['some_db'])
+        self.assertEqual(schema_metadata.get_resource(self.ins, 'table', db_name='some_db').rows, ['some_tb'])
+        self.assertEqual(schema_metadata.get_resource(self.ins, 'column', db_name='some_db', tb_name='some_tb').rows,
+                         ['id', 'name'])
+        # 预取后不再访问实例
+        _get_engine.assert_not_called()
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_prefetch_disabled(self, _get_engine):
+        schema_metadata.prefetch()
+        _get_engine.assert_not_called()
+
+    @patch('sql.utils.schema_metadata.get_engine')
+    def test_refresh(self, _get_engine):
+        """DDL工单结束后只刷新对应的库"""
+        _get_engine.return_value = self.engine
+        self.engine.get_all_databases.return_value = ResultSet(rows=['some_db', 'other_db'])
+        schema_metadata.refresh(self.ins.id, 'some_db')
+        self.engine.get_all_tables.assert_called_once_with(db_name='some_db', schema_name=None)
+        self.assertEqual(schema_metadata.get_resource(self.ins, 'database').rows, ['some_db', 'other_db'])
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.result = {'rows': [(1, 'a')], 'column_list': ['id', 'name'], 'affected_rows': 1}
+
+    def tearDown(self):
+        self.sys_config.purge()
+        query_tree.invalidate_query_tree(self.ins.id)
+        self.ins.delete()
+
+    def test_cacheable(self):
+        self.assertFalse(query_cache.cacheable(self.ins, 'select 1'))
+        self.sys_config.set('query_result_cache_ttl', '60')
+        self.assertTrue(query_cache.cacheable(self.ins, 'select 1'))
+        self.assertTrue(query_cache.cacheable(self.ins, "select * from t where a='now()'"))
+        self.assertFalse(query_cache.cacheable(self.ins, 'select now()'))
+        self.assertFalse(query_cache.cacheable(self.ins, 'select * from t where id=@id'))
+        self.assertFalse(query_cache.cacheable(self.ins, 'select * from t for update'))
+        self.assertFalse(query_cache.cacheable(self.ins, 'show tables'))
+        # 实例单独配置缓存时间
+        self.ins.query_cache_ttl = 0
+        self.assertFalse(query_cache.cacheable(self.ins, 'select 1'))
+
+    def test_get_set(self):
+        self.sys_config.set('query_result_cache_ttl', '60')
+        self.assertTrue(query_cache.set_result(self.ins, 'some_db', 'select 1;', 100, True, self.result))
+        self.assertEqual(query_cache.get_result(self.ins, 'some_db', '/* comment */select 1', 100, True), self.result)
+        # limit、权限校验结果不同时不命中
+        self.assertIsNone(query_cache.get_result(self.ins, 'some_db', 'select 1', 10, True))
+        self.assertIsNone(query_cache.get_result(self.ins, 'some_db', 'select 1', 100, False))
+        # 脱敏配置变更后失效
+        self.sys_config.set('data_masking', 'true')
+        self.assertIsNone(query_cache.get_result(self.ins, 'some_db', 'select 1', 100, True))
+
+    def test_max_size(self):
+        self.sys_config.set('query_result_cache_ttl', '60')
+        self.sys_config.set('query_result_cache_max_size', '1')
+        result = {'rows': [(str(uuid.uuid4()),) for _ in range(100)]}
+        self.assertFalse(query_cache.set_result(self.ins, 'some_db', 'select 1', 100, True, result))
+        self.assertIsNone(query_cache.get_result(self.ins, 'some_db', 'select 1', 100, True))
+
+
+class TestQueryWatchdog(TestCase):
+    def setUp(self):
+        get_redis_connection('default').delete(query_watchdog.WATCHDOG_KEY)
+
+    def tearDown(self):
+        get_redis_connection('default').delete(query_watchdog.WATCHDOG_KEY)
+
+    @patch('sql.utils.query_watchdog._kill')
+    def test_drain(self, _kill):
+        query_watchdog.register(1, 100, 0)
+        token = query_watchdog.register(1, 101, 0)
+        query_watchdog.unregister(token)
+        query_watchdog.register(1, 102, 60)
+        query_watchdog.drain()
+        _kill.assert_called_once_with(1, 100)
+        self.assertEqual(query_watchdog.pending(), 1)
+
+    @patch('sql.utils.query_watchdog.BATCH_SIZE', 2)
+    @patch('sql.utils.query_watchdog._kill')
+    def test_drain_batches(self, _kill):
+        """到期会话超过单批数量时一次执行全部终止"""
+        for i in range(5):
+            query_watchdog.register(1, i, 0)
+        query_watchdog.drain()
+        self.assertEqual(sorted(c[0][1] for c in _kill.call_args_list), [0, 1, 2, 3, 4])
+        self.assertEqual(query_watchdog.pending(), 0)
+
+    @patch('sql.utils.query_watchdog._scheduled', False)
+    def test_register(self):
+        tokens = [query_watchdog.register(1, i, 60) for i in range(10)]
+        self.assertEqual(query_watchdog.pending(), 10)
+        for token in tokens:
+            query_watchdog.unregister(token)
+        self.assertEqual(query_watchdog.pending(), 0)
+        query_watchdog.unregister(None)
+        # 首次登记时添加定时任务
+        self.assertEqual(Schedule.objects.filter(func='sql.utils.query_watchdog.drain').count(), 1)
+
+
+class TestQueryLog(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+
+    def tearDown(self):
+        self.sys_config.purge()
+        QueryLog.objects.all().delete()
+
+    @staticmethod
+    def query_log(i=0):
+        return QueryLog(instance_name='some_ins', db_name='some_db', sqllog=f'select {i}', effect_row=1,
+                        cost_time=0.1, username='some_user')
+
+    def test_save_sync(self):
+        query_log.save(self.query_log())
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log._ensure_thread')
+    def test_save_async(self, _ensure_thread):
+        self.sys_config.set('query_log_async', 'true')
+        for i in range(250):
+            query_log.save(self.query_log(i))
+        self.assertEqual(QueryLog.objects.count(), 0)
+        with patch.object(QueryLog.objects, 'bulk_create', wraps=QueryLog.objects.bulk_create) as bulk_create:
+            query_log.flush()
+            self.assertEqual(bulk_create.call_count, 3)
+        self.assertEqual(QueryLog.objects.count(), 250)
+
+    @patch('sql.utils.query_log._ensure_thread')
+    def test_save_queue_full(self, _ensure_thread):
+        self.sys_config.set('query_log_async', 'true')
+        with patch.object(query_log._queue, 'put_nowait', side_effect=queue.Full):
+            query_log.save(self.query_log())
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log._ensure_thread')
+    def test_bulk_create_error(self, _ensure_thread):
+        self.sys_config.set('query_log_async', 'true')
+        query_log.save(self.query_log())
+        with patch.object(QueryLog.objects, 'bulk_create', side_effect=Exception('some error')):
+            query_log.flush()
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log.FLUSH_INTERVAL', 0.01)
+    @patch('sql.utils.query_log._ensure_thread')
+    def test_writer_error_retry(self, _ensure_thread):
+        """后台线程写入前出错时整批放回，下次重试写入"""
+        self.sys_config.set('query_log_async', 'true')
+        query_log.save(self.query_log())
+        with patch('sql.utils.query_log._ensure_usable', side_effect=Exception('some error')):
+            with self.assertRaises(Exception):
+                query_log._run_once()
+        self.assertEqual(QueryLog.objects.count(), 0)
+        self.assertEqual(len(query_log._inflight), 1)
+        query_log._run_once()
+        self.assertEqual(QueryLog.objects.count(), 1)
+        self.assertEqual(query_log._inflight, [])
+
+
+class TestSlowLogIngest(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        fd, self.path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        # 慢日志时间为2020-01-01 00:00:00之后，早已结束
+        self.start = 1577836800
+
+    def tearDown(self):
+        os.remove(self.path)
+        SlowQueryHistory.objects.all().delete()
+        SlowQuery.objects.all().delete()
+        self.ins.delete()
+
+    def append(self, offset, query_time, sql, user='root'):
+        with open(self.path, 'a') as f:
+            f.write(f"""# Time: 2020-01-01T00:00:00.000000Z
+# User@Host: {user}[{user}] @  [127.0.0.1]  Id:    11
+# Query_time: {query_time}  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 100
+use some_db;
+SET timestamp={self.start + offset};
+{sql};
+""")
+        # 文件已停止写入，最后一条慢日志完整
+        os.utime(self.path, (time.time() - 120, time.time() - 120))
+
+    def test_fingerprint(self):
+        self.assertEqual(slowlog_ingest.fingerprint("SELECT * FROM t1 WHERE id = 1 AND name IN ('a', 'b');"),
+                         'select * from t1 where id = ? and name in(?+)')
+        self.assertEqual(slowlog_ingest.fingerprint("insert into t values (1, 'a'),(2, 'b') /* some comment */"),
+                         'insert into t values(?+)')
+        self.assertEqual(slowlog_ingest.fingerprint('select a from t limit 10, 20'), 'select a from t limit ?')
+        self.assertEqual(slowlog_ingest.checksum('select ?'), '16219655761820A2')
+
+    def test_quantile_sketch(self):
+        sketch = slowlog_ingest.QuantileSketch()
+        for i in range(1, 1001):
+            sketch.add(i)
+        self.assertAlmostEqual(sketch.quantile(0.95), 950, delta=950 * 0.02)
+        self.assertAlmostEqual(sketch.quantile(0.5), 500, delta=500 * 0.02)
+
+    def test_ingest(self):
+        """同一个桶内的同类语句汇总为一条明细"""
+        for i in range(10):
+            self.append(i, i + 1, f'select * from t where id = {i}')
+        self.append(10, 1, 'select * from t where id = 1', user='some_user')
+        self.append(400, 1, 'update t set a = 1')
+        self.assertEqual(slowlog_ingest.ingest(self.ins, self.path), 2)
+        history = SlowQueryHistory.objects.get(checksum__fingerprint='select * from t where id = ?')
+        self.assertEqual(history.hostname_max, 'some_host:3306')
+        self.assertEqual(history.instance, self.ins)
+        self.assertEqual(history.ts_cnt, 11)
+        self.assertEqual(history.query_time_max, 10)
+        self.assertEqual(history.query_time_sum, 56)
+        self.assertEqual(history.user_max, 'root')
+        self.assertEqual(history.db_max, 'some_db')
+        self.assertEqual(history.sample, 'select * from t where id = 9;')
+        self.assertEqual(history.ts_min, datetime.datetime(2020, 1, 1, 0, 0, 1))
+        self.assertEqual(history.ts_max, datetime.datetime(2020, 1, 1, 0, 0, 19))
+        self.assertEqual(SlowQuery.objects.count(), 2)
+
+    def test_ingest_resume(self):
+        """从上次位置继续读取，未结束的桶重新读取，不重复计数"""
+        self.start = int(time.time()) // 300 * 300
+        self.append(0, 1, 'select 1')
+        self.append(1, 1, 'select 2')
+        self.assertEqual(slowlog_ingest.ingest(self.ins, self.path), 0)
+        self.assertEqual(SlowLogCheckpoint.objects.get(instance=self.ins).offset, 0)
+        self.append(2, 1, 'select 3')
+        offset = os.path.getsize(self.path)
+        self.append(300, 1, 'select 4')
+        self.assertEqual(slowlog_ingest.ingest(self.ins, self.path), 1)
+        self.assertEqual(slowlog_ingest.ingest(self.ins, self.path), 0)
+        self.assertEqual(SlowQueryHistory.objects.get().ts_cnt, 3)
+        # 最后一个桶尚未结束，下次从该桶的第一条慢日志开始读取
+        self.assertEqual(SlowLogCheckpoint.objects.get(instance=self.ins).offset, offset)
+
+    def test_ingest_truncated(self):
+        """文件被截断后从头读取"""
+        self.append(0, 1, 'select * from some_tb where id = 1')
+        slowlog_ingest.ingest(self.ins, self.path)
+        open(self.path, 'w').close()
+        self.append(400, 1, 'select 1')
+        slowlog_ingest.ingest(self.ins, self.path)
+        self.assertEqual(SlowQueryHistory.objects.count(), 2)
+
+
+class TestSlowQueryHistory(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        SlowQuery.objects.create(checksum='ABC', fingerprint='select ?', sample='select 1')
+
+    def tearDown(self):
+        SlowQueryHistory.objects.all().delete()
+        SlowQuery.objects.all().delete()
+        SlowQueryRollup.objects.all().delete()
+        RollupWatermark.objects.all().delete()
+        self.ins.delete()
+
+    def history(self, ts_min, query_time_sum, hostname='some_host:3306', instance=None):
+        return SlowQueryHistory.objects.create(
+            instance=instance or self.ins, hostname_max=hostname, user_max='root', db_max='some_db',
+            checksum_id='ABC', sample='select 1', ts_min=ts_min, ts_max=ts_min + datetime.timedelta(seconds=1),
+            ts_cnt=1, query_time_sum=query_time_sum, query_time_min=query_time_sum, query_time_max=query_time_sum,
+            query_time_pct_95=query_time_sum, query_time_median=query_time_sum, query_time_stddev=0)
+
+    def test_aggregate(self):
+        columns = ['checksum', 'ts_cnt', 'Query_time_sum', 'Query_time_stddev', 'Merge_passes_stddev']
+        self.assertEqual(slow_query_history._aggregate('checksum', columns), 'checksum')
+        self.assertEqual(slow_query_history._aggregate('Query_time_sum', columns), 'sum(`Query_time_sum`)')
+        self.assertIn('sqrt', slow_query_history._aggregate('Query_time_stddev', columns))
+        self.assertEqual(slow_query_history._aggregate('Merge_passes_stddev', columns), 'max(`Merge_passes_stddev`)')
+
+    def test_partition_definitions(self):
+        definitions = slow_query_history._partition_definitions([datetime.date(2020, 12, 1)])
+        self.assertEqual(definitions, "partition p202012 values less than (to_days('2021-01-01')), "
+                                      "partition pmax values less than maxvalue")
+        self.assertEqual(slow_query_history._to_days(datetime.date(2020, 1, 1)), 737790)
+
+    def test_compact(self):
+        """同一小时的明细合并，合并后重新汇总不重复计数"""
+        day = datetime.datetime(2020, 1, 1)
+        for query_time in (1, 3):
+            self.history(day + datetime.timedelta(minutes=query_time), query_time)
+        self.history(day + datetime.timedelta(hours=1), 5)
+        last = self.history(datetime.datetime(2020, 1, 2), 7)
+        RollupWatermark.objects.create(name='mysql_slow_query_review_history', last_id=last.id)
+        SlowQueryRollup.objects.create(stat_hour=day, db_max='some_db', user_max='root', ts_cnt=2)
+        slow_query_history.compact(datetime.date(2020, 1, 2), "date_format(ts_min, '%%Y-%%m-%%d %%H')", 'hour')
+        self.assertEqual(SlowQueryHistory.objects.count(), 3)
+        compacted = SlowQueryHistory.objects.get(ts_min=day + datetime.timedelta(minutes=1))
+        self.assertEqual(compacted.instance, self.ins)
+        self.assertEqual(compacted.ts_cnt, 2)
+        self.assertEqual(compacted.ts_max, day + datetime.timedelta(minutes=3, seconds=1))
+        self.assertEqual(compacted.query_time_sum, 4)
+        self.assertEqual(compacted.query_time_min, 1)
+        self.assertEqual(compacted.query_time_max, 3)
+        self.assertEqual(compacted.query_time_median, 2)
+        self.assertAlmostEqual(compacted.query_time_stddev, 1)
+        # 已汇总的次数被扣减，等待重新汇总压缩后的明细
+        self.assertEqual(SlowQueryRollup.objects.get(stat_hour=day).ts_cnt, 0)
+        self.assertEqual(SlowQueryHistory.objects.get(ts_min=datetime.datetime(2020, 1, 2)).id, last.id)
+
+    @patch('sql.utils.slow_query_history._compact_day')
+    def test_compact_watermark(self, _compact_day):
+        """已压缩的天不再处理"""
+        self.history(datetime.datetime(2020, 1, 1), 1)
+        slow_query_history.compact(datetime.date(2020, 1, 3), 'date(ts_min)', 'day')
+        self.assertEqual([c[0][0] for c in _compact_day.call_args_list],
+                         [datetime.date(2020, 1, 1), datetime.date(2020, 1, 2)])
+        watermark = RollupWatermark.objects.get(name='mysql_slow_query_review_history:day')
+        self.assertEqual(watermark.last_id, slow_query_history._to_days(datetime.date(2020, 1, 3)))
+        _compact_day.reset_mock()
+        slow_query_history.compact(datetime.date(2020, 1, 4), 'date(ts_min)', 'day')
+        self.assertEqual([c[0][0] for c in _compact_day.call_args_list], [datetime.date(2020, 1, 3)])
+        _compact_day.reset_mock()
+        slow_query_history.compact(datetime.date(2020, 1, 4), 'date(ts_min)', 'day')
+        _compact_day.assert_not_called()
+
+    def test_purge(self):
+        """非分区表按批删除"""
+        self.history(datetime.datetime(2020, 1, 1), 1)
+        self.history(datetime.datetime(2020, 1, 3), 1)
+        slow_query_history.purge(datetime.date(2020, 1, 2))
+        self.assertEqual(SlowQueryHistory.objects.get().ts_min, datetime.datetime(2020, 1, 3))
+
+    def test_backfill_instance(self):
+        history = self.history(datetime.datetime(2020, 1, 1), 1, hostname='other_host:3306')
+        SlowQueryHistory.objects.filter(id=history.id).update(instance=None)
+        other_ins = Instance.objects.create(instance_name='other_ins', type='slave', db_type='mysql',
+                                            host='other_host', port=3306, user='ins_user', password='some_str')
+        slow_query_history.backfill_instance()
+        self.assertEqual(SlowQueryHistory.objects.get(id=history.id).instance_id, other_ins.id)
+        SlowQueryHistory.objects.all().delete()
+        other_ins.delete()
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        for sqllog, alias in (('select * from some_tb', ''), ('select * from other_tb', 'some_alias'),
+                              ('show tables', '')):
+            QueryLog.objects.create(instance_name='some_ins', db_name='some_db', sqllog=sqllog, effect_row=1,
+                                    username='some_user', user_display='中文名', alias=alias)
+
+    def tearDown(self):
+        self.sys_config.purge()
+        QueryLog.objects.all().delete()
+
+    def test_search(self):
+        fields = ['sqllog', 'user_display', 'alias']
+        self.assertEqual(search.search(QueryLog.objects.all(), fields, '').count(), 3)
+        self.assertEqual(search.search(QueryLog.objects.all(), fields, 'some').count(), 2)
+        self.assertEqual(search.search(QueryLog.objects.all(), fields, '* from').count(), 2)
+        self.assertNotIn('match', str(search.search(QueryLog.objects.all(), fields, 'some').query))
+
+    def test_search_fulltext(self):
+        """开启全文检索时使用全文索引筛选，并保留LIKE条件"""
+        self.sys_config.set('fulltext_search', 'true')
+        fields = ['sqllog', 'user_display', 'alias']
+        sql = str(search.search(QueryLog.objects.all(), fields, '* from 中文').query)
+        self.assertIn('match (`query_log`.`sqllog`, `query_log`.`user_display`, `query_log`.`alias`) '
+                      'against (+"from" +"中文" in boolean mode)', sql)
+        self.assertIn('LIKE', sql)
+        # 没有可用于全文索引的词
+        self.assertNotIn('match', str(search.search(QueryLog.objects.all(), fields, '* a').query))
+
+    def test_count(self):
+        self.assertEqual(search.count(QueryLog.objects.all()), 3)
+        self.sys_config.set('list_count_limit', '2')
+        self.assertEqual(search.count(QueryLog.objects.filter(username='some_user')), 2)
+        self.assertEqual(search.count(QueryLog.objects.filter(alias='some_alias')), 1)
+        with patch('sql.utils.search._estimated_rows', return_value=100):
+            self.assertEqual(search.count(QueryLog.objects.all()), 100)
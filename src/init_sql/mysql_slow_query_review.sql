@@ -15,6 +15,7 @@ CREATE TABLE `mysql_slow_query_review` (
 CREATE TABLE `mysql_slow_query_review_history` (
   `id` int(11) NOT NULL AUTO_INCREMENT,
   `hostname_max` varchar(64) NOT NULL,
+  `instance_id` int(11) DEFAULT NULL,
   `client_max` varchar(64) DEFAULT NULL,
   `user_max` varchar(64) NOT NULL,
   `db_max` varchar(64) DEFAULT NULL,
@@ -117,5 +118,19 @@ CREATE TABLE `mysql_slow_query_review_history` (
   `Bytes_median` float DEFAULT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY (checksum, ts_min, ts_max),
-  KEY `idx_hostname_max_ts_min` (`hostname_max`,`ts_min`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
+  KEY `idx_hostname_max_ts_min` (`hostname_max`,`ts_min`),
+  KEY `idx_instance_id_ts_min` (`instance_id`,`ts_min`),
+  KEY `idx_ts_min` (`ts_min`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- pt-query-digest写入时按hostname_max匹配实例
+DELIMITER $$
+CREATE TRIGGER `trg_slow_query_history_instance` BEFORE INSERT ON `mysql_slow_query_review_history`
+FOR EACH ROW
+BEGIN
+  IF NEW.instance_id IS NULL THEN
+    SET NEW.instance_id = (SELECT id FROM sql_instance
+                           WHERE concat(host, ':', port) = NEW.hostname_max ORDER BY id LIMIT 1);
+  END IF;
+END$$
+DELIMITER ;
\ No newline at end of file
@@ -0,0 +1,70 @@
+-- 查询结果缓存
+alter table sql_instance add query_cache_ttl int(11) DEFAULT NULL comment '查询结果缓存时间，单位秒';
+alter table query_log add cache_hit tinyint(1) NOT NULL DEFAULT 0 comment '是否命中结果缓存';
+
+-- dashboard汇总表
+CREATE TABLE `query_log_rollup` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `stat_date` date NOT NULL COMMENT '统计日期',
+  `user_display` varchar(50) NOT NULL DEFAULT '' COMMENT '操作人中文名',
+  `db_name` varchar(64) NOT NULL DEFAULT '' COMMENT '数据库名称',
+  `query_count` bigint(20) NOT NULL DEFAULT 0 COMMENT '检索次数',
+  `effect_row` bigint(20) NOT NULL DEFAULT 0 COMMENT '检索行数',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_stat_date_user_db` (`stat_date`, `user_display`, `db_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='查询日志汇总';
+
+CREATE TABLE `mysql_slow_query_rollup` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `stat_hour` datetime(6) NOT NULL COMMENT '统计小时',
+  `db_max` varchar(64) NOT NULL DEFAULT '',
+  `user_max` varchar(64) NOT NULL DEFAULT '',
+  `ts_cnt` double NOT NULL DEFAULT 0 COMMENT '执行次数',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_stat_hour_db_user` (`stat_hour`, `db_max`, `user_max`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='慢日志汇总';
+
+CREATE TABLE `rollup_watermark` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(64) NOT NULL COMMENT '明细表',
+  `last_id` bigint(20) NOT NULL DEFAULT 0 COMMENT '已汇总的最大ID',
+  `update_time` datetime(6) NOT NULL COMMENT '更新时间',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='汇总进度';
+
+-- 慢日志采集
+CREATE TABLE `slow_log_checkpoint` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `instance_id` int(11) NOT NULL,
+  `file_path` varchar(255) NOT NULL COMMENT '慢日志文件',
+  `inode` bigint(20) NOT NULL DEFAULT 0 COMMENT '文件inode',
+  `offset` bigint(20) NOT NULL DEFAULT 0 COMMENT '已处理的位置',
+  `update_time` datetime(6) NOT NULL COMMENT '更新时间',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_instance_file_path` (`instance_id`, `file_path`),
+  CONSTRAINT `fk_slow_log_checkpoint_instance` FOREIGN KEY (`instance_id`) REFERENCES `sql_instance` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='慢日志读取位置';
+
+-- 慢日志明细关联实例，增加ts_min索引用于过期清理和压缩，数据量较大时建议在业务低峰执行
+ALTER TABLE mysql_slow_query_review_history
+  ADD COLUMN `instance_id` int(11) DEFAULT NULL AFTER `hostname_max`,
+  ADD KEY `idx_instance_id_ts_min` (`instance_id`, `ts_min`),
+  ADD KEY `idx_ts_min` (`ts_min`);
+UPDATE mysql_slow_query_review_history h JOIN sql_instance i ON h.hostname_max = concat(i.host, ':', i.port)
+SET h.instance_id = i.id;
+DELIMITER $$
+CREATE TRIGGER `trg_slow_query_history_instance` BEFORE INSERT ON `mysql_slow_query_review_history`
+FOR EACH ROW
+BEGIN
+  IF NEW.instance_id IS NULL THEN
+    SET NEW.instance_id = (SELECT id FROM sql_instance
+                           WHERE concat(host, ':', port) = NEW.hostname_max ORDER BY id LIMIT 1);
+  END IF;
+END$$
+DELIMITER ;
+
+-- 查询日志、SQL工单全文检索，需MySQL 5.7.6及以上版本，创建完成后在系统配置中开启fulltext_search
+-- ngram_token_size保持默认值2，建议关闭innodb_ft_enable_stopword，数据量较大时建议在业务低峰执行
+ALTER TABLE query_log ADD FULLTEXT INDEX ft_query_log_search (sqllog, user_display, alias) WITH PARSER ngram;
+ALTER TABLE sql_workflow ADD FULLTEXT INDEX ft_sql_workflow_search (workflow_name, engineer_display) WITH PARSER ngram;
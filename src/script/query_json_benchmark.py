@@ -0,0 +1,55 @@
+# -*- coding: UTF-8 -*-
+"""
+查询结果序列化性能对比，ExtendJSONEncoderFTime按行序列化与按列序列化
+在项目根目录执行：python src/script/query_json_benchmark.py [行数] [列数]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import simplejson as json
+
+from common.utils import columnar_json
+from common.utils.extend_json_encoder import ExtendJSONEncoderFTime
+
+
+def main(row_count=10000, column_count=20):
+    now = datetime.now()
+    generators = [
+        lambda r: r,
+        lambda r: f'user{r}@example.com',
+        lambda r: now - timedelta(seconds=r),
+        lambda r: Decimal(random.randint(0, 10 ** 8)) / 100,
+        lambda r: random.random(),
+        lambda r: None,
+    ]
+    column_list = [f'col{c}' for c in range(column_count)]
+    rows = [tuple(generators[c % len(generators)](r) for c in range(column_count)) for r in range(row_count)]
+    result = {'status': 0, 'msg': 'ok', 'data': {'column_list': column_list, 'rows': rows, 'affected_rows': row_count}}
+
+    start = time.perf_counter()
+    legacy = json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True)
+    legacy_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    payload = columnar_json.dumps(result)
+    cost = time.perf_counter() - start
+
+    # 结果一致性校验，按列格式的decimal为字符串
+    data = json.loads(payload)
+    columns = [[float(value) for value in values] if column_type == 'decimal' else values
+               for column_type, values in zip(data['data']['column_types'], data['data']['columns'])]
+    assert [list(row) for row in zip(*columns)] == json.loads(legacy)['data']['rows']
+    # orjson返回bytes，simplejson返回str
+    print(f'{row_count}行 x {column_count}列，序列化库：{"orjson" if isinstance(payload, bytes) else "simplejson"}')
+    print(f'按行序列化：{legacy_cost:.3f}s，{len(legacy)}字节')
+    print(f'按列序列化：{cost:.3f}s，{len(payload)}字节')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
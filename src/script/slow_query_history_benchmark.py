@@ -0,0 +1,102 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志明细表性能对比，hostname_max过滤的普通表与instance_id过滤的按月分区表
+在Archery数据库中创建两张与mysql_slow_query_review_history结构相同的测试表并生成数据，结束后删除
+在项目根目录执行：python src/script/slow_query_history_benchmark.py [行数] [实例数]，如50000000 50
+"""
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'archery.settings')
+
+import django
+
+django.setup()
+
+from django.db import connection
+
+from sql.utils.slow_query_history import TABLE, _months, _partition_definitions
+
+PLAIN = f'{TABLE}_bench'
+PARTITIONED = f'{TABLE}_bench_part'
+# 生成数据的时间范围，单位天
+DAYS = 365
+SEED_ROWS = 10000
+CHECKSUMS = 2000
+
+REVIEW_SQL = '''select checksum, max(ts_max), sum(Query_time_sum) / sum(ts_cnt), sum(ts_cnt)
+from {table} where {condition} and ts_min between %s and %s
+group by checksum order by sum(ts_cnt) desc limit 14;'''
+
+
+def timed(cursor, sql, params=None):
+    start = time.perf_counter()
+    cursor.execute(sql, params)
+    cursor.fetchall()
+    return time.perf_counter() - start
+
+
+def generate(cursor, row_count, instance_count):
+    """写入种子数据后按ID和时间偏移成倍复制，直到达到指定行数"""
+    cursor.execute(f'create table {PLAIN} like {TABLE};')
+    cursor.execute(f'alter table {PLAIN} drop primary key, add primary key (id, ts_min);')
+    now = datetime.utcnow()
+    seed = []
+    for i in range(SEED_ROWS):
+        ts_min = now - timedelta(seconds=i * DAYS * 86400 // SEED_ROWS)
+        instance_id = i % instance_count + 1
+        seed.append((f'bench_host{instance_id}:3306', instance_id, 'root', f'db{i % 20}', f'{i % CHECKSUMS:032X}',
+                     'select ?', ts_min, ts_min + timedelta(seconds=300), 1 + i % 10, (1 + i % 10) * 0.5))
+    cursor.executemany(f'''insert into {PLAIN} (hostname_max, instance_id, user_max, db_max, checksum, sample,
+        ts_min, ts_max, ts_cnt, Query_time_sum) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);''', seed)
+    count = SEED_ROWS
+    while count < row_count:
+        cursor.execute(f'''insert ignore into {PLAIN} (hostname_max, instance_id, user_max, db_max, checksum, sample,
+              ts_min, ts_max, ts_cnt, Query_time_sum)
+            select hostname_max, instance_id, user_max, db_max, checksum, sample,
+              greatest(date_sub(ts_min, interval (id + %s) %% 86400 second), %s),
+              greatest(date_sub(ts_max, interval (id + %s) %% 86400 second), %s), ts_cnt, Query_time_sum
+            from {PLAIN} order by id limit %s;''', [count, now - timedelta(days=DAYS)] * 2 + [row_count - count])
+        cursor.execute(f'select count(*) from {PLAIN};')
+        count, last_count = cursor.fetchone()[0], count
+        if count == last_count:
+            break
+        print(f'已生成{count}行')
+
+    cursor.execute(f'create table {PARTITIONED} like {PLAIN};')
+    months = _months((now - timedelta(days=DAYS)).date().replace(day=1), date.today().replace(day=1))
+    cursor.execute(f'alter table {PARTITIONED} partition by range (to_days(ts_min)) ({_partition_definitions(months)});')
+    cursor.execute(f'insert into {PARTITIONED} select * from {PLAIN};')
+
+
+def main(row_count=1000000, instance_count=50):
+    with connection.cursor() as cursor:
+        try:
+            generate(cursor, row_count, instance_count)
+            end = datetime.utcnow()
+            for days in (1, 7, 30):
+                params = [end - timedelta(days=days), end]
+                cost = timed(cursor, REVIEW_SQL.format(table=PLAIN, condition="hostname_max = 'bench_host1:3306'"),
+                             params)
+                partition_cost = timed(cursor, REVIEW_SQL.format(table=PARTITIONED, condition='instance_id = 1'),
+                                       params)
+                print(f'最近{days}天慢日志统计：hostname_max普通表{cost:.3f}s，instance_id分区表{partition_cost:.3f}s')
+            # 清理最早一个月的数据
+            cursor.execute('''select partition_name, partition_description from information_schema.partitions
+                where table_schema = database() and table_name = %s order by partition_ordinal_position limit 1;''',
+                           [PARTITIONED])
+            name, less_than = cursor.fetchone()
+            cursor.execute('select from_days(%s);', [less_than])
+            before = cursor.fetchone()[0]
+            delete_cost = timed(cursor, f'delete from {PLAIN} where ts_min < %s;', [before])
+            drop_cost = timed(cursor, f'alter table {PARTITIONED} drop partition {name};')
+            print(f'清理{before}之前的数据：delete {delete_cost:.3f}s，drop partition {drop_cost:.3f}s')
+        finally:
+            cursor.execute(f'drop table if exists {PLAIN}, {PARTITIONED};')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])